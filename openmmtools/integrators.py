@@ -35,6 +35,8 @@ this program.  If not, see <http://www.gnu.org/licenses/>.
 # GLOBAL IMPORTS
 #=============================================================================================
 
+import time
+
 import numpy
 
 import simtk.unit
@@ -50,6 +52,191 @@ from .constants import kB
 from openmmtools import respa
 
 
+class _ThermostatedMixin(object):
+
+    """
+    Mixin for integrators with a temperature and quantities that only need to be computed once.
+
+    Integrators add their one-time computations, if any, such as per-DOF velocity standard deviations, between
+    `_begin_initialization()` and `_end_initialization()`.  This block runs at the first step, and again after
+    the temperature or timestep are changed with `setTemperature()` or `setStepSize()`.  This allows changing the
+    temperature of an integrator, for example in a replica exchange simulation, without creating a new one.
+
+    The integrator must define the global variable 'kT'.
+
+    """
+
+    # Whether the initialization block computes quantities from the timestep or collision rate, so that it has to be
+    # rerun when they change.  Integrators whose initialization block only depends on the temperature, and sets up
+    # state such as thermostat variables that must not be reset by those changes, set this to False.
+    _timestep_dependent_initialization = True
+
+    # Message of the ValueError raised by `step()` if the global 'has_constraints' is set, for integrators that detect
+    # constraints they do not support with `_add_constraint_detection()`; None if constraints are supported.
+    _constraints_error = None
+
+    # Whether the per-DOF 'v' are velocities sampled from the Maxwell-Boltzmann distribution.  Overdamped integrators,
+    # which set 'v' to the displacement divided by the timestep, set this to False.
+    _physical_velocities = True
+
+    # The (global, expression) pairs of the initialization block that depend on the timestep, in the order they are
+    # computed, added with `_add_timestep_dependent_global()`.
+    _timestep_dependent_globals = ()
+
+    def _begin_initialization(self):
+        """Begin the block of computations that are run at the first step and after parameter changes."""
+        self.addGlobalVariable("initialized", 0)  # 0 if precomputed quantities must be recomputed
+        self.beginIfBlock("initialized = 0")
+
+    def _end_initialization(self):
+        """End the block of computations that are run at the first step and after parameter changes."""
+        self.addComputeGlobal("initialized", "1")
+        self.endBlock()
+
+    def _add_timestep_dependent_global(self, variable, expression):
+        """Add the computation of a global that depends on the timestep, which `add_timestep_ramp()` repeats."""
+        self.addComputeGlobal(variable, expression)
+        self._timestep_dependent_globals += ((variable, expression),)
+
+    def _mark_dirty(self):
+        """Have the precomputed quantities, if any, recomputed at the next step."""
+        global_names = [self.getGlobalVariableName(index) for index in range(self.getNumGlobalVariables())]
+        if "initialized" in global_names:
+            self.setGlobalVariableByName("initialized", 0)
+
+    def getTemperature(self):
+        """
+        Get the temperature.
+
+        Returns
+        -------
+        temperature : simtk.unit.Quantity
+            The temperature.
+
+        """
+        kT = self.getGlobalVariableByName("kT") * simtk.unit.kilojoules_per_mole
+        return kT / kB
+
+    def setTemperature(self, temperature):
+        """
+        Set the temperature.
+
+        Parameters
+        ----------
+        temperature : simtk.unit.Quantity
+            The new temperature.
+
+        """
+        kT = kB * temperature
+        self.setGlobalVariableByName("kT", kT.value_in_unit_system(simtk.unit.md_unit_system))
+        self._mark_dirty()
+
+    def setStepSize(self, timestep):
+        """
+        Set the integration timestep.
+
+        Parameters
+        ----------
+        timestep : simtk.unit.Quantity
+            The new timestep.
+
+        """
+        mm.CustomIntegrator.setStepSize(self, timestep)
+        if self._timestep_dependent_initialization:
+            self._mark_dirty()
+
+    def step(self, steps):
+        """
+        Advance the simulation by integrating a specified number of time steps.
+
+        Parameters
+        ----------
+        steps : int
+            The number of time steps to take.
+
+        Raises
+        ------
+        ValueError
+            If the System has constraints that the integrator does not support.  The dynamics are then skipped, so
+            the positions and velocities are unchanged.
+
+        """
+        super(_ThermostatedMixin, self).step(steps)
+        if self._constraints_error is not None and self.getGlobalVariableByName("has_constraints"):
+            raise ValueError(self._constraints_error)
+
+
+class _CollisionRateMixin(_ThermostatedMixin):
+
+    """
+    Mixin for thermostated integrators with a collision rate.
+
+    The integrator must define the global variable 'collision_rate' in units of 1/picoseconds, and compute any
+    quantity that depends on it in the initialization block.
+
+    """
+
+    def getCollisionRate(self):
+        """
+        Get the collision rate.
+
+        Returns
+        -------
+        collision_rate : simtk.unit.Quantity
+            The collision rate.
+
+        """
+        return self.getGlobalVariableByName("collision_rate") / simtk.unit.picoseconds
+
+    def setCollisionRate(self, collision_rate):
+        """
+        Set the collision rate.
+
+        Parameters
+        ----------
+        collision_rate : simtk.unit.Quantity
+            The new collision rate.
+
+        """
+        self.setGlobalVariableByName("collision_rate", collision_rate * simtk.unit.picoseconds)
+        if self._timestep_dependent_initialization:
+            self._mark_dirty()
+
+
+def _add_constraint_detection(integrator):
+    """
+    Add the detection of constraints, setting the global 'has_constraints' to 1 if the System has constraints and 0 otherwise.
+
+    The velocities are set to the positions, a dilation that changes the length of every constraint, and constrained,
+    so that any change reveals constraints.  The velocities are overwritten, and must be saved by the caller if needed.
+
+    """
+    integrator.addComputePerDof("v", "x")
+    integrator.addConstrainVelocities()
+    integrator.addComputeSum("has_constraints", "select(m, (v - x)^2, 0)")
+    integrator.addComputeGlobal("has_constraints", "select(has_constraints, 1, 0)")
+
+
+def _add_constraint_detection_without_storage(integrator):
+    """
+    Add the detection of constraints for integrators without per-DOF storage, setting the global 'has_constraints'.
+
+    The dilation x is added to the velocities before they are constrained.  Constraining the velocities is a projection
+    that is orthogonal with respect to the masses, so it reduces their mass-weighted norm, computed in the global
+    'constraint_detection_norm', if and only if the System has constraints.  The dilation is then subtracted and the
+    velocities constrained again, which leaves them constrained, and unchanged up to rounding for Systems without
+    constraints.
+
+    """
+    integrator.addComputePerDof("v", "v + x")
+    integrator.addComputeSum("constraint_detection_norm", "m*v*v")
+    integrator.addConstrainVelocities()
+    integrator.addComputeSum("has_constraints", "m*v*v")
+    integrator.addComputeGlobal("has_constraints", "1 - delta(constraint_detection_norm - has_constraints)")
+    integrator.addComputePerDof("v", "v - x")
+    integrator.addConstrainVelocities()
+
+
 class MTSIntegrator(respa.MTSIntegrator):
 
     """
@@ -90,6 +277,238 @@ class MTSIntegrator(respa.MTSIntegrator):
         super(MTSIntegrator, self).__init__(timestep, groups)
 
 
+class LangevinMTSIntegrator(_CollisionRateMixin, respa.MTSIntegrator):
+
+    """
+    Langevin multiple timestep integrator built on the rRESPA scheme of MTSIntegrator.
+
+    Force groups are specified as for MTSIntegrator.  The Ornstein-Uhlenbeck velocity randomization
+    is applied either in the middle of every innermost position update (``thermostat='inner'``,
+    the BAOAB analog of rRESPA), or in two half steps at the beginning and end of each outer
+    time step (``thermostat='outer'``, the OBABO analog).
+
+    Examples
+    --------
+
+    Create a Langevin MTS integrator with a 4 fs outer timestep.
+
+    >>> integrator = LangevinMTSIntegrator(4*simtk.unit.femtoseconds, [(0,1), (1,2), (2,8)])
+
+    """
+
+    def __init__(self, timestep=1.0 * simtk.unit.femtoseconds, groups=[(0, 1)], temperature=298.0 * simtk.unit.kelvin,
+                 collision_rate=91.0 / simtk.unit.picoseconds, thermostat='inner'):
+        """Create a LangevinMTSIntegrator.
+
+        Parameters
+        ----------
+        timestep : simtk.unit.Quantity with units compatible with femtoseconds, optional default=1*femtoseconds
+           The largest (outermost) integration time step to use.
+        groups : list of tuples, optional, default=(0,1)
+           A list of tuples defining the force groups.  The first element of each tuple is the force group index, and the second element is the number of times that force group should be evaluated in one time step.
+        temperature : numpy.unit.Quantity compatible with kelvin, default: 298.0*simtk.unit.kelvin
+           The temperature.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default: 91.0/simtk.unit.picoseconds
+           The collision rate.
+        thermostat : str, optional, default='inner'
+           Where the stochastic velocity update is applied: 'inner' (innermost level) or 'outer' (outermost level).
+
+        Notes
+        -----
+        Randomizing the velocities at the innermost level damps the resonances that limit the outer timestep of
+        rRESPA, while randomizing at the outermost level keeps the dynamics within one time step deterministic.
+
+        References
+        ----------
+        Benedict Leimkuhler, Daniel T. Margul, and Mark E. Tuckerman.
+        Stochastic, resonance-free multiple time-step algorithm for molecular dynamics with very large time steps.
+        Molecular Physics 111:3579 (2013).
+        http://dx.doi.org/10.1080/00268976.2013.844369
+
+        """
+        if len(groups) == 0:
+            raise ValueError("No force groups specified")
+        if thermostat not in ['inner', 'outer']:
+            raise ValueError("thermostat must be 'inner' or 'outer', not '%s'" % thermostat)
+        groups = sorted(groups, key=lambda x: x[1])
+        self._thermostat = thermostat
+        self._innermost_substeps = groups[-1][1]
+
+        respa.CustomIntegrator.__init__(self, timestep)
+        self.addGlobalVariable("kT", kB * temperature)  # thermal energy
+        self.addGlobalVariable("collision_rate", collision_rate * simtk.unit.picoseconds)  # in 1/picoseconds
+        self.addGlobalVariable("a", 0)  # velocity damping factor of a stochastic velocity update
+        self.addGlobalVariable("b", 0)  # velocity noise factor of a stochastic velocity update
+        self.addPerDofVariable("x1", 0)  # position before application of constraints
+
+        # Compute the Ornstein-Uhlenbeck coefficients for the current timestep.
+        self._begin_initialization()
+        if thermostat == 'inner':
+            self._add_timestep_dependent_global("a", "exp(-collision_rate * dt / %d)" % self._innermost_substeps)
+        else:
+            self._add_timestep_dependent_global("a", "exp(-collision_rate * dt / 2)")
+        self._add_timestep_dependent_global("b", "sqrt(1 - a^2)")
+        self._end_initialization()
+
+        self.addUpdateContextState()
+
+        if thermostat == 'outer':
+            self._createStochasticVelocityUpdate()
+        self._createSubstepSizes(groups)
+        self._createSubsteps(1, groups)
+        if thermostat == 'outer':
+            self._createStochasticVelocityUpdate()
+        self.addConstrainVelocities()
+
+    def _createStochasticVelocityUpdate(self):
+        """Add an Ornstein-Uhlenbeck velocity update using the precomputed coefficients a and b."""
+        self.addComputePerDof("v", "a*v + b*sqrt(kT/m)*gaussian")
+        self.addConstrainVelocities()
+
+    def _createInnermostStep(self, substeps):
+        if self._thermostat == 'outer':
+            return super(LangevinMTSIntegrator, self)._createInnermostStep(substeps)
+        # Split the position update in two halves around the stochastic velocity update.
+        for i in range(2):
+            self.addComputePerDof("x1", "x")
+            self.addComputePerDof("x", "x+0.5*mts_h1*v")
+            self.addConstrainPositions()
+            self.addComputePerDof("v", "(x-x1)/(0.5*mts_h1)")
+            if i == 0:
+                self._createStochasticVelocityUpdate()
+
+
+class IsokineticMTSIntegrator(_CollisionRateMixin, respa.MTSIntegrator):
+
+    """
+    Stochastic isokinetic Nose-Hoover RESPA (SIN(R)) multiple timestep integrator.
+
+    Every degree of freedom is coupled to a Nose-Hoover thermostat variable under an isokinetic
+    constraint, which bounds its kinetic energy and removes the resonances that limit the outer
+    timestep of rRESPA to about 5 fs.  The slow forces can then be evaluated every 20-100 fs.
+    Force groups are specified as for MTSIntegrator.
+
+    Examples
+    --------
+
+    Evaluate force group 1 every 24 fs and force group 0 every 1 fs.
+
+    >>> integrator = IsokineticMTSIntegrator(24*simtk.unit.femtoseconds, [(1,1), (0,24)])
+
+    """
+
+    # The initialization block draws the thermostat variables, which only depend on the temperature.
+    _timestep_dependent_initialization = False
+    _constraints_error = ("IsokineticMTSIntegrator does not support constraints; "
+                          "use a System without constraints, for example WaterBox(constrained=False).")
+
+    def __init__(self, timestep=1.0 * simtk.unit.femtoseconds, groups=[(0, 1)], temperature=298.0 * simtk.unit.kelvin,
+                 collision_rate=10.0 / simtk.unit.picoseconds, thermostat_timescale=20.0 * simtk.unit.femtoseconds):
+        """Create an IsokineticMTSIntegrator.
+
+        Parameters
+        ----------
+        timestep : simtk.unit.Quantity with units compatible with femtoseconds, optional default=1*femtoseconds
+           The largest (outermost) integration time step to use.
+        groups : list of tuples, optional, default=(0,1)
+           A list of tuples defining the force groups.  The first element of each tuple is the force group index, and the second element is the number of times that force group should be evaluated in one time step.
+        temperature : numpy.unit.Quantity compatible with kelvin, default: 298.0*simtk.unit.kelvin
+           The temperature.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default: 10.0/simtk.unit.picoseconds
+           The collision rate of the Langevin dynamics of the second thermostat variables.
+        thermostat_timescale : numpy.unit.Quantity compatible with femtoseconds, default: 20.0*simtk.unit.femtoseconds
+           The timescale tau of the thermostat variables, whose masses are kT*tau^2.
+
+        Notes
+        -----
+        This is the SIN(R) scheme with one thermostat variable (L=1) per degree of freedom.  Each degree of freedom
+        with velocity v carries thermostat velocities v1 and v2 (per-DOF variables), and m*v^2 + 0.5*Q1*v1^2 = kT is
+        conserved by all parts of the dynamics except the Langevin dynamics of v2.  The forces update v and v1 with
+        the exact isokinetic flow, the position update is split around the thermostat update at the innermost level.
+        The thermostat variables are initialized at the first step and whenever the temperature is changed, after
+        rescaling the velocities to satisfy the isokinetic constraint.
+
+        Only the configurational distribution is canonical: the velocities are bounded by the isokinetic
+        constraint, so the kinetic energy reported by OpenMM does not correspond to the temperature.
+        Constraints are not supported: if the System has constraints, `step()` raises a ValueError without
+        changing the positions or velocities.
+
+        References
+        ----------
+        Benedict Leimkuhler, Daniel T. Margul, and Mark E. Tuckerman.
+        Stochastic, resonance-free multiple time-step algorithm for molecular dynamics with very large time steps.
+        Molecular Physics 111:3579 (2013).
+        http://dx.doi.org/10.1080/00268976.2013.844369
+
+        """
+        if len(groups) == 0:
+            raise ValueError("No force groups specified")
+        groups = sorted(groups, key=lambda x: x[1])
+        kT = kB * temperature
+
+        respa.CustomIntegrator.__init__(self, timestep)
+        self.addGlobalVariable("kT", kT)  # thermal energy
+        self.addGlobalVariable("collision_rate", collision_rate * simtk.unit.picoseconds)  # in 1/picoseconds
+        self.addGlobalVariable("tau", thermostat_timescale / simtk.unit.picoseconds)  # thermostat timescale
+        self.addGlobalVariable("Q1", 0)  # mass of v1
+        self.addGlobalVariable("Q2", 0)  # mass of v2
+        self.addPerDofVariable("v1", 0)  # first thermostat velocity
+        self.addPerDofVariable("v2", 0)  # second thermostat velocity
+        self.addGlobalVariable("has_constraints", 0)  # 1 if the System has constraints
+
+        #
+        # Detection of constraints, which are not supported, with the velocities saved in v1.
+        #
+        self._begin_initialization()
+        self.addComputePerDof("v1", "v")
+        _add_constraint_detection(self)
+        self.addComputePerDof("v", "v1")
+
+        #
+        # Initialization of the thermostat variables on the isokinetic constraint surface.
+        #
+        self.addComputeGlobal("Q1", "kT*tau^2")
+        self.addComputeGlobal("Q2", "kT*tau^2")
+        self.addComputePerDof("v1", "sqrt(kT/Q1)*gaussian")
+        self.addComputePerDof("v2", "sqrt(kT/Q2)*gaussian")
+        self._createIsokineticRescaling("0")
+        self._end_initialization()
+
+        self.addUpdateContextState()
+        self.beginIfBlock("has_constraints = 0")
+        self._createSubstepSizes(groups)
+        self._createSubsteps(1, groups)
+        self.endBlock()
+
+    def _createKick(self, group, stepSize):
+        # Exact isokinetic flow of v and v1 under a constant force, written in the numerically stable form
+        # of a velocity addition, with tanhc(y) = tanh(y)/y and the maximum velocity sqrt(kT/m).
+        force = "f" + str(group)
+        common = ("; D=1 + v*%s*h*tanhc/kT; tanhc=(tanh(y)+delta(y))/(y+delta(y)); y=sqrt(%s^2/(m*kT))*h; h=%s"
+                  % (force, force, stepSize))
+        self.addComputePerDof("v1", "v1/(cosh(y)*D)" + common)
+        self.addComputePerDof("v", "(v + h*%s/m*tanhc)/D" % force + common)
+
+    def _createThermostatStep(self, stepSize):
+        """Add the isokinetic Nose-Hoover and Ornstein-Uhlenbeck update of the thermostat variables."""
+        self._createIsokineticRescaling("0.5*" + stepSize)
+        self.addComputePerDof("v2", "v2 + 0.5*(%s)*(Q1*v1^2 - kT)/Q2" % stepSize)
+        self.addComputePerDof("v2", "v2*exp(-collision_rate*h) + sqrt(kT/Q2*(1 - exp(-2*collision_rate*h)))*gaussian; h=" + stepSize)
+        self.addComputePerDof("v2", "v2 + 0.5*(%s)*(Q1*v1^2 - kT)/Q2" % stepSize)
+        self._createIsokineticRescaling("0.5*" + stepSize)
+
+    def _createIsokineticRescaling(self, stepSize):
+        """Add the Nose-Hoover update of v1 by v2, with v and v1 rescaled onto the isokinetic constraint surface."""
+        # Computing the rescaling from the current v and v1 also removes any accumulated rounding error.
+        self.addComputePerDof("v1", "v1*exp(-v2*h)*sqrt(kT/(m*v^2 + 0.5*Q1*v1^2*exp(-2*v2*h))); h=" + stepSize)
+        self.addComputePerDof("v", "v*sqrt(max(kT - 0.5*Q1*v1^2, 0)/(m*v^2 + delta(v)))")
+
+    def _createInnermostStep(self, substeps):
+        self.addComputePerDof("x", "x+0.5*mts_h1*v")
+        self._createThermostatStep("mts_h1")
+        self.addComputePerDof("x", "x+0.5*mts_h1*v")
+
+
 class DummyIntegrator(mm.CustomIntegrator):
 
     """
@@ -185,129 +604,720 @@ class GradientDescentMinimizationIntegrator(mm.CustomIntegrator):
         self.addComputeGlobal("step_size", "step_size * (2.0*accept + 0.5*(1-accept))")
 
 
-class VelocityVerletIntegrator(mm.CustomIntegrator):
+def _add_projected_force_computation(integrator, scratch):
+    """
+    Add the computation of the forces projected onto the tangent space of the constraints to the per-DOF variable 'fp'.
 
-    """Verlocity Verlet integrator.
+    The velocities are saved in the per-DOF variable 'scratch', replaced by f/m for the velocity constraints to
+    project them, and restored.  Massless particles get zero projected forces.
 
-    Notes
-    -----
-    This integrator is taken verbatim from Peter Eastman's example appearing in the CustomIntegrator header file documentation.
+    """
+    integrator.addComputePerDof(scratch, "v")
+    integrator.addComputePerDof("v", "select(m, f/m, 0)")
+    integrator.addConstrainVelocities()
+    integrator.addComputePerDof("fp", "m*v")
+    integrator.addComputePerDof("v", scratch)
+
+
+class FIREMinimizationIntegrator(mm.CustomIntegrator):
+
+    """Fast inertial relaxation engine (FIRE) minimizer implemented as an integrator.
 
     References
     ----------
-    W. C. Swope, H. C. Andersen, P. H. Berens, and K. R. Wilson, J. Chem. Phys. 76, 637 (1982)
+    Erik Bitzek, Pekka Koskinen, Franz Gaehler, Michael Moseler, and Peter Gumbsch "Structural relaxation made simple", Physical Review Letters 97, 170201 (2006)
+    http://dx.doi.org/10.1103/PhysRevLett.97.170201
+
+    Julien Guenole, Wolfram G. Noehring, Aviral Vaid, Frederic Houlle, Zhuocheng Xie, Aruna Prakash, and Erik Bitzek "Assessment and optimization of the fast inertial relaxation engine (FIRE) for energy minimization in atomistic simulations and its implementation in LAMMPS", Computational Materials Science 175, 109584 (2020)
+    http://dx.doi.org/10.1016/j.commatsci.2020.109584
 
     Examples
     --------
 
-    Create a velocity Verlet integrator.
+    Create a FIRE minimization integrator.
 
-    >>> timestep = 1.0 * simtk.unit.femtoseconds
-    >>> integrator = VelocityVerletIntegrator(timestep)
+    >>> integrator = FIREMinimizationIntegrator()
 
     """
 
-    def __init__(self, timestep=1.0 * simtk.unit.femtoseconds):
-        """Construct a velocity Verlet integrator.
+    def __init__(self, timestep=1.0 * units.femtoseconds, max_timestep=None, force_tolerance=10.0 * units.kilojoules_per_mole / units.nanometers):
+        """
+        Construct a FIRE minimization integrator.
 
         Parameters
         ----------
         timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1*simtk.unit.femtoseconds
-           The integration timestep.
+           The initial timestep of the damped dynamics.
+        max_timestep : numpy.unit.Quantity compatible with femtoseconds, optional, default: None
+           The maximum timestep.  If None, ten times the initial timestep is used.
+        force_tolerance : numpy.unit.Quantity compatible with kilojoules_per_mole/nanometers, default: 10*kilojoules_per_mole/nanometers
+           The minimization stops once the root mean square force is smaller than this value.
 
-        """
+        Notes
+        -----
+        FIRE runs dynamics in which the velocities are steered toward the direction of the forces, accelerated
+        while the power is positive, and quenched as soon as the system moves uphill.  Each step takes a single force
+        evaluation.  This implements FIRE 2.0 with semi-implicit Euler integration, and constraints are applied with
+        the same scheme as VelocityVerletIntegrator.
 
-        super(VelocityVerletIntegrator, self).__init__(timestep)
+        The global variable 'frms' holds the root mean square force at the beginning of the last step, and 'converged'
+        is set to 1, after which steps leave the positions unchanged, once it drops below 'force_tolerance'.  The forces
+        are projected onto the constraints, so that the force components that the constraints cancel are ignored.
+
+        """
 
+        if max_timestep is None:
+            max_timestep = 10 * timestep
+        super(FIREMinimizationIntegrator, self).__init__(timestep)
+
+        self.addGlobalVariable("force_tolerance", force_tolerance.value_in_unit_system(units.md_unit_system))
+        self.addGlobalVariable("dt_max", max_timestep / units.picoseconds)
+        self.addGlobalVariable("dt_min", 0.02 * timestep / units.picoseconds)
+        self.addGlobalVariable("alpha", 0.1)  # velocity mixing parameter
+        self.addGlobalVariable("npositive", 0)  # number of consecutive steps with positive power
+        self.addGlobalVariable("P", 0)  # power
+        self.addGlobalVariable("vnorm", 0)
+        self.addGlobalVariable("fnorm", 0)
+        self.addGlobalVariable("ndof", 0)
+        self.addGlobalVariable("frms", 0)  # root mean square force
+        self.addGlobalVariable("converged", 0)
+        self.addGlobalVariable("initialized", 0)
         self.addPerDofVariable("x1", 0)
+        self.addPerDofVariable("fp", 0)  # projected forces
 
+        # Update context state.
         self.addUpdateContextState()
-        self.addComputePerDof("v", "v+0.5*dt*f/m")
-        self.addComputePerDof("x", "x+dt*v")
+
+        # Start from rest.
+        self.beginIfBlock("initialized = 0")
+        self.addConstrainPositions()
+        self.addComputePerDof("v", "0")
+        self.addComputeSum("ndof", "1")
+        self.addComputeGlobal("initialized", "1")
+        self.endBlock()
+
+        # Check for convergence.
+        _add_projected_force_computation(self, "x1")
+        self.addComputeSum("fnorm", "fp^2")
+        self.addComputeGlobal("frms", "sqrt(fnorm/ndof)")
+        self.addComputeGlobal("converged", "step(force_tolerance - frms)")
+
+        self.beginIfBlock("converged = 0")
+
+        # Accelerate while moving downhill, and stop as soon as moving uphill.
+        self.addComputeSum("P", "fp*v")
+        self.beginIfBlock("P > 0")
+        self.addComputeGlobal("npositive", "npositive + 1")
+        self.beginIfBlock("npositive > 5")
+        self.addComputeGlobal("dt", "min(1.1*dt, dt_max)")
+        self.addComputeGlobal("alpha", "0.99*alpha")
+        self.endBlock()
+        self.endBlock()
+        self.beginIfBlock("P <= 0")
+        self.addComputeGlobal("npositive", "0")
+        self.addComputeGlobal("dt", "max(0.5*dt, dt_min)")
+        self.addComputeGlobal("alpha", "0.1")
+        self.addComputePerDof("x", "x - 0.5*dt*v")
+        self.addComputePerDof("v", "0")
+        self.endBlock()
+
+        # Semi-implicit Euler step with the velocities steered toward the forces.
+        self.addComputePerDof("v", "v + dt*f/m")
+        self.addComputeSum("vnorm", "v^2")
+        self.addComputeGlobal("vnorm", "sqrt(vnorm)")
+        self.addComputeGlobal("fnorm", "sqrt(fnorm)")
+        self.addComputePerDof("v", "(1-alpha)*v + alpha*vnorm*fp/(fnorm + delta(fnorm))")
+        self.addComputePerDof("x", "x + dt*v")
         self.addComputePerDof("x1", "x")
         self.addConstrainPositions()
-        self.addComputePerDof("v", "v+0.5*dt*f/m+(x-x1)/dt")
+        self.addComputePerDof("v", "v + (x-x1)/dt")
         self.addConstrainVelocities()
 
+        self.endBlock()
+
 
-class AndersenVelocityVerletIntegrator(mm.CustomIntegrator):
+class LBFGSMinimizationIntegrator(mm.CustomIntegrator):
 
-    """Velocity Verlet integrator with Andersen thermostat using per-particle collisions (rather than massive collisions).
+    """Limited-memory Broyden-Fletcher-Goldfarb-Shanno (L-BFGS) minimizer implemented as an integrator.
 
     References
     ----------
-    Hans C. Andersen "Molecular dynamics simulations at constant pressure and/or temperature", Journal of Chemical Physics 72, 2384-2393 (1980)
-    http://dx.doi.org/10.1063/1.439486
+    Jorge Nocedal "Updating quasi-Newton matrices with limited storage", Mathematics of Computation 35, 773-782 (1980)
+    http://dx.doi.org/10.1090/S0025-5718-1980-0572855-7
 
     Examples
     --------
 
-    Create a velocity Verlet integrator with Andersen thermostat.
-
-    >>> timestep = 1.0 * simtk.unit.femtoseconds
-    >>> collision_rate = 91.0 / simtk.unit.picoseconds
-    >>> temperature = 298.0 * simtk.unit.kelvin
-    >>> integrator = AndersenVelocityVerletIntegrator(temperature, collision_rate, timestep)
+    Create an L-BFGS minimization integrator that keeps the last five position and gradient changes.
 
-    Notes
-    ------
-    The velocity Verlet integrator is taken verbatim from Peter Eastman's example in the CustomIntegrator header file documentation.
-    The efficiency could be improved by avoiding recomputation of sigma_v every timestep.
+    >>> integrator = LBFGSMinimizationIntegrator(history=5)
 
     """
 
-    def __init__(self, temperature=298 * simtk.unit.kelvin, collision_rate=91.0 / simtk.unit.picoseconds, timestep=1.0 * simtk.unit.femtoseconds):
-        """Construct a velocity Verlet integrator with Andersen thermostat, implemented as per-particle collisions (rather than massive collisions).
+    def __init__(self, history=5, initial_step_size=0.01 * units.angstroms, force_tolerance=10.0 * units.kilojoules_per_mole / units.nanometers):
+        """
+        Construct an L-BFGS minimization integrator.
 
         Parameters
         ----------
-        temperature : numpy.unit.Quantity compatible with kelvin, default=298*simtk.unit.kelvin
-           The temperature of the fictitious bath.
-        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default=91/simtk.unit.picoseconds
-           The collision rate with fictitious bath particles.
-        timestep : numpy.unit.Quantity compatible with femtoseconds, default=1*simtk.unit.femtoseconds
-           The integration timestep.
+        history : int, default: 5
+           The number of position and gradient changes used to approximate the inverse Hessian.
+        initial_step_size : numpy.unit.Quantity compatible with nanometers, default: 0.01*simtk.unit.angstroms
+           The norm of the first step, which is taken along the forces.
+        force_tolerance : numpy.unit.Quantity compatible with kilojoules_per_mole/nanometers, default: 10*kilojoules_per_mole/nanometers
+           The minimization stops once the root mean square force is smaller than this value.
+
+        Notes
+        -----
+        Each step computes a quasi-Newton search direction with the two-loop recursion, and backtracks along it until
+        the Armijo condition is satisfied.  Position and gradient changes are only stored if they have positive
+        curvature, which keeps the search direction downhill; if no downhill step is found, the history is cleared.
+        The 2*history+4 per-DOF variables that are needed make this minimizer more memory intensive than FIRE.
+        With constraints, the forces are projected onto the constraints and the position constraints are applied
+        after each trial step.  The velocities are left unchanged.
+
+        The global variable 'frms' holds the root mean square force at the beginning of the last step, and 'converged'
+        is set to 1, after which steps leave the positions unchanged, once it drops below 'force_tolerance'.
 
         """
-        super(AndersenVelocityVerletIntegrator, self).__init__(timestep)
 
-        #
-        # Integrator initialization.
-        #
-        kT = kB * temperature
-        self.addGlobalVariable("kT", kT)  # thermal energy
-        self.addGlobalVariable("p_collision", timestep * collision_rate)  # per-particle collision probability per timestep
-        self.addPerDofVariable("sigma_v", 0)  # velocity distribution stddev for Maxwell-Boltzmann (computed later)
-        self.addPerDofVariable("collision", 0)  # 1 if collision has occured this timestep, 0 otherwise
-        self.addPerDofVariable("x1", 0)  # for constraints
+        if history < 1:
+            raise ValueError("history must be at least 1, not %s" % str(history))
+        timestep = 1.0 * units.femtoseconds
+        super(LBFGSMinimizationIntegrator, self).__init__(timestep)
 
-        #
-        # Update velocities from Maxwell-Boltzmann distribution for particles that collide.
-        #
-        self.addComputePerDof("sigma_v", "sqrt(kT/m)")
-        self.addComputePerDof("collision", "step(p_collision-uniform)")  # if collision has occured this timestep, 0 otherwise
-        self.addComputePerDof("v", "(1-collision)*v + collision*sigma_v*gaussian")  # randomize velocities of particles that have collided
+        self.addGlobalVariable("force_tolerance", force_tolerance.value_in_unit_system(units.md_unit_system))
+        self.addGlobalVariable("initial_step_size", initial_step_size / units.nanometers)
+        self.addGlobalVariable("step_length", 0)  # fraction of the quasi-Newton step taken
+        self.addGlobalVariable("energy_old", 0)
+        self.addGlobalVariable("gp", 0)  # directional derivative along the search direction
+        self.addGlobalVariable("sy", 0)  # curvature along the last step
+        self.addGlobalVariable("yy", 0)
+        self.addGlobalVariable("gamma", 0)  # scale of the initial inverse Hessian
+        self.addGlobalVariable("beta", 0)
+        self.addGlobalVariable("fnorm", 0)
+        self.addGlobalVariable("ndof", 0)
+        self.addGlobalVariable("frms", 0)  # root mean square force
+        self.addGlobalVariable("converged", 0)
+        self.addPerDofVariable("d", 0)  # inverse Hessian times gradient
+        self.addPerDofVariable("x_old", 0)
+        self.addPerDofVariable("f_old", 0)
+        self.addPerDofVariable("fp", 0)  # projected forces
+        for i in range(1, history + 1):
+            self.addGlobalVariable("rho%d" % i, 0)  # 1/(s.y), or 0 if the pair is not stored
+            self.addGlobalVariable("a%d" % i, 0)
+            self.addPerDofVariable("s%d" % i, 0)  # position change, most recent first
+            self.addPerDofVariable("y%d" % i, 0)  # gradient change, most recent first
 
-        #
-        # Velocity Verlet step
-        #
+        # Update context state.
+        self.addUpdateContextState()
+
+        # Check for convergence.
+        self.addComputeSum("ndof", "1")
+        _add_projected_force_computation(self, "d")
+        self.addComputeSum("fnorm", "fp^2")
+        self.addComputeGlobal("frms", "sqrt(fnorm/ndof)")
+        self.addComputeGlobal("converged", "step(force_tolerance - frms)")
+
+        self.beginIfBlock("converged = 0")
+        self.addConstrainPositions()
+
+        # Two-loop recursion for the inverse Hessian times the gradient.
+        self.addComputePerDof("d", "-fp")
+        for i in range(1, history + 1):
+            self.addComputeSum("a%d" % i, "rho{0}*s{0}*d".format(i))
+            self.addComputePerDof("d", "d - a{0}*y{0}".format(i))
+        self.addComputeSum("sy", "s1*y1")
+        self.addComputeSum("yy", "y1*y1")
+        self.addComputeGlobal("gamma", "select(rho1, sy/yy, initial_step_size/sqrt(fnorm))")
+        self.addComputePerDof("d", "gamma*d")
+        for i in range(history, 0, -1):
+            self.addComputeSum("beta", "rho{0}*y{0}*d".format(i))
+            self.addComputePerDof("d", "d + s{0}*(a{0} - beta)".format(i))
+
+        # Backtracking line search along -d.
+        self.addComputeSum("gp", "fp*d")
+        self.addComputeGlobal("energy_old", "energy")
+        self.addComputePerDof("x_old", "x")
+        self.addComputePerDof("f_old", "fp")
+        self.addComputeGlobal("step_length", "1")
+        self.addComputePerDof("x", "x_old - step_length*d")
+        self.addConstrainPositions()
+        # Also backtracks if the energy is NaN.
+        self.beginWhileBlock("step(energy_old + 1e-4*step_length*gp - energy) * delta(energy - energy) = 0")
+        self.addComputeGlobal("step_length", "0.5*step_length")
+        self.addComputePerDof("x", "x_old - step_length*d")
+        self.addConstrainPositions()
+        self.beginIfBlock("step_length < 1e-10")
+        self.addComputePerDof("x", "x_old")
+        self.addComputeGlobal("step_length", "0")
+        self.endBlock()
+        self.endBlock()
+
+        # Store the position and gradient changes if they have positive curvature, and otherwise clear the history
+        # if no downhill step was found.
+        _add_projected_force_computation(self, "d")
+        self.addComputeSum("sy", "(x - x_old)*(f_old - fp)")
+        self.beginIfBlock("sy > 0")
+        for i in range(history, 1, -1):
+            self.addComputeGlobal("rho%d" % i, "rho%d" % (i - 1))
+            self.addComputePerDof("s%d" % i, "s%d" % (i - 1))
+            self.addComputePerDof("y%d" % i, "y%d" % (i - 1))
+        self.addComputeGlobal("rho1", "1/sy")
+        self.addComputePerDof("s1", "x - x_old")
+        self.addComputePerDof("y1", "f_old - fp")
+        self.endBlock()
+        self.beginIfBlock("step_length = 0")
+        for i in range(1, history + 1):
+            self.addComputeGlobal("rho%d" % i, "0")
+        self.endBlock()
+
+        self.endBlock()
+
+
+class VelocityVerletIntegrator(mm.CustomIntegrator):
+
+    """Verlocity Verlet integrator.
+
+    Notes
+    -----
+    This integrator is taken verbatim from Peter Eastman's example appearing in the CustomIntegrator header file documentation.
+
+    References
+    ----------
+    W. C. Swope, H. C. Andersen, P. H. Berens, and K. R. Wilson, J. Chem. Phys. 76, 637 (1982)
+
+    Examples
+    --------
+
+    Create a velocity Verlet integrator.
+
+    >>> timestep = 1.0 * simtk.unit.femtoseconds
+    >>> integrator = VelocityVerletIntegrator(timestep)
+
+    """
+
+    def __init__(self, timestep=1.0 * simtk.unit.femtoseconds):
+        """Construct a velocity Verlet integrator.
+
+        Parameters
+        ----------
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1*simtk.unit.femtoseconds
+           The integration timestep.
+
+        """
+
+        super(VelocityVerletIntegrator, self).__init__(timestep)
+
+        self.addPerDofVariable("x1", 0)
+
+        self.addUpdateContextState()
+        self.addComputePerDof("v", "v+0.5*dt*f/m")
+        self.addComputePerDof("x", "x+dt*v")
+        self.addComputePerDof("x1", "x")
+        self.addConstrainPositions()
+        self.addComputePerDof("v", "v+0.5*dt*f/m+(x-x1)/dt")
+        self.addConstrainVelocities()
+
+
+class AndersenVelocityVerletIntegrator(_CollisionRateMixin, mm.CustomIntegrator):
+
+    """Velocity Verlet integrator with Andersen thermostat using per-particle collisions (rather than massive collisions).
+
+    References
+    ----------
+    Hans C. Andersen "Molecular dynamics simulations at constant pressure and/or temperature", Journal of Chemical Physics 72, 2384-2393 (1980)
+    http://dx.doi.org/10.1063/1.439486
+
+    Examples
+    --------
+
+    Create a velocity Verlet integrator with Andersen thermostat.
+
+    >>> timestep = 1.0 * simtk.unit.femtoseconds
+    >>> collision_rate = 91.0 / simtk.unit.picoseconds
+    >>> temperature = 298.0 * simtk.unit.kelvin
+    >>> integrator = AndersenVelocityVerletIntegrator(temperature, collision_rate, timestep)
+
+    Notes
+    ------
+    The velocity Verlet integrator is taken verbatim from Peter Eastman's example in the CustomIntegrator header file documentation.
+
+    """
+
+    def __init__(self, temperature=298 * simtk.unit.kelvin, collision_rate=91.0 / simtk.unit.picoseconds, timestep=1.0 * simtk.unit.femtoseconds):
+        """Construct a velocity Verlet integrator with Andersen thermostat, implemented as per-particle collisions (rather than massive collisions).
+
+        Parameters
+        ----------
+        temperature : numpy.unit.Quantity compatible with kelvin, default=298*simtk.unit.kelvin
+           The temperature of the fictitious bath.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default=91/simtk.unit.picoseconds
+           The collision rate with fictitious bath particles.
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default=1*simtk.unit.femtoseconds
+           The integration timestep.
+
+        """
+        super(AndersenVelocityVerletIntegrator, self).__init__(timestep)
+
+        #
+        # Integrator initialization.
+        #
+        kT = kB * temperature
+        self.addGlobalVariable("kT", kT)  # thermal energy
+        self.addGlobalVariable("collision_rate", collision_rate * simtk.unit.picoseconds)  # in 1/picoseconds
+        self.addGlobalVariable("p_collision", 0)  # per-particle collision probability per timestep (computed later)
+        self.addPerDofVariable("sigma_v", 0)  # velocity distribution stddev for Maxwell-Boltzmann (computed later)
+        self.addPerDofVariable("collision", 0)  # 1 if collision has occured this timestep, 0 otherwise
+        self.addPerDofVariable("x1", 0)  # for constraints
+
+        #
+        # Initialization.
+        #
+        self._begin_initialization()
+        self.addComputePerDof("sigma_v", "sqrt(kT/m)")
+        self._add_timestep_dependent_global("p_collision", "collision_rate*dt")
+        self._end_initialization()
+
+        #
+        # Update velocities from Maxwell-Boltzmann distribution for particles that collide.
+        #
+        self.addComputePerDof("collision", "step(p_collision-uniform)")  # if collision has occured this timestep, 0 otherwise
+        self.addComputePerDof("v", "(1-collision)*v + collision*sigma_v*gaussian")  # randomize velocities of particles that have collided
+
+        #
+        # Velocity Verlet step
+        #
+        self.addUpdateContextState()
+        self.addComputePerDof("v", "v+0.5*dt*f/m")
+        self.addComputePerDof("x", "x+dt*v")
+        self.addComputePerDof("x1", "x")
+        self.addConstrainPositions()
+        self.addComputePerDof("v", "v+0.5*dt*f/m+(x-x1)/dt")
+        self.addConstrainVelocities()
+
+
+class BussiVelocityVerletIntegrator(_CollisionRateMixin, mm.CustomIntegrator):
+
+    """Velocity Verlet integrator with the Bussi-Donadio-Parrinello stochastic velocity rescaling thermostat.
+
+    References
+    ----------
+    Giovanni Bussi, Davide Donadio, and Michele Parrinello "Canonical sampling through velocity rescaling", Journal of Chemical Physics 126, 014101 (2007)
+    http://dx.doi.org/10.1063/1.2408420
+
+    George Marsaglia and Wai Wan Tsang "A simple method for generating gamma variables", ACM Transactions on Mathematical Software 26, 363-372 (2000)
+    http://dx.doi.org/10.1145/358407.358414
+
+    Examples
+    --------
+
+    Create a velocity Verlet integrator with stochastic velocity rescaling.
+
+    >>> timestep = 1.0 * simtk.unit.femtoseconds
+    >>> collision_rate = 10.0 / simtk.unit.picoseconds
+    >>> temperature = 298.0 * simtk.unit.kelvin
+    >>> integrator = BussiVelocityVerletIntegrator(temperature, collision_rate, timestep)
+
+    Notes
+    ------
+    The thermostat rescales all velocities by a common factor, drawn so that the kinetic energy relaxes toward
+    its canonical distribution with a rate 'collision_rate'.  Only a few random numbers are needed per step,
+    instead of one per degree of freedom as in Langevin or Andersen thermostats.
+
+    """
+
+    def __init__(self, temperature=298 * simtk.unit.kelvin, collision_rate=10.0 / simtk.unit.picoseconds, timestep=1.0 * simtk.unit.femtoseconds,
+                 ndof=None, monitor_heat=False):
+        """Construct a velocity Verlet integrator with stochastic velocity rescaling.
+
+        Parameters
+        ----------
+        temperature : numpy.unit.Quantity compatible with kelvin, default=298*simtk.unit.kelvin
+           The temperature of the bath.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default=10/simtk.unit.picoseconds
+           The inverse of the relaxation time of the kinetic energy.
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default=1*simtk.unit.femtoseconds
+           The integration timestep.
+        ndof : int, optional, default=None
+           The number of degrees of freedom, which must be at least 3, for example `count_degrees_of_freedom(system)`.
+           If None, three degrees of freedom are counted for each particle with nonzero mass at the first step.  This
+           is only correct for Systems without constraints, and `step()` raises a ValueError if the System has
+           constraints.  It also ignores a CMMotionRemover, which removes three degrees of freedom.
+        monitor_heat : boolean, default: False
+           Accumulate the heat exchanged with the bath, in the global `heat`.
+
+        Notes
+        -----
+        The velocities are rescaled for half a timestep before and after each velocity Verlet step.  The sum of
+        ndof-1 squared Gaussian variates required by the rescaling factor is drawn exactly as a gamma variate with
+        the method of Marsaglia and Tsang.  The velocities must be initialized to a nonzero kinetic energy.
+
+        """
+        if ndof is not None and ndof < 3:
+            raise ValueError("ndof must be at least 3, not %s" % str(ndof))
+        if ndof is None:
+            self._constraints_error = "%s counts the degrees of freedom only for Systems without constraints; " \
+                                      "specify ndof, for example with count_degrees_of_freedom(system)." % self.__class__.__name__
+
+        super(BussiVelocityVerletIntegrator, self).__init__(timestep)
+
+        #
+        # Integrator initialization.
+        #
+        kT = kB * temperature
+        self.addGlobalVariable("kT", kT)  # thermal energy
+        self.addGlobalVariable("collision_rate", collision_rate * simtk.unit.picoseconds)  # in 1/picoseconds
+        self.addGlobalVariable("ndof", 0 if ndof is None else ndof)  # number of degrees of freedom
+        self.addGlobalVariable("c", 0)  # kinetic energy memory over half a timestep
+        self.addGlobalVariable("kinetic_energy", 0)
+        self.addGlobalVariable("alpha", 0)  # velocity scaling factor
+        self.addGlobalVariable("R1", 0)  # Gaussian variate
+        self.addGlobalVariable("chisq", 0)  # sum of ndof-1 squared Gaussian variates
+        self.addGlobalVariable("gamma_d", 0)  # parameters and state of the gamma variate generator
+        self.addGlobalVariable("gamma_c", 0)
+        self.addGlobalVariable("gamma_x", 0)
+        self.addGlobalVariable("gamma_v", 0)
+        self.addGlobalVariable("gamma_accept", 0)
+        if monitor_heat:
+            self.addGlobalVariable("heat", 0)
+        self.addGlobalVariable("has_constraints", 0)  # 1 if ndof is counted and the System has constraints
+        self.addPerDofVariable("x1", 0)  # for constraints
+
+        #
+        # Initialization.
+        #
+        self._begin_initialization()
+        if ndof is None:
+            self.addComputeSum("ndof", "select(m, 1, 0)")
+            self.addComputePerDof("x1", "v")
+            _add_constraint_detection(self)
+            self.addComputePerDof("v", "x1")
+        self._add_timestep_dependent_global("c", "exp(-collision_rate*dt/2)")
+        self.addComputeGlobal("gamma_d", "(ndof-1)/2 - 1/3")
+        self.addComputeGlobal("gamma_c", "1/sqrt(9*gamma_d)")
+        self._end_initialization()
+
+        #
+        # Velocity Verlet step between half-step velocity rescalings.
+        #
         self.addUpdateContextState()
+        self.beginIfBlock("has_constraints = 0")
+        self._add_rescaling_step(monitor_heat)
         self.addComputePerDof("v", "v+0.5*dt*f/m")
         self.addComputePerDof("x", "x+dt*v")
         self.addComputePerDof("x1", "x")
         self.addConstrainPositions()
         self.addComputePerDof("v", "v+0.5*dt*f/m+(x-x1)/dt")
         self.addConstrainVelocities()
+        self._add_rescaling_step(monitor_heat)
+        self.endBlock()
+
+    def _add_rescaling_step(self, monitor_heat):
+        """Rescale the velocities over half a timestep."""
+        self.addComputeSum("kinetic_energy", "0.5*m*v*v")
+        self.addComputeGlobal("R1", "gaussian")
+
+        # Draw chisq = 2*Gamma((ndof-1)/2) with the Marsaglia-Tsang rejection method.
+        self.addComputeGlobal("gamma_accept", "0")
+        self.beginWhileBlock("gamma_accept = 0")
+        self.addComputeGlobal("gamma_x", "gaussian")
+        self.addComputeGlobal("gamma_v", "(1 + gamma_c*gamma_x)^3")
+        self.addComputeGlobal("gamma_accept", "step(gamma_v) * step(0.5*gamma_x^2 + gamma_d - gamma_d*gamma_v + gamma_d*log(gamma_v) - log(uniform))")
+        self.endBlock()
+        self.addComputeGlobal("chisq", "2*gamma_d*gamma_v")
+
+        # The sign of the scaling factor is chosen as in Bussi et al. to make the rescaling time-reversible.
+        self.addComputeGlobal("alpha", "select(kinetic_energy, sign*sqrt(alpha2), 0);"
+                                       "alpha2 = c + (1-c)*ratio*(R1^2 + chisq) + 2*R1*sqrt(c*(1-c)*ratio);"
+                                       "sign = 2*step(R1 + sqrt(c/((1-c)*ratio))) - 1;"
+                                       "ratio = kT/(2*kinetic_energy)")
+        self.addComputePerDof("v", "alpha*v")
+        if monitor_heat:
+            self.addComputeGlobal("heat", "heat + (alpha^2 - 1)*kinetic_energy")
+
+
+class NoseHooverChainVelocityVerletIntegrator(_ThermostatedMixin, mm.CustomIntegrator):
+
+    """Velocity Verlet integrator with a Nose-Hoover chain thermostat.
+
+    References
+    ----------
+    Glenn J. Martyna, Mark E. Tuckerman, Douglas J. Tobias, and Michael L. Klein "Explicit reversible integrators for extended systems dynamics", Molecular Physics 87, 1117-1157 (1996)
+    http://dx.doi.org/10.1080/00268979600100761
 
+    Examples
+    --------
+
+    Create a velocity Verlet integrator with a Nose-Hoover chain of four thermostats, propagated with a fifth-order
+    Suzuki-Yoshida factorization.
+
+    >>> timestep = 1.0 * simtk.unit.femtoseconds
+    >>> temperature = 298.0 * simtk.unit.kelvin
+    >>> integrator = NoseHooverChainVelocityVerletIntegrator(temperature, timestep, chain_length=4, yoshida_order=5)
+
+    Notes
+    ------
+    The thermostat is deterministic, so that trajectories are reproducible and dynamical properties are not
+    perturbed by random collisions.
+
+    """
+
+    # Suzuki-Yoshida weights of each order.
+    _YOSHIDA_WEIGHTS = {
+        1: [1.0],
+        3: [1.0 / (2.0 - 2.0**(1.0/3.0)), 1.0 - 2.0 / (2.0 - 2.0**(1.0/3.0)), 1.0 / (2.0 - 2.0**(1.0/3.0))],
+        5: [1.0 / (4.0 - 4.0**(1.0/3.0))] * 2 + [1.0 - 4.0 / (4.0 - 4.0**(1.0/3.0))] + [1.0 / (4.0 - 4.0**(1.0/3.0))] * 2,
+        7: [0.784513610477560, 0.235573213359357, -1.17767998417887,
+            1.0 - 2.0 * (0.784513610477560 + 0.235573213359357 - 1.17767998417887),
+            -1.17767998417887, 0.235573213359357, 0.784513610477560],
+    }
+
+    def __init__(self, temperature=298 * simtk.unit.kelvin, timestep=1.0 * simtk.unit.femtoseconds, chain_length=3,
+                 thermostat_timescale=0.1 * simtk.unit.picoseconds, yoshida_order=3, thermostat_substeps=1, ndof=None):
+        """Construct a velocity Verlet integrator with a Nose-Hoover chain thermostat.
+
+        Parameters
+        ----------
+        temperature : numpy.unit.Quantity compatible with kelvin, default=298*simtk.unit.kelvin
+           The temperature of the thermostat.
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default=1*simtk.unit.femtoseconds
+           The integration timestep.
+        chain_length : int, default=3
+           The number of thermostats in the chain.
+        thermostat_timescale : numpy.unit.Quantity compatible with picoseconds, default=0.1*simtk.unit.picoseconds
+           The period of the thermostat oscillations, which sets the thermostat masses.
+        yoshida_order : int, default=3
+           The order of the Suzuki-Yoshida factorization of the thermostat propagator, one of 1, 3, 5, or 7.
+        thermostat_substeps : int, default=1
+           The number of times the factorized thermostat propagator is applied in each half timestep.
+        ndof : int, optional, default=None
+           The number of degrees of freedom, for example `count_degrees_of_freedom(system)`.  If None, three degrees
+           of freedom are counted for each particle with nonzero mass at the first step.  This is only correct for
+           Systems without constraints, and `step()` raises a ValueError if the System has constraints.  It also
+           ignores a CMMotionRemover, which removes three degrees of freedom.
+
+        Notes
+        -----
+        The positions and velocities of the thermostats are the global variables 'xi1', 'vxi1', ... where thermostat 1
+        is coupled to the particles.  The thermostat masses are ndof*kT*tau^2 for the first thermostat and kT*tau^2 for
+        the others.  The global variable 'thermostat_energy' holds the kinetic and potential energy of the chain, so
+        that the sum of the total energy of the system and the thermostat energy is conserved.
+
+        """
+        if chain_length < 1:
+            raise ValueError("chain_length must be at least 1, not %s" % str(chain_length))
+        if yoshida_order not in self._YOSHIDA_WEIGHTS:
+            raise ValueError("yoshida_order must be one of %s, not %s" % (sorted(self._YOSHIDA_WEIGHTS), str(yoshida_order)))
+        self._chain_length = chain_length
+        if ndof is None:
+            self._constraints_error = "%s counts the degrees of freedom only for Systems without constraints; " \
+                                      "specify ndof, for example with count_degrees_of_freedom(system)." % self.__class__.__name__
+
+        super(NoseHooverChainVelocityVerletIntegrator, self).__init__(timestep)
+
+        #
+        # Integrator initialization.
+        #
+        kT = kB * temperature
+        self.addGlobalVariable("kT", kT)  # thermal energy
+        self.addGlobalVariable("tau", thermostat_timescale / simtk.unit.picoseconds)  # thermostat timescale
+        self.addGlobalVariable("ndof", 0 if ndof is None else ndof)  # number of degrees of freedom
+        for j in range(1, chain_length + 1):
+            self.addGlobalVariable("xi%d" % j, 0)  # thermostat position
+            self.addGlobalVariable("vxi%d" % j, 0)  # thermostat velocity
+            self.addGlobalVariable("Q%d" % j, 0)  # thermostat mass
+        self.addGlobalVariable("G", 0)  # thermostat force
+        self.addGlobalVariable("kinetic_energy", 0)
+        self.addGlobalVariable("scale", 0)  # accumulated velocity scaling factor
+        self.addGlobalVariable("thermostat_energy", 0)
+        self.addGlobalVariable("has_constraints", 0)  # 1 if ndof is counted and the System has constraints
+        self.addPerDofVariable("x1", 0)  # for constraints
 
-class MetropolisMonteCarloIntegrator(mm.CustomIntegrator):
+        #
+        # Initialization.
+        #
+        self._begin_initialization()
+        if ndof is None:
+            self.addComputeSum("ndof", "select(m, 1, 0)")
+            self.addComputePerDof("x1", "v")
+            _add_constraint_detection(self)
+            self.addComputePerDof("v", "x1")
+        self.addComputeGlobal("Q1", "ndof*kT*tau^2")
+        for j in range(2, chain_length + 1):
+            self.addComputeGlobal("Q%d" % j, "kT*tau^2")
+        self._end_initialization()
+
+        #
+        # Velocity Verlet step between half-step thermostat propagations.
+        #
+        self.addUpdateContextState()
+        self.beginIfBlock("has_constraints = 0")
+        self._add_thermostat_half_step(yoshida_order, thermostat_substeps)
+        self.addComputePerDof("v", "v+0.5*dt*f/m")
+        self.addComputePerDof("x", "x+dt*v")
+        self.addComputePerDof("x1", "x")
+        self.addConstrainPositions()
+        self.addComputePerDof("v", "v+0.5*dt*f/m+(x-x1)/dt")
+        self.addConstrainVelocities()
+        self._add_thermostat_half_step(yoshida_order, thermostat_substeps)
+        self.endBlock()
+
+        # Energy of the chain.
+        M = chain_length
+        expression = " + ".join(["0.5*Q%d*vxi%d^2" % (j, j) for j in range(1, M + 1)])
+        expression += " + ndof*kT*xi1"
+        if M > 1:
+            expression += " + kT*(" + " + ".join(["xi%d" % j for j in range(2, M + 1)]) + ")"
+        self.addComputeGlobal("thermostat_energy", expression)
+
+    def _add_thermostat_force(self, j):
+        """Compute the force on thermostat j in the global 'G'."""
+        if j == 1:
+            self.addComputeGlobal("G", "(2*kinetic_energy - ndof*kT)/Q1")
+        else:
+            self.addComputeGlobal("G", "(Q{0}*vxi{0}^2 - kT)/Q{1}".format(j - 1, j))
+
+    def _add_thermostat_velocity_update(self, j, stepsize):
+        """Update the velocity of thermostat j over a quarter of 'stepsize', damped by thermostat j+1."""
+        if j == self._chain_length:
+            self.addComputeGlobal("vxi%d" % j, "vxi%d + %s/4*G" % (j, stepsize))
+        else:
+            self.addComputeGlobal("vxi%d" % j, "(vxi{0}*damping + {1}/4*G)*damping; damping = exp(-{1}/8*vxi{2})".format(j, stepsize, j + 1))
+
+    def _add_thermostat_half_step(self, yoshida_order, thermostat_substeps):
+        """Propagate the thermostat chain and rescale the velocities over half a timestep."""
+        M = self._chain_length
+        self.addComputeSum("kinetic_energy", "0.5*m*v*v")
+        self.addComputeGlobal("scale", "1")
+        for substep in range(thermostat_substeps):
+            for weight in self._YOSHIDA_WEIGHTS[yoshida_order]:
+                stepsize = "(%r*dt)" % (weight / thermostat_substeps)
+                # Update the thermostat velocities from the end of the chain.
+                for j in range(M, 0, -1):
+                    self._add_thermostat_force(j)
+                    self._add_thermostat_velocity_update(j, stepsize)
+                # Scale the particle velocities and update the thermostat positions.
+                self.addComputeGlobal("scale", "scale*exp(-%s/2*vxi1)" % stepsize)
+                self.addComputeGlobal("kinetic_energy", "kinetic_energy*exp(-%s*vxi1)" % stepsize)
+                for j in range(1, M + 1):
+                    self.addComputeGlobal("xi%d" % j, "xi%d + %s/2*vxi%d" % (j, stepsize, j))
+                # Update the thermostat velocities from the start of the chain.
+                for j in range(1, M + 1):
+                    self._add_thermostat_force(j)
+                    self._add_thermostat_velocity_update(j, stepsize)
+        self.addComputePerDof("v", "scale*v")
+
+
+class MetropolisMonteCarloIntegrator(_ThermostatedMixin, mm.CustomIntegrator):
 
     """
     Metropolis Monte Carlo with Gaussian displacement trials.
 
     """
 
-    def __init__(self, temperature=298.0 * simtk.unit.kelvin, sigma=0.1 * simtk.unit.angstroms, timestep=1 * simtk.unit.femtoseconds):
+    def __init__(self, temperature=298.0 * simtk.unit.kelvin, sigma=0.1 * simtk.unit.angstroms, timestep=1 * simtk.unit.femtoseconds,
+                 molecules=None, groups=None):
         """
         Create a simple Metropolis Monte Carlo integrator that uses Gaussian displacement trials.
 
@@ -319,10 +1329,22 @@ class MetropolisMonteCarloIntegrator(mm.CustomIntegrator):
            The displacement standard deviation for each degree of freedom.
         timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1.0*simtk.unit.femtoseconds
            The integration timestep, which is purely fictitious---it is just used to advance the simulation clock.
+        molecules : list of list of int, optional, default: None
+           If specified, each trial translates a single randomly chosen group of particles rigidly by a Gaussian
+           displacement, instead of displacing all degrees of freedom independently.  The groups must partition
+           the particles of the System, e.g. one group per molecule, or one group per particle for single-particle moves.
+           Negative, repeated or missing particle indices raise a ValueError.  The number of particles of the System
+           is not known at construction, so the caller must ensure that all indices are smaller than
+           system.getNumParticles().
+        groups : iterable of int, optional, default: None
+           If specified, only the energies of these force groups are used in the acceptance criterion.  Force groups
+           whose energy cannot change during a trial, such as restraints between particles that are never moved,
+           can be left out.
 
         Warning
         -------
-        This integrator does not respect constraints.
+        This integrator does not respect constraints, unless 'molecules' is specified and no constraint connects
+        particles in different groups.
 
         Notes
         -----
@@ -330,6 +1352,12 @@ class MetropolisMonteCarloIntegrator(mm.CustomIntegrator):
         Velocities are drawn from a Maxwell-Boltzmann distribution each timestep to generate correct (x,v) statistics.
         Additional global variables 'ntrials' and  'naccept' keep track of how many trials have been attempted and accepted, respectively.
 
+        Displacing all degrees of freedom at once makes the energy change extensive, so that the acceptance rate
+        vanishes as the system grows unless 'sigma' is made very small.  Moving a single molecule per trial keeps
+        the energy change, and hence the acceptance rate, independent of the system size.  The per-DOF variable
+        'molecule' holds the index of the group each particle belongs to, and the global variable 'selected' the
+        index of the group moved in the last trial.
+
         Examples
         --------
 
@@ -340,6 +1368,13 @@ class MetropolisMonteCarloIntegrator(mm.CustomIntegrator):
         >>> sigma = 1.0 * simtk.unit.angstroms
         >>> integrator = MetropolisMonteCarloIntegrator(temperature, sigma, timestep)
 
+        Create a Metropolis Monte Carlo integrator that translates one water molecule per trial.
+
+        >>> from openmmtools import testsystems
+        >>> waterbox = testsystems.WaterBox(box_edge=2.0*simtk.unit.nanometers)
+        >>> molecules = [[atom.index for atom in residue.atoms()] for residue in waterbox.topology.residues()]
+        >>> integrator = MetropolisMonteCarloIntegrator(temperature, sigma, timestep, molecules=molecules)
+
         """
 
         # Create a new Custom integrator.
@@ -361,6 +1396,42 @@ class MetropolisMonteCarloIntegrator(mm.CustomIntegrator):
         self.addGlobalVariable("Eold", 0)  # old energy
         self.addGlobalVariable("Enew", 0)  # new energy
         self.addGlobalVariable("accept", 0)  # accept or reject
+        if molecules is not None:
+            # Check that the groups are disjoint sets of valid particle indices that cover all the particles.
+            molecule_of = dict()
+            for index, molecule in enumerate(molecules):
+                for particle in molecule:
+                    if int(particle) != particle or particle < 0:
+                        raise ValueError("molecules contain the invalid particle index {}".format(particle))
+                    if particle in molecule_of:
+                        raise ValueError("particle {} is in both molecules {} and {}".format(
+                            particle, molecule_of[particle], index))
+                    molecule_of[int(particle)] = index
+            missing = sorted(set(range(len(molecule_of))) - set(molecule_of))
+            if len(missing) > 0:
+                raise ValueError("molecules must partition the particles 0 to N-1, but particle {} "
+                                 "is in none of them".format(missing[0]))
+            molecule_indices = [molecule_of[particle] for particle in range(len(molecule_of))]
+            self.addGlobalVariable("nmolecules", len(molecules))  # number of groups that can be moved
+            self.addGlobalVariable("selected", 0)  # index of the group moved in this trial
+            self.addGlobalVariable("gx", 0)  # displacement of the moved group in units of sigma_x
+            self.addGlobalVariable("gy", 0)
+            self.addGlobalVariable("gz", 0)
+            self.addPerDofVariable("molecule", 0)  # index of the group of each particle
+            self.setPerDofVariableByName("molecule", [mm.Vec3(index, index, index) for index in molecule_indices])
+
+        # Energy used in the acceptance criterion.
+        if groups is None:
+            energy = "energy"
+        else:
+            energy = "(" + " + ".join("energy%d" % group for group in sorted(set(groups))) + ")"
+
+        #
+        # Initialization.
+        #
+        self._begin_initialization()
+        self.addComputePerDof("sigma_v", "sqrt(kT/m)")
+        self._end_initialization()
 
         #
         # Context state update.
@@ -370,7 +1441,6 @@ class MetropolisMonteCarloIntegrator(mm.CustomIntegrator):
         #
         # Update velocities from Maxwell-Boltzmann distribution.
         #
-        self.addComputePerDof("sigma_v", "sqrt(kT/m)")
         self.addComputePerDof("v", "sigma_v*gaussian")
         self.addConstrainVelocities()
 
@@ -379,25 +1449,34 @@ class MetropolisMonteCarloIntegrator(mm.CustomIntegrator):
         #
         # Store old positions and energy.
         self.addComputePerDof("xold", "x")
-        self.addComputeGlobal("Eold", "energy")
-        # Gaussian particle displacements.
-        self.addComputePerDof("x", "x + sigma_x*gaussian")
+        self.addComputeGlobal("Eold", energy)
+        if molecules is None:
+            # Gaussian particle displacements.
+            self.addComputePerDof("x", "x + sigma_x*gaussian")
+        else:
+            # Gaussian rigid translation of a randomly chosen group.
+            self.addComputeGlobal("selected", "floor(uniform*nmolecules)")
+            for component in ["gx", "gy", "gz"]:
+                self.addComputeGlobal(component, "gaussian")
+            self.addComputePerDof("x", "x + sigma_x*select(delta(molecule-selected), vector(gx, gy, gz), 0)")
         # Accept or reject with Metropolis criteria.
-        self.addComputeGlobal("accept", "step(exp(-(energy-Eold)/kT) - uniform)")
+        self.addComputeGlobal("Enew", energy)
+        self.addComputeGlobal("accept", "step(exp(-(Enew-Eold)/kT) - uniform)")
         self.addComputePerDof("x", "(1-accept)*xold + x*accept")
         # Accumulate acceptance statistics.
         self.addComputeGlobal("naccept", "naccept + accept")
         self.addComputeGlobal("ntrials", "ntrials + 1")
 
 
-class HMCIntegrator(mm.CustomIntegrator):
+class HMCIntegrator(_ThermostatedMixin, mm.CustomIntegrator):
 
     """
     Hybrid Monte Carlo (HMC) integrator.
 
     """
 
-    def __init__(self, temperature=298.0 * simtk.unit.kelvin, nsteps=10, timestep=1 * simtk.unit.femtoseconds):
+    def __init__(self, temperature=298.0 * simtk.unit.kelvin, nsteps=10, timestep=1 * simtk.unit.femtoseconds, lean=False,
+                 target_acceptance_rate=None, adaptation_trials=100):
         """
         Create a hybrid Monte Carlo (HMC) integrator.
 
@@ -409,6 +1488,16 @@ class HMCIntegrator(mm.CustomIntegrator):
            The number of velocity Verlet steps to take per HMC trial.
         timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1*simtk.unit.femtoseconds
            The integration timestep.
+        lean : bool, default: False
+           If True, only the per-DOF variable 'xold' is allocated: the velocity standard deviations are computed
+           when needed, and the velocities are used as scratch storage when applying position constraints.  The
+           velocities are then recomputed from two positions, which loses precision in single precision, so this is
+           only done if the System has constraints, which is detected at the first step.
+        target_acceptance_rate : float, optional, default: None
+           If specified, the timestep is adapted during the first 'adaptation_trials' trials so that the average
+           acceptance probability approaches this value, and then frozen.  'timestep' is the initial guess.
+        adaptation_trials : int, default: 100
+           The number of trials during which the timestep is adapted, if 'target_acceptance_rate' is specified.
 
         Warning
         -------
@@ -422,6 +1511,17 @@ class HMCIntegrator(mm.CustomIntegrator):
         Additional global variables 'ntrials' and  'naccept' keep track of how many trials have been attempted and
         accepted, respectively.
 
+        The timestep is adapted with the dual averaging scheme of Hoffman and Gelman [1], which drives the running
+        average of the acceptance probability toward 'target_acceptance_rate' while the log timestep is averaged
+        with decreasing weights.  At the end of the warm-up, the averaged timestep is used for all subsequent trials,
+        so that production sampling satisfies detailed balance.  The global variable 'nadapt' counts the adaptation
+        trials performed so far, and the adaptation can be restarted with `resetAdaptation()`.
+
+        References
+        ----------
+        [1] Hoffman MD and Gelman A. The No-U-Turn sampler: Adaptively setting path lengths in Hamiltonian Monte Carlo.
+        JMLR 15:1593, 2014.
+
         TODO
         ----
         Currently, the simulation timestep is only advanced by 'timestep' each step, rather than timestep*nsteps.  Fix this.
@@ -436,9 +1536,17 @@ class HMCIntegrator(mm.CustomIntegrator):
         >>> nsteps = 10 # number of steps per call
         >>> integrator = HMCIntegrator(temperature, nsteps, timestep)
 
-        """
+        Create an HMC integrator that tunes its timestep for an acceptance rate of 0.65 over the first 200 trials.
 
-        super(HMCIntegrator, self).__init__(timestep)
+        >>> integrator = HMCIntegrator(temperature, nsteps, timestep, target_acceptance_rate=0.65, adaptation_trials=200)
+
+        """
+
+        if target_acceptance_rate is not None and not 0.0 < target_acceptance_rate < 1.0:
+            raise ValueError("target_acceptance_rate must be between 0 and 1, not %s" % str(target_acceptance_rate))
+        self._adaptive = target_acceptance_rate is not None
+
+        super(HMCIntegrator, self).__init__(timestep)
 
         # Compute the thermal energy.
         kT = kB * temperature
@@ -450,20 +1558,37 @@ class HMCIntegrator(mm.CustomIntegrator):
         self.addGlobalVariable("ntrials", 0)  # number of Metropolization trials
 
         self.addGlobalVariable("kT", kT)  # thermal energy
-        self.addPerDofVariable("sigma", 0)
+        if not lean:
+            self.addPerDofVariable("sigma", 0)
         self.addGlobalVariable("ke", 0)  # kinetic energy
         self.addPerDofVariable("xold", 0)  # old positions
         self.addGlobalVariable("Eold", 0)  # old energy
         self.addGlobalVariable("Enew", 0)  # new energy
         self.addGlobalVariable("accept", 0)  # accept or reject
-        self.addPerDofVariable("x1", 0)  # for constraints
+        if not lean:
+            self.addPerDofVariable("x1", 0)  # for constraints
+        else:
+            self.addGlobalVariable("has_constraints", 1)  # 1 if the System has constraints
+        if target_acceptance_rate is not None:
+            self.addGlobalVariable("target_acceptance_rate", target_acceptance_rate)
+            self.addGlobalVariable("adaptation_trials", adaptation_trials)
+            self.addGlobalVariable("nadapt", 0)  # number of adaptation trials performed
+            self.addGlobalVariable("acceptance_probability", 0)  # Metropolis acceptance probability of the last trial
+            self.addGlobalVariable("mu", 0)  # log timestep toward which the adaptation is shrunk
+            self.addGlobalVariable("Hbar", 0)  # running average of target minus actual acceptance probability
+            self.addGlobalVariable("log_dt", 0)  # current log timestep
+            self.addGlobalVariable("log_dt_bar", 0)  # weighted average of the log timestep
 
         #
-        # Pre-computation.
-        # This only needs to be done once, but it needs to be done for each degree of freedom.
-        # Could move this to initialization?
+        # Initialization.
         #
-        self.addComputePerDof("sigma", "sqrt(kT/m)")
+        self._begin_initialization()
+        if lean:
+            # The velocities are drawn right after, so they need not be saved.
+            _add_constraint_detection(self)
+        else:
+            self.addComputePerDof("sigma", "sqrt(kT/m)")
+        self._end_initialization()
 
         #
         # Allow Context updating here, outside of inner loop only.
@@ -473,7 +1598,10 @@ class HMCIntegrator(mm.CustomIntegrator):
         #
         # Draw new velocity.
         #
-        self.addComputePerDof("v", "sigma*gaussian")
+        if lean:
+            self.addComputePerDof("v", "sqrt(kT/m)*gaussian")
+        else:
+            self.addComputePerDof("v", "sigma*gaussian")
         self.addConstrainVelocities()
 
         #
@@ -489,9 +1617,18 @@ class HMCIntegrator(mm.CustomIntegrator):
         for step in range(nsteps):
             self.addComputePerDof("v", "v+0.5*dt*f/m")
             self.addComputePerDof("x", "x+dt*v")
-            self.addComputePerDof("x1", "x")
-            self.addConstrainPositions()
-            self.addComputePerDof("v", "v+0.5*dt*f/m+(x-x1)/dt")
+            if lean:
+                # Store the old positions in v, so that v becomes (x-xold)/dt after constraining x.
+                self.beginIfBlock("has_constraints = 1")
+                self.addComputePerDof("v", "x-dt*v")
+                self.addConstrainPositions()
+                self.addComputePerDof("v", "(x-v)/dt")
+                self.endBlock()
+                self.addComputePerDof("v", "v+0.5*dt*f/m")
+            else:
+                self.addComputePerDof("x1", "x")
+                self.addConstrainPositions()
+                self.addComputePerDof("v", "v+0.5*dt*f/m+(x-x1)/dt")
             self.addConstrainVelocities()
 
         #
@@ -508,6 +1645,56 @@ class HMCIntegrator(mm.CustomIntegrator):
         self.addComputeGlobal("naccept", "naccept + accept")
         self.addComputeGlobal("ntrials", "ntrials + 1")
 
+        #
+        # Timestep adaptation.
+        #
+        if target_acceptance_rate is not None:
+            self._add_dual_averaging_step()
+
+    def _add_dual_averaging_step(self, gamma=0.05, t0=10.0, kappa=0.75):
+        """
+        Add one dual averaging update of the timestep, which freezes the timestep at the end of the warm-up.
+
+        Parameters
+        ----------
+        gamma : float, default: 0.05
+           Controls the amount of shrinkage toward 'mu'.
+        t0 : float, default: 10.0
+           Stabilizes the initial iterations.
+        kappa : float, default: 0.75
+           Exponent of the decreasing weights of the averaged log timestep.
+
+        """
+        self.beginIfBlock("nadapt < adaptation_trials")
+        self.beginIfBlock("nadapt = 0")
+        self.addComputeGlobal("mu", "log(10*dt)")
+        self.endBlock()
+        # The acceptance probability is zero for NaN energies.
+        self.addComputeGlobal("acceptance_probability", "select(step(p), min(1, p), 0); p = exp(-(Enew-Eold)/kT)")
+        self.addComputeGlobal("nadapt", "nadapt + 1")
+        self.addComputeGlobal("Hbar", "(1 - 1/(nadapt+%r))*Hbar + (target_acceptance_rate - acceptance_probability)/(nadapt+%r)" % (t0, t0))
+        self.addComputeGlobal("log_dt", "mu - sqrt(nadapt)/%r*Hbar" % gamma)
+        self.addComputeGlobal("log_dt_bar", "eta*log_dt + (1-eta)*log_dt_bar; eta = nadapt^(-%r)" % kappa)
+        self.addComputeGlobal("dt", "exp(select(step(nadapt - adaptation_trials), log_dt_bar, log_dt))")
+        self.endBlock()
+
+    def resetAdaptation(self):
+        """
+        Restart the timestep adaptation from the current timestep.
+
+        Raises
+        ------
+        ValueError
+            If the integrator was created without 'target_acceptance_rate', so that the timestep is not adapted.
+
+        """
+        if not self._adaptive:
+            raise ValueError("The timestep is not adapted; create the HMCIntegrator with a target_acceptance_rate "
+                             "to use resetAdaptation()")
+        self.setGlobalVariableByName("nadapt", 0)
+        self.setGlobalVariableByName("Hbar", 0)
+        self.setGlobalVariableByName("log_dt_bar", 0)
+
     @property
     def n_accept(self):
         """The number of accepted HMC moves."""
@@ -523,14 +1710,15 @@ class HMCIntegrator(mm.CustomIntegrator):
         """The acceptance rate: n_accept  / n_trials."""
         return self.n_accept / float(self.n_trials)
 
-class GHMCIntegrator(mm.CustomIntegrator):
+class GHMCIntegrator(_CollisionRateMixin, mm.CustomIntegrator):
 
     """
     Generalized hybrid Monte Carlo (GHMC) integrator.
 
     """
 
-    def __init__(self, temperature=298.0 * simtk.unit.kelvin, collision_rate=91.0 / simtk.unit.picoseconds, timestep=1.0 * simtk.unit.femtoseconds):
+    def __init__(self, temperature=298.0 * simtk.unit.kelvin, collision_rate=91.0 / simtk.unit.picoseconds, timestep=1.0 * simtk.unit.femtoseconds,
+                 nsteps=1, partial_momentum_refresh=None, lean=False):
         """
         Create a generalized hybrid Monte Carlo (GHMC) integrator.
 
@@ -542,18 +1730,35 @@ class GHMCIntegrator(mm.CustomIntegrator):
            The collision rate.
         timestep : simtk.unit.Quantity compatible with femtoseconds, default: 1.0*unit.femtoseconds
            The integration timestep.
+        nsteps : int, default: 1
+           The number of velocity Verlet steps to take per Metropolization trial.
+        partial_momentum_refresh : float, optional, default: None
+           The fraction of the kinetic energy that is randomized before and after each trial, between 0 (no
+           randomization, as in molecular dynamics) and 1 (full randomization, as in HMC).  If None, the fraction
+           1 - exp(-collision_rate * nsteps * timestep) is used.
+        lean : bool, default: False
+           If True, only the per-DOF variables 'xold' and 'vold' are allocated: the velocity standard deviations are
+           computed when needed, and the velocities are used as scratch storage when applying position constraints.
+           The velocities are then recomputed from two positions, which loses precision in single precision, so this
+           is only done if the System has constraints, which is detected at the first step.
+
+        Warning
+        -------
+        Because 'nsteps' sets the number of steps taken, a call to integrator.step(1) actually takes 'nsteps' steps.
 
         Notes
         -----
         This integrator is equivalent to a Langevin integrator in the velocity Verlet discretization with a
         Metrpolization step to ensure sampling from the appropriate distribution.
 
+        With nsteps > 1, the cost of the kinetic energy reductions, energy evaluation and storage of the old
+        state needed for Metropolization is amortized over several force evaluations, while sampling remains exact.
+
         Additional global variables 'ntrials' and  'naccept' keep track of how many trials have been attempted and
         accepted, respectively.
 
         TODO
         ----
-        * Move initialization of 'sigma' to setting the per-particle variables.
         * Generalize to use MTS inner integrator.
 
         Examples
@@ -575,7 +1780,8 @@ class GHMCIntegrator(mm.CustomIntegrator):
 
         # Initialize constants.
         kT = kB * temperature
-        gamma = collision_rate
+        if partial_momentum_refresh is not None and not 0.0 <= partial_momentum_refresh <= 1.0:
+            raise ValueError("partial_momentum_refresh must be between 0 and 1, not %s" % str(partial_momentum_refresh))
 
         # Create a new custom integrator.
         super(GHMCIntegrator, self).__init__(timestep)
@@ -584,8 +1790,10 @@ class GHMCIntegrator(mm.CustomIntegrator):
         # Integrator initialization.
         #
         self.addGlobalVariable("kT", kT)  # thermal energy
-        self.addGlobalVariable("b", numpy.exp(-gamma * timestep))  # velocity mixing parameter
-        self.addPerDofVariable("sigma", 0) # velocity standard deviation
+        self.addGlobalVariable("collision_rate", collision_rate * simtk.unit.picoseconds)  # in 1/picoseconds
+        self.addGlobalVariable("b", 0)  # velocity mixing parameter
+        if not lean:
+            self.addPerDofVariable("sigma", 0) # velocity standard deviation
         self.addGlobalVariable("ke", 0)  # kinetic energy
         self.addPerDofVariable("vold", 0)  # old velocities
         self.addPerDofVariable("xold", 0)  # old positions
@@ -596,16 +1804,30 @@ class GHMCIntegrator(mm.CustomIntegrator):
         self.addGlobalVariable("accept", 0)  # accept or reject
         self.addGlobalVariable("naccept", 0)  # number accepted
         self.addGlobalVariable("ntrials", 0)  # number of Metropolization trials
-        self.addPerDofVariable("x1", 0)  # position before application of constraints
+        if not lean:
+            self.addPerDofVariable("x1", 0)  # position before application of constraints
+        else:
+            self.addGlobalVariable("has_constraints", 1)  # 1 if the System has constraints
+        sigma = "sqrt(kT/m)" if lean else "sigma"
 
         #
         # Initialization.
         #
-        self.beginIfBlock("ntrials = 0")
-        self.addComputePerDof("sigma", "sqrt(kT/m)")
+        self._begin_initialization()
+        if not lean:
+            self.addComputePerDof("sigma", "sqrt(kT/m)")
+        if partial_momentum_refresh is None:
+            self._add_timestep_dependent_global("b", "exp(-collision_rate*%d*dt)" % nsteps)
+        else:
+            self.addComputeGlobal("b", str(1.0 - partial_momentum_refresh))
+        if lean:
+            # Detect constraints with the velocities saved in vold.
+            self.addComputePerDof("vold", "v")
+            _add_constraint_detection(self)
+            self.addComputePerDof("v", "vold")
         self.addConstrainPositions()
         self.addConstrainVelocities()
-        self.endBlock()
+        self._end_initialization()
 
         #
         # Allow context updating here.
@@ -615,7 +1837,7 @@ class GHMCIntegrator(mm.CustomIntegrator):
         #
         # Velocity randomization
         #
-        self.addComputePerDof("v", "sqrt(b)*v + sqrt(1-b)*sigma*gaussian")
+        self.addComputePerDof("v", "sqrt(b)*v + sqrt(1-b)*%s*gaussian" % sigma)
         self.addConstrainVelocities()
 
         # Compute initial total energy
@@ -624,13 +1846,23 @@ class GHMCIntegrator(mm.CustomIntegrator):
         self.addComputeGlobal("Eold", "ke + potential_old")
         self.addComputePerDof("xold", "x")
         self.addComputePerDof("vold", "v")
-        # Velocity Verlet step
-        self.addComputePerDof("v", "v + 0.5*dt*f/m")
-        self.addComputePerDof("x", "x + v*dt")
-        self.addComputePerDof("x1", "x")
-        self.addConstrainPositions()
-        self.addComputePerDof("v", "v + 0.5*dt*f/m + (x-x1)/dt")
-        self.addConstrainVelocities()
+        # Velocity Verlet steps
+        for step in range(nsteps):
+            self.addComputePerDof("v", "v + 0.5*dt*f/m")
+            self.addComputePerDof("x", "x + v*dt")
+            if lean:
+                # Store the old positions in v, so that v becomes (x-xold)/dt after constraining x.
+                self.beginIfBlock("has_constraints = 1")
+                self.addComputePerDof("v", "x - v*dt")
+                self.addConstrainPositions()
+                self.addComputePerDof("v", "(x-v)/dt")
+                self.endBlock()
+                self.addComputePerDof("v", "v + 0.5*dt*f/m")
+            else:
+                self.addComputePerDof("x1", "x")
+                self.addConstrainPositions()
+                self.addComputePerDof("v", "v + 0.5*dt*f/m + (x-x1)/dt")
+            self.addConstrainVelocities()
         # Compute final total energy
         self.addComputeSum("ke", "0.5*m*v*v")
         self.addComputeGlobal("potential_new", "energy")
@@ -646,7 +1878,7 @@ class GHMCIntegrator(mm.CustomIntegrator):
         #
         # Velocity randomization
         #
-        self.addComputePerDof("v", "sqrt(b)*v + sqrt(1-b)*sigma*gaussian")
+        self.addComputePerDof("v", "sqrt(b)*v + sqrt(1-b)*%s*gaussian" % sigma)
         self.addConstrainVelocities()
 
         #
@@ -674,12 +1906,203 @@ class GHMCIntegrator(mm.CustomIntegrator):
         temperature : simtk.unit.Quantity
             The new temperature
         """
-        kT = kB * temperature
-        self.setGlobalVariableByName('kT', kT)
-        # Reset statistics to ensure 'sigma' is updated on step 0
+        super(GHMCIntegrator, self).setTemperature(temperature)
         self.resetStatistics()
 
-class VVVRIntegrator(mm.CustomIntegrator):
+class LangevinSplittingIntegrator(_CollisionRateMixin, mm.CustomIntegrator):
+
+    """
+    Langevin integrator built from an arbitrary splitting of the Langevin equations.
+
+    """
+
+    def __init__(self, splitting="V R O R V", temperature=298.0 * simtk.unit.kelvin, collision_rate=91.0 / simtk.unit.picoseconds,
+                 timestep=1.0 * simtk.unit.femtoseconds, monitor_heat=False, monitor_work=False, lean=False):
+        """
+        Create a Langevin integrator from a splitting string.
+
+        Parameters
+        ----------
+        splitting : str, default: "V R O R V"
+           Sequence of substeps, separated by spaces, each of which is one of
+           'O' (Ornstein-Uhlenbeck velocity randomization), 'V' (velocity update from forces),
+           and 'R' (position update from velocities). The timestep is divided equally among
+           all substeps of the same kind.
+        temperature : numpy.unit.Quantity compatible with kelvin, default: 298.0*simtk.unit.kelvin
+           The temperature.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default: 91.0/simtk.unit.picoseconds
+           The collision rate.
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1.0*simtk.unit.femtoseconds
+           The integration timestep.
+        monitor_heat : boolean, default: False
+           Accumulate the heat exchanged with the bath in each step, in the global `heat`.
+        monitor_work : boolean, default: False
+           Accumulate the shadow work of each step, in the global `shadow_work`.
+        lean : boolean, default: False
+           If True, no per-DOF variables are allocated: the velocities are used as scratch storage when applying
+           position constraints.  Every 'R' substep then recomputes the velocities from two positions, which
+           loses about log10(|x|/|v dt|) significant digits of the velocities, a noticeable error in single
+           precision, so this is only done if the System has constraints, which is detected at the first step.
+
+        Notes
+        -----
+        Common splittings are "V R O R V" (BAOAB), "R V O V R" (ABOBA), and "O V R V O" (OBABO, which is the
+        VVVR integrator). BAOAB has a much smaller configurational sampling error than the other splittings,
+        which allows substantially larger timesteps at the same accuracy.
+
+        The heat is the change in kinetic energy during the 'O' substeps, and the shadow work is the change
+        in total energy during a step that is not accounted for by the heat.
+
+        References
+        ----------
+        Benedict Leimkuhler and Charles Matthews.
+        Rational construction of stochastic numerical methods for molecular sampling.
+        Applied Mathematics Research eXpress 2013:34 (2013).
+        http://dx.doi.org/10.1093/amrx/abs010
+
+        David A. Sivak, John D. Chodera, and Gavin E. Crooks.
+        Time step rescaling recovers continuous-time dynamical properties for discrete-time Langevin integration of nonequilibrium systems
+        http://arxiv.org/abs/1301.3800
+
+        Examples
+        --------
+
+        Create a BAOAB Langevin integrator that measures the shadow work.
+
+        >>> temperature = 298.0 * simtk.unit.kelvin
+        >>> collision_rate = 1.0 / simtk.unit.picoseconds
+        >>> timestep = 4.0 * simtk.unit.femtoseconds
+        >>> integrator = LangevinSplittingIntegrator("V R O R V", temperature, collision_rate, timestep, monitor_work=True)
+
+        """
+        substeps = self._parse_splitting(splitting)
+        measure = monitor_heat or monitor_work
+        self._lean = lean
+
+        # Create a new custom integrator.
+        super(LangevinSplittingIntegrator, self).__init__(timestep)
+
+        #
+        # Integrator initialization.
+        #
+        self.addGlobalVariable("kT", kB * temperature)  # thermal energy
+        self.addGlobalVariable("collision_rate", collision_rate * simtk.unit.picoseconds)  # in 1/picoseconds
+        self.addGlobalVariable("a", 0)  # velocity damping factor of an 'O' substep
+        self.addGlobalVariable("b", 0)  # velocity noise factor of an 'O' substep
+        if not lean:
+            self.addPerDofVariable("x1", 0)  # position before application of constraints
+        else:
+            self.addGlobalVariable("has_constraints", 1)  # 1 if the System has constraints
+            self.addGlobalVariable("constraint_detection_norm", 0)
+
+        # bookkeeping variables
+        if measure:
+            self.addGlobalVariable("kinetic_energy", 0)
+            self.addGlobalVariable("step_heat", 0)  # heat exchanged in the current step
+        if monitor_heat:
+            self.addGlobalVariable("heat", 0)
+        if monitor_work:
+            self.addGlobalVariable("initial_energy", 0)  # total energy at the beginning of the step
+            self.addGlobalVariable("shadow_work", 0)
+
+        #
+        # Compute the Ornstein-Uhlenbeck coefficients for the current timestep.
+        #
+        self._begin_initialization()
+        self._add_timestep_dependent_global("a", "exp(-collision_rate * dt / %d)" % max(substeps.count("O"), 1))
+        self._add_timestep_dependent_global("b", "sqrt(1 - a^2)")
+        if lean:
+            _add_constraint_detection_without_storage(self)
+        self._end_initialization()
+
+        #
+        # Allow context updating here.
+        #
+        self.addUpdateContextState()
+
+        if measure:
+            self.addComputeGlobal("step_heat", "0")
+        if monitor_work:
+            self.addComputeSum("kinetic_energy", "0.5 * m * v * v")
+            self.addComputeGlobal("initial_energy", "kinetic_energy + energy")
+
+        #
+        # Substeps.
+        #
+        self._add_substeps(substeps, measure)
+
+        #
+        # Accumulate heat and shadow work.
+        #
+        if monitor_heat:
+            self.addComputeGlobal("heat", "heat + step_heat")
+        if monitor_work:
+            self.addComputeSum("kinetic_energy", "0.5 * m * v * v")
+            self.addComputeGlobal("shadow_work", "shadow_work + (kinetic_energy + energy - initial_energy) - step_heat")
+
+    # Kinds of substeps that can appear in a splitting.
+    _SUBSTEP_KINDS = ["O", "V", "R"]
+
+    @classmethod
+    def _parse_splitting(cls, splitting):
+        """Return the list of substeps of a splitting string, checking that it is valid."""
+        substeps = splitting.split() if " " in splitting.strip() else list(splitting.strip())
+        for substep in substeps:
+            if substep not in cls._SUBSTEP_KINDS:
+                raise ValueError("Invalid substep '%s' in splitting '%s'; substeps must be one of %s"
+                                 % (substep, splitting, ", ".join("'%s'" % kind for kind in cls._SUBSTEP_KINDS)))
+        if "V" not in substeps or "R" not in substeps:
+            raise ValueError("Splitting '%s' must contain at least one 'V' and one 'R' substep" % splitting)
+        return substeps
+
+    def _add_substeps(self, substeps, measure):
+        """Add the substeps of the splitting."""
+        for substep in substeps:
+            self._add_substep(substep, substeps.count(substep), measure)
+
+    def _add_substep(self, substep, nsubsteps, measure):
+        """Add one substep, of which there are nsubsteps of the same kind in the splitting."""
+        if substep == "O":
+            self._add_O_step(nsubsteps, measure)
+        elif substep == "V":
+            self._add_V_step(nsubsteps)
+        elif substep == "R":
+            self._add_R_step(nsubsteps)
+
+    def _add_O_step(self, nsubsteps, measure):
+        """Add an Ornstein-Uhlenbeck velocity randomization over dt/nsubsteps."""
+        if measure:
+            self.addComputeSum("kinetic_energy", "0.5 * m * v * v")
+            self.addComputeGlobal("step_heat", "step_heat - kinetic_energy")
+        self.addComputePerDof("v", "a*v + b*sqrt(kT/m)*gaussian")
+        self.addConstrainVelocities()
+        if measure:
+            self.addComputeSum("kinetic_energy", "0.5 * m * v * v")
+            self.addComputeGlobal("step_heat", "step_heat + kinetic_energy")
+
+    def _add_V_step(self, nsubsteps):
+        """Add a velocity update from forces over dt/nsubsteps."""
+        self.addComputePerDof("v", "v + (dt / %d)*f/m" % nsubsteps)
+        self.addConstrainVelocities()
+
+    def _add_R_step(self, nsubsteps):
+        """Add a position update from velocities over dt/nsubsteps."""
+        self.addComputePerDof("x", "x + (dt / %d)*v" % nsubsteps)
+        if self._lean:
+            # Store the old positions in v, so that v becomes the displacement over the substep after constraining x.
+            self.beginIfBlock("has_constraints = 1")
+            self.addComputePerDof("v", "x - (dt / %d)*v" % nsubsteps)
+            self.addConstrainPositions()
+            self.addComputePerDof("v", "(x - v)/(dt / %d)" % nsubsteps)
+            self.endBlock()
+        else:
+            self.addComputePerDof("x1", "x")
+            self.addConstrainPositions()
+            self.addComputePerDof("v", "v + (x - x1)/(dt / %d)" % nsubsteps)
+        self.addConstrainVelocities()
+
+
+class VVVRIntegrator(LangevinSplittingIntegrator):
 
     """
     Create a velocity Verlet with velocity randomization (VVVR) integrator.
@@ -687,7 +2110,7 @@ class VVVRIntegrator(mm.CustomIntegrator):
     """
 
     def __init__(self, temperature=298.0 * simtk.unit.kelvin, collision_rate=91.0 / simtk.unit.picoseconds,
-                 timestep=1.0 * simtk.unit.femtoseconds, monitor_heat = False, monitor_work = False):
+                 timestep=1.0 * simtk.unit.femtoseconds, monitor_heat = False, monitor_work = False, lean=False):
         """
         Create a velocity verlet with velocity randomization (VVVR) integrator.
 
@@ -703,18 +2126,23 @@ class VVVRIntegrator(mm.CustomIntegrator):
            Accumulate the heat exchanged with the bath in each step, in the global `heat`.
         monitor_work : boolean, default: False
            Accumulate the shadow work of each step, in the global `shadow_work`.
+        lean : boolean, default: False
+           If True, no per-DOF variables are allocated (see LangevinSplittingIntegrator).
 
         Notes
         -----
         This integrator is equivalent to a Langevin integrator in the velocity Verlet discretization with a
         timestep correction to ensure that the field-free diffusion constant is timestep invariant.
+        It is the "O V R V O" splitting of LangevinSplittingIntegrator.
 
         The global 'shadow_work' keeps track of the shadow_work accumulated during integration, and can be
         used to correct the sampled statistics or in a Metropolization scheme.
 
-        TODO
-        ----
-        Move initialization of 'sigma' to setting the per-particle variables.
+        The energies of the last step are kept in the globals 'kinetic_energy_1' and 'kinetic_energy_2' (the
+        kinetic energies before and after the symplectic substeps) if either quantity is monitored, in
+        'kinetic_energy_0' and 'kinetic_energy_3' (before the first and after the last velocity randomization)
+        if the heat is monitored, and in 'energy_before_symplectic' and 'energy_after_symplectic' (the total
+        energies before and after the symplectic substeps) if the work is monitored.
 
         References
         ----------
@@ -733,99 +2161,1036 @@ class VVVRIntegrator(mm.CustomIntegrator):
         >>> integrator = VVVRIntegrator(temperature, collision_rate, timestep)
 
         """
-        # Compute constants.
-        kT = kB * temperature
-        gamma = collision_rate
-
-        # Create a new custom integrator.
-        super(VVVRIntegrator, self).__init__(timestep)
-
-        #
-        # Integrator initialization.
-        #
-        self.addGlobalVariable("kT", kT)  # thermal energy
-        self.addGlobalVariable("b", numpy.exp(-gamma * timestep))  # velocity mixing parameter
-        self.addPerDofVariable("sigma", 0)
-        self.addPerDofVariable("x1", 0)  # position before application of constraints
-
-        # bookkeeping variables
-        if monitor_heat and monitor_work:
-            self.addGlobalVariable("heat", 0)
-            self.addGlobalVariable("kinetic_energy_0", 0)
+        self._monitor_heat = monitor_heat
+        self._monitor_work = monitor_work
+        super(VVVRIntegrator, self).__init__("O V R V O", temperature, collision_rate, timestep,
+                                             monitor_heat=monitor_heat, monitor_work=monitor_work, lean=lean)
+
+    def _add_substeps(self, substeps, measure):
+        """Add the substeps, keeping the kinetic and total energies around the symplectic substeps in globals."""
+        if measure:
             self.addGlobalVariable("kinetic_energy_1", 0)
             self.addGlobalVariable("kinetic_energy_2", 0)
-            self.addGlobalVariable("kinetic_energy_3", 0)
-            self.addGlobalVariable("energy_before_symplectic", 0)
-            self.addGlobalVariable("energy_after_symplectic", 0)
-            self.addGlobalVariable("shadow_work", 0)
-        elif monitor_heat:
-            self.addGlobalVariable("heat", 0)
+        if self._monitor_heat:
             self.addGlobalVariable("kinetic_energy_0", 0)
-            self.addGlobalVariable("kinetic_energy_1", 0)
-            self.addGlobalVariable("kinetic_energy_2", 0)
             self.addGlobalVariable("kinetic_energy_3", 0)
-        elif monitor_work:
-            self.addGlobalVariable("kinetic_energy_1", 0)
-            self.addGlobalVariable("kinetic_energy_2", 0)
+        if self._monitor_work:
             self.addGlobalVariable("energy_before_symplectic", 0)
             self.addGlobalVariable("energy_after_symplectic", 0)
-            self.addGlobalVariable("shadow_work", 0)
+
+        # The 'O' substeps leave the kinetic energy after the randomization in 'kinetic_energy', and the
+        # kinetic energy it changed by in 'step_heat'.
+        self._add_substep(substeps[0], substeps.count(substeps[0]), measure)
+        if measure:
+            self.addComputeGlobal("kinetic_energy_1", "kinetic_energy")
+        if self._monitor_heat:
+            self.addComputeGlobal("kinetic_energy_0", "kinetic_energy - step_heat")
+        if self._monitor_work:
+            self.addComputeGlobal("energy_before_symplectic", "energy + kinetic_energy")
+        for substep in substeps[1:-1]:
+            self._add_substep(substep, substeps.count(substep), measure)
+        if measure:
+            self.addComputeSum("kinetic_energy_2", "0.5 * m * v * v")
+        if self._monitor_work:
+            self.addComputeGlobal("energy_after_symplectic", "energy + kinetic_energy_2")
+        self._add_substep(substeps[-1], substeps.count(substeps[-1]), measure)
+        if self._monitor_heat:
+            self.addComputeGlobal("kinetic_energy_3", "kinetic_energy")
+
+
+class MetropolizedLangevinSplittingIntegrator(LangevinSplittingIntegrator):
+
+    """
+    Langevin integrator whose steps are accepted or rejected with the shadow work, so that sampling is exact.
+
+    """
+
+    def __init__(self, splitting="V R O R V", temperature=298.0 * simtk.unit.kelvin, collision_rate=1.0 / simtk.unit.picoseconds,
+                 timestep=1.0 * simtk.unit.femtoseconds, monitor_heat=False, lean=False):
+        """
+        Create a Metropolized Langevin integrator from a symmetric splitting string.
+
+        Parameters
+        ----------
+        splitting : str, default: "V R O R V"
+           Sequence of substeps, which must read the same forwards and backwards (see LangevinSplittingIntegrator).
+        temperature : numpy.unit.Quantity compatible with kelvin, default: 298.0*simtk.unit.kelvin
+           The temperature.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default: 1.0/simtk.unit.picoseconds
+           The collision rate.
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1.0*simtk.unit.femtoseconds
+           The integration timestep.
+        monitor_heat : boolean, default: False
+           Accumulate the heat exchanged with the bath in accepted steps, in the global `heat`.
+        lean : boolean, default: False
+           If True, the velocities are used as scratch storage when applying position constraints
+           (see LangevinSplittingIntegrator).
+
+        Notes
+        -----
+        Each step of the splitting is a trial that is accepted with probability min(1, exp(-w/kT)), where w is the
+        shadow work of the step, i.e. the change in total energy not accounted for by the heat.  On rejection, the
+        positions are restored and the velocities are restored and reversed, as in GHMCIntegrator.  For symmetric
+        splittings, this satisfies detailed balance with respect to the canonical distribution for any timestep,
+        which allows larger timesteps without configurational sampling errors.
+
+        The global 'shadow_work' accumulates the shadow work of accepted steps, and the global variables 'ntrials' and
+        'naccept' keep track of how many trials have been attempted and accepted, respectively.
+
+        References
+        ----------
+        Jerome P. Nilmeier, Gavin E. Crooks, David D. L. Minh, and John D. Chodera.
+        Nonequilibrium candidate Monte Carlo is an efficient tool for equilibrium simulation.
+        PNAS 108:E1009 (2011).
+        http://dx.doi.org/10.1073/pnas.1106094108
+
+        Examples
+        --------
+
+        Create a Metropolized BAOAB integrator.
+
+        >>> temperature = 298.0 * simtk.unit.kelvin
+        >>> collision_rate = 1.0 / simtk.unit.picoseconds
+        >>> timestep = 4.0 * simtk.unit.femtoseconds
+        >>> integrator = MetropolizedLangevinSplittingIntegrator("V R O R V", temperature, collision_rate, timestep)
+
+        """
+        substeps = self._parse_splitting(splitting)
+        if substeps != substeps[::-1]:
+            raise ValueError("Splitting '%s' must be symmetric to be Metropolized" % splitting)
+        super(MetropolizedLangevinSplittingIntegrator, self).__init__(splitting, temperature, collision_rate, timestep,
+                                                                      monitor_heat=monitor_heat, monitor_work=True, lean=lean)
+
+    def _add_substeps(self, substeps, measure):
+        """Add the substeps of the splitting as a trial that is accepted or rejected with its shadow work."""
+        self.addPerDofVariable("xold", 0)  # old positions
+        self.addPerDofVariable("vold", 0)  # old velocities
+        self.addGlobalVariable("accept", 0)  # accept or reject
+        self.addGlobalVariable("naccept", 0)  # number accepted
+        self.addGlobalVariable("ntrials", 0)  # number of Metropolization trials
+
+        self.addComputePerDof("xold", "x")
+        self.addComputePerDof("vold", "v")
+        super(MetropolizedLangevinSplittingIntegrator, self)._add_substeps(substeps, measure)
+
+        # Accept/reject with the shadow work of the step, ensuring rejection if the energy is NaN.
+        self.addComputeSum("kinetic_energy", "0.5 * m * v * v")
+        self.addComputeGlobal("accept", "step(exp(-((kinetic_energy + energy - initial_energy) - step_heat)/kT) - uniform)")
+        self.beginIfBlock("accept != 1")
+        self.addComputePerDof("x", "xold")
+        self.addComputePerDof("v", "-vold")
+        self.addComputeGlobal("step_heat", "0")
+        self.endBlock()
 
         #
-        # Allow context updating here.
+        # Accumulate statistics.
         #
-        self.addUpdateContextState()
+        self.addComputeGlobal("naccept", "naccept + accept")
+        self.addComputeGlobal("ntrials", "ntrials + 1")
+
+    def resetStatistics(self):
+        """
+        Reset the step counter and statistics
+
+        """
+        self.setGlobalVariableByName('ntrials', 0)
+        self.setGlobalVariableByName('naccept', 0)
+
+    def setTemperature(self, temperature):
+        """
+        Set the temperature.
+
+        This also resets the trial statistics.
+
+        Parameters
+        ----------
+        temperature : simtk.unit.Quantity
+            The new temperature
+        """
+        super(MetropolizedLangevinSplittingIntegrator, self).setTemperature(temperature)
+        self.resetStatistics()
+
+
+class NonequilibriumLangevinSplittingIntegrator(LangevinSplittingIntegrator):
+
+    """
+    Langevin integrator that switches context parameters along a protocol and accumulates the protocol work.
+
+    """
+
+    _SUBSTEP_KINDS = ["O", "V", "R", "H"]
+
+    def __init__(self, alchemical_functions=None, nsteps_neq=100, splitting="H V R O R V", temperature=298.0 * simtk.unit.kelvin,
+                 collision_rate=91.0 / simtk.unit.picoseconds, timestep=1.0 * simtk.unit.femtoseconds,
+                 monitor_heat=False, monitor_work=False, lean=False):
+        """
+        Create a nonequilibrium switching Langevin integrator.
+
+        Parameters
+        ----------
+        alchemical_functions : dict of str: str, optional, default: None
+           For each context parameter to switch, an expression of the global 'protocol_lambda' giving its value, e.g.
+           {'lambda_sterics': 'min(1, 2*protocol_lambda)'}.  'protocol_lambda' goes from 0 to 1 during the protocol.
+        nsteps_neq : int, default: 100
+           The number of steps over which 'protocol_lambda' goes from 0 to 1.
+        splitting : str, default: "H V R O R V"
+           Sequence of substeps (see LangevinSplittingIntegrator), where 'H' substeps update the context parameters.
+           'protocol_lambda' is incremented equally in each 'H' substep.  A splitting without 'H' substeps raises
+           a ValueError.
+        temperature : numpy.unit.Quantity compatible with kelvin, default: 298.0*simtk.unit.kelvin
+           The temperature.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default: 91.0/simtk.unit.picoseconds
+           The collision rate.
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1.0*simtk.unit.femtoseconds
+           The integration timestep.
+        monitor_heat : boolean, default: False
+           Accumulate the heat exchanged with the bath in each step, in the global `heat`.
+        monitor_work : boolean, default: False
+           Accumulate the shadow work of each step, in the global `shadow_work`.  The protocol work is excluded.
+        lean : boolean, default: False
+           If True, no per-DOF variables are allocated (see LangevinSplittingIntegrator).
+
+        Notes
+        -----
+        The whole switching trajectory runs inside the integrator program, so it can be executed with a single call
+        to integrator.step(nsteps_neq).  The context parameters are set to their values at protocol_lambda = 0 in the
+        first 'H' substep, and kept at their final values once the protocol is complete, so that further steps
+        sample the final state.  The protocol work, which is the sum of the changes in potential energy at fixed
+        positions in the 'H' substeps, is accumulated in the global 'protocol_work', and `resetProtocol()` prepares
+        the integrator for another switching trajectory, resetting the protocol work, heat and shadow work.
+
+        References
+        ----------
+        Jerome P. Nilmeier, Gavin E. Crooks, David D. L. Minh, and John D. Chodera.
+        Nonequilibrium candidate Monte Carlo is an efficient tool for equilibrium simulation.
+        PNAS 108:E1009 (2011).
+        http://dx.doi.org/10.1073/pnas.1106094108
+
+        Examples
+        --------
+
+        Create an integrator that switches off the context parameter 'lambda' over 500 steps.
+
+        >>> temperature = 298.0 * simtk.unit.kelvin
+        >>> integrator = NonequilibriumLangevinSplittingIntegrator({'lambda': '1 - protocol_lambda'}, 500, temperature=temperature)
+
+        """
+        self._alchemical_functions = dict() if alchemical_functions is None else dict(alchemical_functions)
+        self._nsteps_neq = nsteps_neq
+        self._monitor_heat = monitor_heat
+        self._monitor_work = monitor_work
+        super(NonequilibriumLangevinSplittingIntegrator, self).__init__(splitting, temperature, collision_rate, timestep,
+                                                                        monitor_heat=monitor_heat, monitor_work=monitor_work, lean=lean)
+
+    @classmethod
+    def _parse_splitting(cls, splitting):
+        """Return the list of substeps of a splitting string, checking that it has at least one 'H' substep."""
+        substeps = super(NonequilibriumLangevinSplittingIntegrator, cls)._parse_splitting(splitting)
+        if "H" not in substeps:
+            raise ValueError("Splitting '%s' must contain at least one 'H' substep to switch the context parameters"
+                             % splitting)
+        return substeps
+
+    def _add_substeps(self, substeps, measure):
+        """Add the substeps of the splitting, including the 'H' substeps that switch the context parameters."""
+        self.addGlobalVariable("protocol_lambda", 0)  # protocol progress, from 0 to 1
+        self.addGlobalVariable("protocol_step", 0)  # number of 'H' substeps performed
+        self.addGlobalVariable("protocol_work", 0)  # accumulated protocol work
+        self.addGlobalVariable("Eold", 0)  # potential energy before an 'H' substep
+        super(NonequilibriumLangevinSplittingIntegrator, self)._add_substeps(substeps, measure)
+
+    def _add_substep(self, substep, nsubsteps, measure):
+        """Add one substep, of which there are nsubsteps of the same kind in the splitting."""
+        if substep == "H":
+            self._add_H_step(nsubsteps, measure)
+        else:
+            super(NonequilibriumLangevinSplittingIntegrator, self)._add_substep(substep, nsubsteps, measure)
+
+    def _add_H_step(self, nsubsteps, measure):
+        """Add an update of the context parameters by 1/(nsteps_neq*nsubsteps) of the protocol."""
+        # Set the context parameters to their initial values at the start of the protocol.
+        self.beginIfBlock("protocol_step = 0")
+        self.addComputeGlobal("Eold", "energy")
+        for parameter, expression in self._alchemical_functions.items():
+            self.addComputeGlobal(parameter, expression)
+        if self._monitor_work:
+            self.addComputeGlobal("initial_energy", "initial_energy + (energy - Eold)")
+        self.endBlock()
+
+        self.beginIfBlock("protocol_step < %d" % (self._nsteps_neq * nsubsteps))
+        self.addComputeGlobal("Eold", "energy")
+        self.addComputeGlobal("protocol_step", "protocol_step + 1")
+        self.addComputeGlobal("protocol_lambda", "protocol_step / %d" % (self._nsteps_neq * nsubsteps))
+        for parameter, expression in self._alchemical_functions.items():
+            self.addComputeGlobal(parameter, expression)
+        self.addComputeGlobal("protocol_work", "protocol_work + (energy - Eold)")
+        if self._monitor_work:
+            # Exclude the protocol work from the shadow work.
+            self.addComputeGlobal("initial_energy", "initial_energy + (energy - Eold)")
+        self.endBlock()
+
+    def resetProtocol(self):
+        """
+        Reset the protocol and the work accumulated along it, to run another switching trajectory.
+
+        The protocol work is reset, as well as the heat and shadow work if they are monitored, so that all of them
+        are accumulated over the same switching trajectory.
+
+        """
+        self.setGlobalVariableByName("protocol_lambda", 0)
+        self.setGlobalVariableByName("protocol_step", 0)
+        self.setGlobalVariableByName("protocol_work", 0)
+        if self._monitor_heat:
+            self.setGlobalVariableByName("heat", 0)
+        if self._monitor_work:
+            self.setGlobalVariableByName("shadow_work", 0)
+
+    @property
+    def protocol_work(self):
+        """The protocol work accumulated since the protocol was started."""
+        return self.getGlobalVariableByName("protocol_work") * simtk.unit.kilojoules_per_mole
+
+
+class BrownianDynamicsIntegrator(_CollisionRateMixin, mm.CustomIntegrator):
+
+    """
+    Overdamped Langevin (Brownian) dynamics integrator.
+
+    """
+
+    # The velocities are the displacement divided by the timestep, not samples from the Maxwell-Boltzmann distribution.
+    _physical_velocities = False
+
+    def __init__(self, temperature=298.0 * simtk.unit.kelvin, collision_rate=91.0 / simtk.unit.picoseconds, timestep=1.0 * simtk.unit.femtoseconds):
+        """
+        Create a Brownian dynamics integrator.
+
+        Parameters
+        ----------
+        temperature : numpy.unit.Quantity compatible with kelvin, default: 298.0*simtk.unit.kelvin
+           The temperature.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default: 91.0/simtk.unit.picoseconds
+           The friction coefficient divided by the mass, which sets the diffusion constant kT/(m*collision_rate).
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1.0*simtk.unit.femtoseconds
+           The integration timestep.
+
+        Notes
+        -----
+        The positions are updated with the Euler-Maruyama discretization of overdamped Langevin dynamics,
+        x <- x + dt*f/(m*collision_rate) + sqrt(2*kT*dt/(m*collision_rate))*gaussian, which takes a single force
+        evaluation per step.  The velocities are set to the displacement divided by the timestep.  The sampled
+        distribution has an error of order dt, which MALAIntegrator removes.
+
+        Examples
+        --------
+
+        Create a Brownian dynamics integrator.
+
+        >>> temperature = 298.0 * simtk.unit.kelvin
+        >>> collision_rate = 91.0 / simtk.unit.picoseconds
+        >>> timestep = 10.0 * simtk.unit.femtoseconds
+        >>> integrator = BrownianDynamicsIntegrator(temperature, collision_rate, timestep)
+
+        """
+        super(BrownianDynamicsIntegrator, self).__init__(timestep)
 
         #
-        # Pre-computation.
-        # This only needs to be done once, but it needs to be done for each degree of freedom.
-        # Could move this to initialization?
+        # Integrator initialization.
         #
-        self.addComputePerDof("sigma", "sqrt(kT/m)")
+        self.addGlobalVariable("kT", kB * temperature)  # thermal energy
+        self.addGlobalVariable("collision_rate", collision_rate * simtk.unit.picoseconds)  # in 1/picoseconds
+        self.addPerDofVariable("xold", 0)  # old positions
+
+        self.addUpdateContextState()
 
         #
-        # Velocity perturbation.
+        # Euler-Maruyama step.
         #
+        self.addComputePerDof("xold", "x")
+        self.addComputePerDof("x", "x + dt*f/(m*collision_rate) + sqrt(2*kT*dt/(m*collision_rate))*gaussian")
+        self.addConstrainPositions()
+        self.addComputePerDof("v", "(x - xold)/dt")
 
-        if monitor_heat:
-            self.addComputeSum("kinetic_energy_0", "0.5 * m * v * v")
 
-        self.addComputePerDof("v", "sqrt(b)*v + sqrt(1-b)*sigma*gaussian")
-        self.addConstrainVelocities()
+class MALAIntegrator(_CollisionRateMixin, mm.CustomIntegrator):
 
-        if monitor_heat or monitor_work:
-            self.addComputeSum("kinetic_energy_1", "0.5 * m * v * v")
+    """
+    Metropolis-adjusted Langevin algorithm (MALA) integrator.
 
-        if monitor_heat:
-            self.addComputeGlobal("heat", "heat + (kinetic_energy_1 - kinetic_energy_0)")
+    """
 
-        if monitor_work:
-            self.addComputeGlobal("energy_before_symplectic", "energy + kinetic_energy_1")
+    # The velocities are the displacement divided by the timestep, not samples from the Maxwell-Boltzmann distribution.
+    _physical_velocities = False
+
+    def __init__(self, temperature=298.0 * simtk.unit.kelvin, collision_rate=91.0 / simtk.unit.picoseconds, timestep=1.0 * simtk.unit.femtoseconds):
+        """
+        Create a Metropolis-adjusted Langevin algorithm (MALA) integrator.
+
+        Parameters
+        ----------
+        temperature : numpy.unit.Quantity compatible with kelvin, default: 298.0*simtk.unit.kelvin
+           The temperature.
+        collision_rate : numpy.unit.Quantity compatible with 1/picoseconds, default: 91.0/simtk.unit.picoseconds
+           The friction coefficient divided by the mass, which sets the diffusion constant kT/(m*collision_rate).
+        timestep : numpy.unit.Quantity compatible with femtoseconds, default: 1.0*simtk.unit.femtoseconds
+           The integration timestep.
+
+        Warning
+        -------
+        This integrator does not sample exactly from the canonical distribution with constraints.
+
+        Notes
+        -----
+        Each step proposes a Brownian dynamics step (see BrownianDynamicsIntegrator), which is accepted or rejected
+        with the Metropolis-Hastings criterion, including the ratio of the reverse and forward proposal probabilities.
+        Configurations are then sampled exactly from the Boltzmann distribution for any timestep.  The velocities are
+        set to the displacement divided by the timestep, and are zero after a rejection.
+
+        Additional global variables 'ntrials' and  'naccept' keep track of how many trials have been attempted and
+        accepted, respectively.
+
+        References
+        ----------
+        Gareth O. Roberts and Richard L. Tweedie.
+        Exponential convergence of Langevin distributions and their discrete approximations.
+        Bernoulli 2:341 (1996).
+        http://dx.doi.org/10.2307/3318418
+
+        Examples
+        --------
+
+        Create a MALA integrator.
+
+        >>> temperature = 298.0 * simtk.unit.kelvin
+        >>> collision_rate = 91.0 / simtk.unit.picoseconds
+        >>> timestep = 10.0 * simtk.unit.femtoseconds
+        >>> integrator = MALAIntegrator(temperature, collision_rate, timestep)
+
+        """
+        super(MALAIntegrator, self).__init__(timestep)
 
         #
-        # Symplectic steps
+        # Integrator initialization.
         #
-        self.addComputePerDof("v", "v + 0.5*dt*f/m")
-        self.addComputePerDof("x", "x + v*dt")
-        self.addComputePerDof("x1", "x")
-        self.addConstrainPositions()
-        self.addComputePerDof("v", "v + 0.5*dt*f/m + (x-x1)/dt")
-        self.addConstrainVelocities()
+        self.addGlobalVariable("naccept", 0)  # number accepted
+        self.addGlobalVariable("ntrials", 0)  # number of Metropolization trials
 
-        if monitor_heat or monitor_work:
-            self.addComputeSum("kinetic_energy_2", "0.5 * m * v * v")
+        self.addGlobalVariable("kT", kB * temperature)  # thermal energy
+        self.addGlobalVariable("collision_rate", collision_rate * simtk.unit.picoseconds)  # in 1/picoseconds
+        self.addPerDofVariable("xold", 0)  # old positions
+        self.addPerDofVariable("fold", 0)  # old forces
+        self.addGlobalVariable("Eold", 0)  # old energy
+        self.addGlobalVariable("Enew", 0)  # new energy
+        self.addGlobalVariable("log_forward", 0)  # minus log probability of the proposal
+        self.addGlobalVariable("log_reverse", 0)  # minus log probability of the reverse proposal
+        self.addGlobalVariable("accept", 0)  # accept or reject
 
-        if monitor_work:
-            self.addComputeGlobal("energy_after_symplectic", "energy + kinetic_energy_2")
-            self.addComputeGlobal("shadow_work", "shadow_work + (energy_after_symplectic - energy_before_symplectic)")
+        self.addUpdateContextState()
 
         #
-        # Velocity randomization
+        # Propose a Brownian dynamics step.
         #
+        self.addComputePerDof("xold", "x")
+        self.addComputePerDof("fold", "f")
+        self.addComputeGlobal("Eold", "energy")
+        self.addComputePerDof("x", "x + dt*f/(m*collision_rate) + sqrt(2*kT*dt/(m*collision_rate))*gaussian")
+        self.addConstrainPositions()
+        self.addComputeSum("log_forward", "m*collision_rate/(4*kT*dt)*(x - xold - dt*fold/(m*collision_rate))^2")
+        self.addComputeGlobal("Enew", "energy")
+        self.addComputeSum("log_reverse", "m*collision_rate/(4*kT*dt)*(xold - x - dt*f/(m*collision_rate))^2")
 
-        self.addComputePerDof("v", "sqrt(b)*v + sqrt(1-b)*sigma*gaussian")
-        self.addConstrainVelocities()
+        #
+        # Accept/reject step.
+        #
+        self.addComputeGlobal("accept", "step(exp(-(Enew-Eold)/kT - log_reverse + log_forward) - uniform)")
+        self.addComputePerDof("x", "x*accept + xold*(1-accept)")
+        self.addComputePerDof("v", "(x - xold)/dt")
 
-        if monitor_heat:
-            self.addComputeSum("kinetic_energy_3", "0.5 * m * v * v")
-            self.addComputeGlobal("heat", "heat + (kinetic_energy_1 - kinetic_energy_0) + (kinetic_energy_3 - kinetic_energy_2)")
+        #
+        # Accumulate statistics.
+        #
+        self.addComputeGlobal("naccept", "naccept + accept")
+        self.addComputeGlobal("ntrials", "ntrials + 1")
+
+    @property
+    def n_accept(self):
+        """The number of accepted MALA moves."""
+        return self.getGlobalVariableByName("naccept")
+
+    @property
+    def n_trials(self):
+        """The total number of attempted MALA moves."""
+        return self.getGlobalVariableByName("ntrials")
+
+    @property
+    def acceptance_rate(self):
+        """The acceptance rate: n_accept  / n_trials."""
+        return self.n_accept / float(self.n_trials)
+
+#=============================================================================================
+# INTEGRATOR UTILITIES
+#=============================================================================================
+
+def count_degrees_of_freedom(system):
+    """Count the degrees of freedom of a System.
+
+    Three degrees of freedom are counted for each particle with nonzero mass, minus one for each constraint, minus
+    three if the System has a CMMotionRemover.
+
+    Parameters
+    ----------
+    system : simtk.openmm.System
+        The System.
+
+    Returns
+    -------
+    ndof : int
+        The number of degrees of freedom.
+
+    Examples
+    --------
+
+    Thermostat a water box with rigid water molecules.
+
+    >>> from openmmtools import testsystems
+    >>> testsystem = testsystems.WaterBox(box_edge=2.0*simtk.unit.nanometers)
+    >>> ndof = count_degrees_of_freedom(testsystem.system)
+    >>> integrator = BussiVelocityVerletIntegrator(ndof=ndof)
+
+    """
+    nparticles = sum(1 for index in range(system.getNumParticles())
+                     if system.getParticleMass(index) / simtk.unit.amu > 0)
+    ndof = 3 * nparticles - system.getNumConstraints()
+    if any(isinstance(force, mm.CMMotionRemover) for force in system.getForces()):
+        ndof -= 3
+    return ndof
+
+
+def estimate_per_dof_memory(integrator, nparticles, precision='mixed'):
+    """Estimate the memory used by the per-DOF variables of a CustomIntegrator.
+
+    Parameters
+    ----------
+    integrator : simtk.openmm.CustomIntegrator
+        The integrator, for example any of the integrators in this module.
+    nparticles : int
+        The number of particles in the System.
+    precision : str, optional, default='mixed'
+        The precision of the platform, 'single', 'mixed' or 'double'.  Per-DOF variables are stored in single
+        precision only by single precision platforms; the Reference and CPU platforms use double precision.
+
+    Returns
+    -------
+    memory : dict of str : int
+        The number of bytes used by each per-DOF variable, by variable name.  This does not include the
+        positions, velocities and forces, which every integrator stores.
+
+    Examples
+    --------
+
+    Compare the per-DOF storage of the standard and lean GHMC integrators for a million atoms.
+
+    >>> standard = estimate_per_dof_memory(GHMCIntegrator(), 1000000)
+    >>> lean = estimate_per_dof_memory(GHMCIntegrator(lean=True), 1000000)
+    >>> sum(standard.values()) - sum(lean.values())
+    48000000
+
+    """
+    bytes_per_value = {'single': 4, 'mixed': 8, 'double': 8}
+    if precision not in bytes_per_value:
+        raise ValueError("precision must be one of %s, not '%s'" % (sorted(bytes_per_value.keys()), precision))
+    nbytes = 3 * nparticles * bytes_per_value[precision]
+    return {integrator.getPerDofVariableName(index): nbytes for index in range(integrator.getNumPerDofVariables())}
+
+
+def tune_mts_schedule(testsystem, schedules, platform=None, temperature=298.0 * simtk.unit.kelvin,
+                      simulation_time=2.0 * simtk.unit.picoseconds, nsamples=20, drift_tolerance=1.0):
+    """Find the fastest multiple timestep schedule whose energy drift is acceptable.
+
+    Each candidate schedule is used to run a short NVE trajectory with MTSIntegrator from the same
+    initial positions and velocities. The energy drift is the slope of a linear fit to the total
+    energy, and the cost is the wall-clock time spent in integration per simulated picosecond.
+
+    Parameters
+    ----------
+    testsystem : TestSystem
+        The test system to simulate. Its forces must already be assigned to force groups, for
+        example with `testsystems.assign_mts_force_groups`.
+    schedules : list of tuples
+        Candidate schedules, each a tuple (timestep, groups) of the outer timestep and the force
+        group specification passed to MTSIntegrator.
+    platform : simtk.openmm.Platform, optional, default=None
+        The platform to benchmark on. If None, OpenMM chooses the fastest available platform.
+    temperature : simtk.unit.Quantity compatible with kelvin, optional, default=298*kelvin
+        The temperature used to assign initial velocities and to express the drift.
+    simulation_time : simtk.unit.Quantity compatible with picoseconds, optional, default=2*picoseconds
+        The length of each trajectory.
+    nsamples : int, optional, default=20
+        The number of total energy samples collected along each trajectory.
+    drift_tolerance : float, optional, default=1.0
+        The largest acceptable energy drift, in kT per nanosecond per degree of freedom.
+
+    Returns
+    -------
+    best : tuple or None
+        The fastest schedule (timestep, groups) within the drift tolerance, or None if no schedule is.
+        Schedules whose trajectory became unstable, including those for which OpenMM raised an
+        exception, have infinite drift and are never chosen.
+    report : list of dict
+        For each schedule, in the order given, a dict with the keys 'timestep', 'groups', 'drift'
+        (in kT/ns/dof, or inf if the trajectory became unstable) and 'seconds_per_ps'.
+
+    Examples
+    --------
+
+    Compare the schedules of a water box with reciprocal space forces evaluated every 2 or 4 fs.
+
+    >>> from openmmtools import testsystems
+    >>> testsystem = testsystems.WaterBox(box_edge=2.0*simtk.unit.nanometers)
+    >>> schedules = [(2.0*simtk.unit.femtoseconds, testsystems.assign_mts_force_groups(testsystem, 2, 1, 1)),
+    ...              (4.0*simtk.unit.femtoseconds, testsystems.assign_mts_force_groups(testsystem, 4, 2, 1))]
+    >>> best, report = tune_mts_schedule(testsystem, schedules, simulation_time=0.2*simtk.unit.picoseconds)
+
+    Note that `assign_mts_force_groups` returns the same force groups for both schedules here, so
+    the force group assignment of the System is valid for both.
+
+    """
+    system = testsystem.system
+    kT = kB * temperature
+    ndof = count_degrees_of_freedom(system)
+
+    # Every populated force group, including the reciprocal space group of a NonbondedForce, must be integrated.
+    force_groups = set()
+    for force in system.getForces():
+        force_groups.add(force.getForceGroup())
+        if isinstance(force, mm.NonbondedForce) and force.getReciprocalSpaceForceGroup() >= 0 and \
+                force.getNonbondedMethod() in [mm.NonbondedForce.Ewald, mm.NonbondedForce.PME]:
+            force_groups.add(force.getReciprocalSpaceForceGroup())
+    for timestep, groups in schedules:
+        missing = force_groups - set(group for group, substeps in groups)
+        if len(missing) > 0:
+            raise ValueError("The schedule %s does not integrate the force groups %s of the System."
+                             % (groups, sorted(missing)))
+
+    report = list()
+    for timestep, groups in schedules:
+        nsteps = int(round(simulation_time / timestep))
+        steps_per_sample = max(nsteps // nsamples, 1)
+
+        integrator = MTSIntegrator(timestep, groups)
+        if platform is None:
+            context = mm.Context(system, integrator)
+        else:
+            context = mm.Context(system, integrator, platform)
+        context.setPositions(testsystem.positions)
+        context.setVelocitiesToTemperature(temperature, 1)
+
+        times, energies = list(), list()
+        elapsed = 0.0
+        try:
+            # Take a step outside the timing to compile kernels.
+            integrator.step(1)
+            for sample in range(nsamples):
+                initial_time = time.time()
+                integrator.step(steps_per_sample)
+                state = context.getState(getEnergy=True)
+                elapsed += time.time() - initial_time
+                times.append(state.getTime() / simtk.unit.nanoseconds)
+                energies.append((state.getPotentialEnergy() + state.getKineticEnergy()) / kT)
+        except mm.OpenMMException:
+            # Platforms other than Reference raise an exception when particle coordinates become NaN.
+            energies.append(numpy.nan)
+        del context, integrator
+
+        if numpy.all(numpy.isfinite(energies)):
+            drift = abs(numpy.polyfit(times, energies, 1)[0]) / ndof
+        else:
+            drift = numpy.inf
+        simulated_time = nsamples * steps_per_sample * timestep / simtk.unit.picoseconds
+        report.append(dict(timestep=timestep, groups=groups, drift=drift, seconds_per_ps=elapsed / simulated_time))
+
+    acceptable = [entry for entry in report if entry['drift'] <= drift_tolerance]
+    if len(acceptable) == 0:
+        return None, report
+    best = min(acceptable, key=lambda entry: entry['seconds_per_ps'])
+    return (best['timestep'], best['groups']), report
+
+
+def add_timestep_ramp(integrator, timestep=None, initial_timestep=None, growth_factor=1.05, shrink_factor=0.5,
+                      max_temperature_factor=1.5, min_acceptance_rate=0.5):
+    """Have a thermostated integrator ramp its timestep up from a small value during equilibration.
+
+    Freshly built systems often have large forces that make the production timestep unstable. This
+    appends a block to the integrator program that starts from `initial_timestep` and, after every
+    step, multiplies `dt` by `growth_factor` if the step looked stable and by `shrink_factor` otherwise,
+    never going below `initial_timestep`. A step is stable if the potential energy is finite, the
+    instantaneous kinetic temperature is below `max_temperature_factor` times the target temperature
+    (except for overdamped integrators such as BrownianDynamicsIntegrator, whose `v` are not physical
+    velocities), and, for integrators with a Metropolis test (global `accept`), the running acceptance rate is above
+    `min_acceptance_rate`. Once `dt` reaches `timestep` the ramp is switched off and the integrator
+    continues unchanged.
+
+    Precomputed quantities that depend on the timestep, such as the Langevin velocity damping, are
+    recomputed directly whenever `dt` changes. The rest of the initialization block, such as the constraint
+    detection of lean integrators or the isokinetic thermostat variables of IsokineticMTSIntegrator, is
+    not rerun.
+
+    Parameters
+    ----------
+    integrator : simtk.openmm.CustomIntegrator
+        A thermostated integrator from this module, with a global `kT`. It is modified in place and must
+        not yet be bound to a Context.
+    timestep : simtk.unit.Quantity compatible with femtoseconds, optional, default=None
+        The production timestep to ramp up to. If None, the current step size of the integrator is used.
+    initial_timestep : simtk.unit.Quantity compatible with femtoseconds, optional, default=None
+        The timestep to start from. If None, one hundredth of `timestep` is used.
+    growth_factor : float, optional, default=1.05
+        The factor by which the timestep grows after a stable step.
+    shrink_factor : float, optional, default=0.5
+        The factor by which the timestep shrinks after an unstable step.
+    max_temperature_factor : float, optional, default=1.5
+        The largest kinetic temperature, relative to the target temperature, still considered stable.
+    min_acceptance_rate : float, optional, default=0.5
+        The smallest running acceptance rate still considered stable, for integrators with a Metropolis test.
+
+    Notes
+    -----
+    The ramp adds the globals `ramp_timestep`, `ramp_initial_timestep`, `ramp_done` and a few others,
+    prefixed with `ramp_`. While it is active the potential energy and kinetic energy are computed every
+    step; once `ramp_done` is 1 the additional cost is a single conditional per step. Setting `ramp_done`
+    back to 0 and the step size to the initial timestep restarts the ramp.
+
+    Examples
+    --------
+
+    Equilibrate a Lennard-Jones fluid from random positions with a Langevin integrator.
+
+    >>> from openmmtools import testsystems
+    >>> testsystem = testsystems.LennardJonesFluid(nparticles=100)
+    >>> box_edge = testsystem.system.getDefaultPeriodicBoxVectors()[0][0]
+    >>> positions = box_edge * numpy.random.RandomState(0).uniform(size=(100, 3))
+    >>> integrator = VVVRIntegrator(temperature=120*simtk.unit.kelvin, timestep=10*simtk.unit.femtoseconds)
+    >>> add_timestep_ramp(integrator)
+    >>> context = mm.Context(testsystem.system, integrator)
+    >>> context.setPositions(positions)
+    >>> integrator.step(5000)
+    >>> integrator.getGlobalVariableByName("ramp_done")
+    1.0
+
+    """
+    global_names = [integrator.getGlobalVariableName(index) for index in range(integrator.getNumGlobalVariables())]
+    if "kT" not in global_names:
+        raise ValueError("the timestep ramp requires a thermostated integrator with a global 'kT'")
+    if not (growth_factor > 1.0 and 0.0 < shrink_factor < 1.0):
+        raise ValueError("growth_factor must be larger than 1 and shrink_factor must be between 0 and 1")
+
+    if timestep is None:
+        timestep = integrator.getStepSize()
+    if initial_timestep is None:
+        initial_timestep = timestep / 100.0
+    timestep = timestep.value_in_unit_system(simtk.unit.md_unit_system)
+    initial_timestep = initial_timestep.value_in_unit_system(simtk.unit.md_unit_system)
+    if not 0.0 < initial_timestep <= timestep:
+        raise ValueError("initial_timestep must be positive and no larger than timestep")
+
+    integrator.addGlobalVariable("ramp_timestep", timestep)
+    integrator.addGlobalVariable("ramp_initial_timestep", initial_timestep)
+    integrator.addGlobalVariable("ramp_done", 0)
+    integrator.addGlobalVariable("ramp_stable", 0)
+    integrator.addGlobalVariable("ramp_kinetic_energy", 0)
+    integrator.addGlobalVariable("ramp_ndof", 0)
+    integrator.addGlobalVariable("ramp_acceptance_rate", 1)
+
+    integrator.beginIfBlock("ramp_done = 0")
+    # Non-finite energies fail the tests, since step(NaN) = delta(NaN) = 0.
+    integrator.addComputeGlobal("ramp_stable", "delta(energy - energy)")
+    if getattr(integrator, "_physical_velocities", True):
+        integrator.beginIfBlock("ramp_ndof = 0")
+        integrator.addComputeSum("ramp_ndof", "select(m, 1, 0)")
+        integrator.endBlock()
+        integrator.addComputeSum("ramp_kinetic_energy", "0.5*m*v*v")
+        integrator.addComputeGlobal("ramp_stable", "ramp_stable * step(%r*ramp_ndof*kT - 2*ramp_kinetic_energy)"
+                                    % float(max_temperature_factor))
+    if "accept" in global_names:
+        integrator.addComputeGlobal("ramp_acceptance_rate", "0.9*ramp_acceptance_rate + 0.1*accept")
+        integrator.addComputeGlobal("ramp_stable", "ramp_stable * step(ramp_acceptance_rate - %r)"
+                                    % float(min_acceptance_rate))
+    integrator.addComputeGlobal("dt", "select(ramp_stable, min(%r*dt, ramp_timestep), max(%r*dt, ramp_initial_timestep))"
+                                % (float(growth_factor), float(shrink_factor)))
+    integrator.addComputeGlobal("ramp_done", "step(dt - ramp_timestep)")
+    for variable, expression in getattr(integrator, "_timestep_dependent_globals", ()):
+        integrator.addComputeGlobal(variable, expression)
+    integrator.endBlock()
+
+    integrator.setStepSize(initial_timestep)
+
+
+def _get_integrator_variables(integrator):
+    """Return copies of the global and per-DOF variables of a CustomIntegrator, as dicts by variable name."""
+    global_variables = {integrator.getGlobalVariableName(index): integrator.getGlobalVariable(index)
+                        for index in range(integrator.getNumGlobalVariables())}
+    per_dof_variables = {integrator.getPerDofVariableName(index): numpy.array(integrator.getPerDofVariable(index))
+                         for index in range(integrator.getNumPerDofVariables())}
+    return global_variables, per_dof_variables
+
+
+def _set_integrator_variables(integrator, global_variables, per_dof_variables):
+    """Set the global and per-DOF variables of a CustomIntegrator from dicts by variable name."""
+    for name, value in global_variables.items():
+        integrator.setGlobalVariableByName(name, value)
+    for name, values in per_dof_variables.items():
+        integrator.setPerDofVariableByName(name, values)
+
+
+def _is_stochastic(integrator):
+    """Return True if the program of a CustomIntegrator draws random numbers."""
+    for index in range(integrator.getNumComputations()):
+        expression = integrator.getComputationStep(index)[2]
+        if 'gaussian' in expression or 'uniform' in expression:
+            return True
+    return False
+
+
+def run_with_rollback(context, nsteps, checkpoint_interval=100, max_retries=4, timestep_factor=0.5):
+    """Integrate a Context, rolling back to the last checkpoint when the simulation becomes unstable.
+
+    The simulation is run in blocks of `checkpoint_interval` steps. After each block the potential
+    energy, kinetic energy and positions are checked, and if they are all finite the state of the
+    Context and all global and per-DOF variables of its integrator (for example `heat`, `shadow_work`,
+    `naccept` and `ntrials`) are kept in memory as a checkpoint. If they are not finite, or integration
+    raises an exception, the checkpoint is restored and the block is retried.
+
+    A stochastic integrator first retries the block at the same timestep, with new random numbers; after
+    that, and immediately for deterministic integrators, every retry multiplies the timestep of the
+    checkpoint by `timestep_factor`. That timestep is restored once the block has been completed, so
+    rare instabilities cost only the steps of a single block. Changes of the timestep made by the
+    integrator itself, for example by `add_timestep_ramp`, are kept.
+
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+        The Context to integrate. Its integrator must be a CustomIntegrator, for example any of the
+        integrators in this module.
+    nsteps : int
+        The number of steps to take.
+    checkpoint_interval : int, optional, default=100
+        The number of steps between checkpoints.
+    max_retries : int, optional, default=4
+        The largest number of times a single block is retried before giving up.
+    timestep_factor : float, optional, default=0.5
+        The factor by which the timestep is reduced on each retry.
+
+    Returns
+    -------
+    nrollbacks : int
+        The total number of times the Context was rolled back to a checkpoint.
+
+    Raises
+    ------
+    RuntimeError
+        If a block is still unstable after `max_retries` retries. The Context is left at the last checkpoint.
+
+    Notes
+    -----
+    Random number streams cannot be reseeded after a Context has been created, but they are not part of
+    the checkpoint, so a retried block sees different random numbers than the failed attempt. Steps of
+    retried blocks are taken at a smaller timestep, so the simulated time may be shorter than `nsteps`
+    times the timestep.
+
+    Examples
+    --------
+
+    Run Langevin dynamics of alanine dipeptide with a checkpoint every 50 steps.
+
+    >>> from openmmtools import testsystems
+    >>> testsystem = testsystems.AlanineDipeptideVacuum()
+    >>> integrator = VVVRIntegrator(temperature=300*simtk.unit.kelvin, timestep=1*simtk.unit.femtoseconds)
+    >>> context = mm.Context(testsystem.system, integrator)
+    >>> context.setPositions(testsystem.positions)
+    >>> nrollbacks = run_with_rollback(context, 200, checkpoint_interval=50)
+
+    """
+    integrator = context.getIntegrator()
+    stochastic = _is_stochastic(integrator)
+
+    def create_checkpoint():
+        state = context.getState(getPositions=True, getVelocities=True, getParameters=True)
+        return state, integrator.getStepSize(), _get_integrator_variables(integrator)
+
+    def restore_checkpoint(checkpoint):
+        state, timestep, (global_variables, per_dof_variables) = checkpoint
+        # The step size is set first, since thermostated integrators mark their precomputed quantities
+        # as stale when it changes, and the variables restore them.
+        integrator.setStepSize(timestep)
+        context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+        context.setPositions(state.getPositions())
+        context.setVelocities(state.getVelocities())
+        context.setTime(state.getTime())
+        for name, value in state.getParameters().items():
+            context.setParameter(name, value)
+        _set_integrator_variables(integrator, global_variables, per_dof_variables)
+
+    def is_finite():
+        state = context.getState(getEnergy=True, getPositions=True)
+        energies = [state.getPotentialEnergy() / simtk.unit.kilojoules_per_mole,
+                    state.getKineticEnergy() / simtk.unit.kilojoules_per_mole]
+        positions = state.getPositions(asNumpy=True) / simtk.unit.nanometers
+        return numpy.all(numpy.isfinite(energies)) and numpy.all(numpy.isfinite(positions))
+
+    checkpoint = create_checkpoint()
+    nrollbacks = 0
+    nsteps_done = 0
+    while nsteps_done < nsteps:
+        nsteps_block = min(checkpoint_interval, nsteps - nsteps_done)
+        timestep_reduced = False
+        for attempt in range(max_retries + 1):
+            try:
+                integrator.step(nsteps_block)
+                success = is_finite()
+            except mm.OpenMMException:
+                success = False
+            if success:
+                break
+            nrollbacks += 1
+            restore_checkpoint(checkpoint)
+            if attempt < max_retries:
+                nreductions = attempt if stochastic else attempt + 1
+                if nreductions > 0:
+                    integrator.setStepSize(checkpoint[1] * timestep_factor**nreductions)
+                    timestep_reduced = True
+        else:
+            raise RuntimeError("Integration was still unstable after %d retries at step %d; the Context was "
+                               "restored to the last checkpoint." % (max_retries, nsteps_done))
+        if timestep_reduced:
+            integrator.setStepSize(checkpoint[1])
+        checkpoint = create_checkpoint()
+        nsteps_done += nsteps_block
+
+    return nrollbacks
+
+
+def save_checkpoint(context, file):
+    """Save the state of a Context and all variables of its integrator to a compact binary file.
+
+    Unlike `Context.createCheckpoint`, the checkpoint includes the step size and every global and per-DOF
+    variable of the integrator, such as `naccept`, `ntrials`, `heat`, `shadow_work` and `vold`, so that
+    acceptance statistics, work accounting and timesteps adapted during the simulation continue correctly
+    after a restart, and it is independent of the platform. The time and step count of the Context are
+    saved as well. It is stored in numpy's uncompressed `.npz` format and restored with `load_checkpoint`.
+
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+        The Context to save. Its integrator must be a CustomIntegrator, for example any of the integrators
+        in this module.
+    file : str or file
+        The file name or open binary file to write to. numpy appends '.npz' to file names without it.
+
+    Examples
+    --------
+
+    Save a GHMC simulation and restore it into a new Context.
+
+    >>> import io
+    >>> from openmmtools import testsystems
+    >>> testsystem = testsystems.HarmonicOscillator()
+    >>> integrator = GHMCIntegrator()
+    >>> context = mm.Context(testsystem.system, integrator)
+    >>> context.setPositions(testsystem.positions)
+    >>> integrator.step(10)
+    >>> checkpoint = io.BytesIO()
+    >>> save_checkpoint(context, checkpoint)
+    >>> new_integrator = GHMCIntegrator()
+    >>> new_context = mm.Context(testsystem.system, new_integrator)
+    >>> _ = checkpoint.seek(0)
+    >>> load_checkpoint(new_context, checkpoint)
+    >>> new_integrator.getGlobalVariableByName("ntrials")
+    10.0
+
+    """
+    integrator = context.getIntegrator()
+    state = context.getState(getPositions=True, getVelocities=True, getParameters=True)
+    global_variables, per_dof_variables = _get_integrator_variables(integrator)
+    global_names = sorted(global_variables.keys())
+    per_dof_names = sorted(per_dof_variables.keys())
+    parameter_names = sorted(state.getParameters().keys())
+    nparticles = context.getSystem().getNumParticles()
+
+    numpy.savez(file,
+                integrator_class=numpy.array(_integrator_class_name(integrator)),
+                time=numpy.array(state.getTime().value_in_unit_system(simtk.unit.md_unit_system)),
+                step_count=numpy.array(context.getStepCount(), dtype=numpy.int64),
+                timestep=numpy.array(integrator.getStepSize().value_in_unit_system(simtk.unit.md_unit_system)),
+                box_vectors=numpy.array(state.getPeriodicBoxVectors().value_in_unit_system(simtk.unit.md_unit_system)),
+                positions=state.getPositions(asNumpy=True).value_in_unit_system(simtk.unit.md_unit_system),
+                velocities=state.getVelocities(asNumpy=True).value_in_unit_system(simtk.unit.md_unit_system),
+                parameter_names=numpy.array(parameter_names, dtype=str),
+                parameter_values=numpy.array([state.getParameters()[name] for name in parameter_names], dtype=float),
+                global_names=numpy.array(global_names, dtype=str),
+                global_values=numpy.array([global_variables[name] for name in global_names], dtype=float),
+                per_dof_names=numpy.array(per_dof_names, dtype=str),
+                per_dof_values=numpy.array([per_dof_variables[name] for name in per_dof_names],
+                                           dtype=float).reshape(len(per_dof_names), nparticles, 3))
+
+
+def load_checkpoint(context, file):
+    """Restore the state of a Context and all variables of its integrator from a file written by `save_checkpoint`.
+
+    The checkpoint is validated before anything is changed: the integrator of the Context must be of the
+    same class as the saved one and define exactly the same global and per-DOF variables (integrators of
+    one class constructed with different options, for example with and without `monitor_heat`, differ),
+    and the System must have the same number of particles and global parameters.
+
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+        The Context to restore. It must have been created with a new instance of the integrator class that
+        was saved.
+    file : str or file
+        The file name or open binary file to read from.
+
+    Raises
+    ------
+    ValueError
+        If the checkpoint does not match the Context or its integrator.
+
+    """
+    integrator = context.getIntegrator()
+    global_variables, per_dof_variables = _get_integrator_variables(integrator)
+    nparticles = context.getSystem().getNumParticles()
+    parameter_names = sorted(context.getState(getParameters=True).getParameters().keys())
+
+    with numpy.load(file, allow_pickle=False) as checkpoint:
+        checkpoint = {key: checkpoint[key] for key in checkpoint.files}
+
+    integrator_class = str(checkpoint['integrator_class'])
+    if integrator_class != _integrator_class_name(integrator):
+        raise ValueError("The checkpoint was saved with a %s, not a %s."
+                         % (integrator_class, _integrator_class_name(integrator)))
+    for kind, names, saved_names in [('global', global_variables.keys(), checkpoint['global_names']),
+                                     ('per-DOF', per_dof_variables.keys(), checkpoint['per_dof_names']),
+                                     ('context parameter', parameter_names, checkpoint['parameter_names'])]:
+        if sorted(names) != list(saved_names):
+            raise ValueError("The checkpoint has %s variables %s, but the Context has %s."
+                             % (kind, list(saved_names), sorted(names)))
+    if checkpoint['positions'].shape != (nparticles, 3):
+        raise ValueError("The checkpoint has %d particles, but the System has %d."
+                         % (checkpoint['positions'].shape[0], nparticles))
+
+    context.setPeriodicBoxVectors(*[mm.Vec3(*vector) for vector in checkpoint['box_vectors']])
+    context.setPositions(checkpoint['positions'])
+    context.setVelocities(checkpoint['velocities'])
+    context.setTime(float(checkpoint['time']))
+    context.setStepCount(int(checkpoint['step_count']))
+    for name, value in zip(checkpoint['parameter_names'], checkpoint['parameter_values']):
+        context.setParameter(str(name), value)
+    # Set before the variables, which would otherwise be marked as stale by thermostated integrators.
+    integrator.setStepSize(float(checkpoint['timestep']))
+    _set_integrator_variables(integrator,
+                              dict(zip(checkpoint['global_names'], checkpoint['global_values'])),
+                              dict(zip(checkpoint['per_dof_names'], checkpoint['per_dof_values'])))
+
+
+def _integrator_class_name(integrator):
+    """Return the fully qualified class name of an integrator."""
+    return '%s.%s' % (integrator.__class__.__module__, integrator.__class__.__name__)
@@ -71,10 +71,21 @@ class MTSIntegrator(CustomIntegrator):
         CustomIntegrator.__init__(self, dt)
         self.addPerDofVariable("x1", 0)
         self.addUpdateContextState();
+        self._createSubstepSizes(groups)
         self._createSubsteps(1, groups)
         self.addConstrainVelocities();
-            
+
+    def _createSubstepSizes(self, groups):
+        """Add a global variable mts_hN holding the step size of each level N, where N=1 is the innermost level."""
+        for level in range(1, len(groups)+1):
+            substeps = groups[len(groups)-level][1]
+            self.addGlobalVariable("mts_h"+str(level), 0)
+            self.addComputeGlobal("mts_h"+str(level), "dt/"+str(substeps))
+
     def _createSubsteps(self, parentSubsteps, groups):
+        # Each level is a loop over its substeps within one substep of the parent level.  The closing
+        # half kick of a substep and the opening half kick of the next one are merged into a single kick,
+        # so the program size grows linearly with the number of levels.
         group, substeps = groups[0]
         stepsPerParentStep = substeps/parentSubsteps
         if stepsPerParentStep < 1 or stepsPerParentStep != int(stepsPerParentStep):
@@ -82,13 +93,30 @@ class MTSIntegrator(CustomIntegrator):
         stepsPerParentStep = int(stepsPerParentStep) # needed for Python 3.x
         if group < 0 or group > 31:
             raise ValueError("Force group must be between 0 and 31")
-        for i in range(stepsPerParentStep):
-            self.addComputePerDof("v", "v+0.5*(dt/"+str(substeps)+")*f"+str(group)+"/m")
-            if len(groups) == 1:
-                self.addComputePerDof("x1", "x")
-                self.addComputePerDof("x", "x+(dt/"+str(substeps)+")*v")
-                self.addConstrainPositions();
-                self.addComputePerDof("v", "(x-x1)/(dt/"+str(substeps)+")");
-            else:
-                self._createSubsteps(substeps, groups[1:])
-            self.addComputePerDof("v", "v+0.5*(dt/"+str(substeps)+")*f"+str(group)+"/m")
+        level = str(len(groups))
+        if stepsPerParentStep == 1:
+            self._createKick(group, "0.5*mts_h"+level)
+        else:
+            self.addGlobalVariable("mts_i"+level, 0)
+            self.addComputeGlobal("mts_i"+level, "0")
+            self.beginWhileBlock("mts_i"+level+" < "+str(stepsPerParentStep))
+            self._createKick(group, "(1-0.5*delta(mts_i"+level+"))*mts_h"+level)
+        if len(groups) == 1:
+            self._createInnermostStep(substeps)
+        else:
+            self._createSubsteps(substeps, groups[1:])
+        if stepsPerParentStep != 1:
+            self.addComputeGlobal("mts_i"+level, "mts_i"+level+"+1")
+            self.endBlock()
+        self._createKick(group, "0.5*mts_h"+level)
+
+    def _createKick(self, group, stepSize):
+        """Add a velocity update from the forces of a force group over a time given by the expression stepSize."""
+        self.addComputePerDof("v", "v+("+stepSize+")*f"+str(group)+"/m")
+
+    def _createInnermostStep(self, substeps):
+        """Add the position update of the innermost level, which takes substeps steps per time step."""
+        self.addComputePerDof("x1", "x")
+        self.addComputePerDof("x", "x+mts_h1*v")
+        self.addConstrainPositions();
+        self.addComputePerDof("v", "(x-x1)/mts_h1");
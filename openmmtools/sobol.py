@@ -8,6 +8,7 @@ See mit_license.txt for license information.
 
 import math
 from six.moves import xrange
+import numpy as np
 from numpy import *
 
 def i4_bit_hi1 ( n ):
@@ -162,11 +163,25 @@ def i4_sobol_generate ( m, n, skip ):
 #    Input, integer SKIP, the number of initial points to skip.
 #
 #    Output, real R(M,N), the points.
+#
+#  Discussion:
+#
+#    The points are generated in bulk with SobolSequence, which gives the same
+#    values as repeated calls to I4_SOBOL without touching its global state.
 #
         r=zeros((m,n))
-        for j in xrange (1, n+1):
-                seed = skip + j - 2
-                [ r[0:m,j-1], seed ] = i4_sobol ( m, seed )
+#
+#       I4_SOBOL treats negative seeds as 0, which yields the origin.
+#
+        nnegative = 1 - skip
+        if ( nnegative < 0 ):
+                nnegative = 0
+        if ( nnegative > n ):
+                nnegative = n
+        first = skip - 1
+        if ( first < 0 ):
+                first = 0
+        r[0:m,nnegative:n] = transpose ( SobolSequence ( m, first ).generate ( n - nnegative ) )
         return r
 
 def i4_sobol ( dim_num, seed ):
@@ -436,6 +451,220 @@ def i4_sobol ( dim_num, seed ):
 
         return [ quasi, seed ]
 
+#=============================================================================================
+# Stateful Sobol' sequence generator
+#=============================================================================================
+
+# Initial direction numbers (columns of V) used by i4_sobol, one list per column.
+# Entry k of column j applies to dimension k + first_dim.
+_SOBOL_DIM_MAX = 40
+_SOBOL_LOG_MAX = 30
+_SOBOL_INITIAL_DIRECTIONS = [
+    (0, [1] * 40),
+    (2, [1, 3, 1, 3, 1, 3, 3, 1, 3, 1, 3, 1, 3, 1, 1, 3, 1, 3, 1, 3,
+         1, 3, 3, 1, 3, 1, 3, 1, 3, 1, 1, 3, 1, 3, 1, 3, 1, 3]),
+    (3, [7, 5, 1, 3, 3, 7, 5, 5, 7, 7, 1, 3, 3, 7, 5, 1, 1, 5, 3, 3,
+         1, 7, 5, 1, 3, 3, 7, 5, 1, 1, 5, 7, 7, 5, 1, 3, 3]),
+    (5, [1, 7, 9, 13, 11, 1, 3, 7, 9, 5, 13, 13, 11, 3, 15, 5, 3, 15, 7, 9,
+         13, 9, 1, 11, 7, 5, 15, 1, 15, 11, 5, 3, 1, 7, 9]),
+    (7, [9, 3, 27, 15, 29, 21, 23, 19, 11, 25, 7, 13, 17, 1, 25, 29, 3, 31, 11, 5,
+         23, 27, 19, 21, 5, 1, 17, 13, 7, 15, 9, 31, 9]),
+    (13, [37, 33, 7, 5, 11, 39, 63, 27, 17, 15, 23, 29, 3, 21, 13, 31, 25, 9, 49, 33,
+          19, 29, 11, 19, 27, 15, 25]),
+    (19, [13, 33, 115, 41, 79, 17, 29, 119, 75, 73, 105, 7, 59, 65, 21, 3, 113, 61, 89, 45,
+          107]),
+    (37, [7, 23, 39]),
+    ]
+_SOBOL_POLY = [1, 3, 7, 11, 13, 19, 25, 37, 59, 47, 61, 55, 41, 67, 97, 91, 109, 103, 115, 131,
+               193, 137, 145, 143, 241, 157, 185, 167, 229, 171, 213, 191, 253, 203, 211, 239, 247, 285, 369, 299]
+
+
+def sobol_direction_numbers(dim_num):
+    """Compute the integer direction numbers of the Sobol' sequence used by i4_sobol.
+
+    Parameters
+    ----------
+    dim_num : int
+        The number of spatial dimensions (1 <= dim_num <= 40).
+
+    Returns
+    -------
+    v : numpy.ndarray of int64 with shape (dim_num, 30)
+        v[i, k] is the direction number for bit k of dimension i, already scaled
+        by the appropriate power of two, so that a point is given by the XOR of the
+        direction numbers selected by the Gray code of its index, times 2**-30.
+
+    """
+    if dim_num < 1 or dim_num > _SOBOL_DIM_MAX:
+        raise ValueError("dim_num must satisfy 1 <= dim_num <= %d; got %d" % (_SOBOL_DIM_MAX, dim_num))
+
+    maxcol = _SOBOL_LOG_MAX
+    v = [[0] * maxcol for i in range(_SOBOL_DIM_MAX)]
+    for column, (first_dim, values) in enumerate(_SOBOL_INITIAL_DIRECTIONS):
+        for i, value in enumerate(values):
+            v[first_dim + i][column] = value
+    v[0] = [1] * maxcol
+
+    # Fill the remaining direction numbers with the recurrence of Bratley and Fox.
+    for i in range(1, dim_num):
+        poly = _SOBOL_POLY[i]
+        m = poly.bit_length() - 1  # degree of the primitive polynomial
+        includ = [(poly >> (m - k)) & 1 for k in range(1, m + 1)]
+        for j in range(m, maxcol):
+            newv = v[i][j - m]
+            l = 1
+            for k in range(1, m + 1):
+                l *= 2
+                if includ[k - 1]:
+                    newv ^= l * v[i][j - k]
+            v[i][j] = newv
+
+    # Scale column k by 2**(maxcol - k - 1).
+    v = np.array(v[:dim_num], dtype=np.int64)
+    v <<= np.arange(maxcol - 1, -1, -1, dtype=np.int64)
+    return v
+
+
+class SobolSequence(object):
+    """Stateful generator of the Sobol' low-discrepancy sequence.
+
+    Each instance keeps its own position in the sequence, so independent generators
+    can be used concurrently. The generator can jump to an arbitrary index in
+    O(log n) time and emits points in vectorized chunks, which makes it possible
+    for several workers to produce disjoint slices of the same sequence.
+
+    The points are identical to those produced by i4_sobol, i.e. index 0 is the
+    origin and index n is the point i4_sobol returns for seed n.
+
+    Parameters
+    ----------
+    dim_num : int
+        The number of spatial dimensions (1 <= dim_num <= 40).
+    index : int, optional, default=0
+        The index of the first point to generate.
+
+    Examples
+    --------
+    Generate 1000 three-dimensional points in chunks of 256 points.
+
+    >>> sequence = SobolSequence(3)
+    >>> for chunk in sequence.chunks(1000, chunk_size=256):
+    ...     pass
+
+    Generate the second half of a 2000-point sequence without computing the first half.
+
+    >>> x = SobolSequence(3, index=1000).generate(1000)
+
+    """
+
+    #: The largest index that can be generated.
+    max_index = 2**_SOBOL_LOG_MAX - 1
+
+    def __init__(self, dim_num, index=0):
+        self._directions = sobol_direction_numbers(dim_num)
+        self._recipd = 1.0 / 2**_SOBOL_LOG_MAX
+        self.skip_to(index)
+
+    @property
+    def dim_num(self):
+        """The number of spatial dimensions."""
+        return self._directions.shape[0]
+
+    @property
+    def index(self):
+        """The index of the next point to be generated."""
+        return self._index
+
+    def skip_to(self, index):
+        """Move the generator to an arbitrary index of the sequence in O(log index) time.
+
+        Parameters
+        ----------
+        index : int
+            The index of the next point to generate.
+
+        """
+        index = int(index)
+        if index < 0 or index > self.max_index:
+            raise ValueError("index must satisfy 0 <= index <= %d; got %d" % (self.max_index, index))
+
+        # The integer point at a given index is the XOR of the direction numbers
+        # selected by the bits of the Gray code of the index.
+        gray = index ^ (index >> 1)
+        state = np.zeros(self.dim_num, dtype=np.int64)
+        k = 0
+        while gray:
+            if gray & 1:
+                state ^= self._directions[:, k]
+            gray >>= 1
+            k += 1
+
+        self._index = index
+        self._state = state
+
+    def generate(self, n):
+        """Generate the next n points of the sequence and advance the generator.
+
+        Parameters
+        ----------
+        n : int
+            The number of points to generate.
+
+        Returns
+        -------
+        x : numpy.ndarray with shape (n, dim_num)
+            The points, each in [0,1)^dim_num.
+
+        """
+        n = int(n)
+        if n < 0:
+            raise ValueError("n must be non-negative; got %d" % n)
+        if self._index + n - 1 > self.max_index:
+            raise ValueError("Cannot generate beyond index %d" % self.max_index)
+
+        # Point i+1 is point i XORed with the direction number of the lowest
+        # zero bit of i, so a chunk is a cumulative XOR of direction numbers.
+        indices = np.arange(self._index + 1, self._index + n, dtype=np.int64)
+        lowest_bit = np.frexp((indices & -indices).astype(np.float64))[1] - 1
+        steps = np.empty((n, self.dim_num), dtype=np.int64)
+        steps[:1] = self._state
+        steps[1:] = self._directions[:, lowest_bit].T
+        points = np.bitwise_xor.accumulate(steps, axis=0)
+
+        if n > 0:
+            self._state = points[-1] ^ self._directions[:, self._lowest_zero_bit(self._index + n - 1)]
+            self._index += n
+        return points * self._recipd
+
+    def chunks(self, n, chunk_size=65536):
+        """Iterate over the next n points of the sequence in chunks of bounded size.
+
+        Parameters
+        ----------
+        n : int
+            The total number of points to generate.
+        chunk_size : int, optional, default=65536
+            The maximum number of points in each chunk.
+
+        Yields
+        ------
+        x : numpy.ndarray with shape (chunk_size, dim_num)
+            The next chunk of points; the last chunk may be shorter.
+
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive; got %d" % chunk_size)
+        while n > 0:
+            size = chunk_size if n > chunk_size else n
+            yield self.generate(size)
+            n -= size
+
+    @staticmethod
+    def _lowest_zero_bit(i):
+        """Return the (zero-based) position of the lowest zero bit of i."""
+        return ((i + 1) & -(i + 1)).bit_length() - 1
+
+
 def i4_uniform ( a, b, seed ):
 
 #*****************************************************************************80
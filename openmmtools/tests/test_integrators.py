@@ -13,7 +13,10 @@ Test custom integrators.
 # GLOBAL IMPORTS
 #=============================================================================================
 
+import os
 import re
+import shutil
+import tempfile
 import numpy
 
 from simtk import unit
@@ -26,6 +29,9 @@ from openmmtools import integrators, testsystems
 
 kB = unit.BOLTZMANN_CONSTANT_kB * unit.AVOGADRO_CONSTANT_NA
 
+# Integrators that do not support constraints when constructed with default arguments.
+UNCONSTRAINED_INTEGRATORS = ['BussiVelocityVerletIntegrator', 'IsokineticMTSIntegrator', 'NoseHooverChainVelocityVerletIntegrator']
+
 #=============================================================================================
 # UTILITY SUBROUTINES
 #=============================================================================================
@@ -50,7 +56,7 @@ def check_stability(integrator, test, platform=None, nsteps=100, temperature=300
    else:
       context = openmm.Context(test.system, integrator)
    context.setPositions(test.positions)
-   context.setVelocitiesToTemperature(temperature) # TODO: Make deterministic.
+   testsystems.set_subrandom_velocities(context, temperature)
  
    # Set integrator temperature
    if hasattr(integrator, 'setTemperature'):
@@ -93,13 +99,17 @@ def test_stabilities_alanine_dipeptide():
 
    """
    test = testsystems.AlanineDipeptideImplicit()
+   unconstrained_test = testsystems.AlanineDipeptideImplicit(constraints=None)
 
    for methodname in dir(integrators):
       if re.match('.*Integrator$', methodname):
          integrator = getattr(integrators, methodname)()
          integrator.__doc__ = methodname
          check_stability.description = "Testing %s for stability over a short number of integration steps of alanine dipeptide in implicit solvent." % methodname
-         yield check_stability, integrator, test
+         if methodname in UNCONSTRAINED_INTEGRATORS:
+            yield check_stability, integrator, unconstrained_test
+         else:
+            yield check_stability, integrator, test
 
 def test_integrator_decorators():
     integrator = integrators.HMCIntegrator(timestep=0.05 * unit.femtoseconds)
@@ -144,4 +154,807 @@ def test_vvvr_shadow_work_accumulation():
    n_globals = integrator.getNumGlobalVariables()
    names_of_globals = [integrator.getGlobalVariableName(i) for i in range(n_globals)]
    assert('shadow_work' not in names_of_globals)
+
+   # The energies of the last step are kept in the same globals as in earlier versions.
+   integrator = integrators.VVVRIntegrator(temperature, monitor_heat=True, monitor_work=True)
+   context = openmm.Context(system, integrator)
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(temperature)
+   integrator.step(1)
+   energies = dict((name, integrator.getGlobalVariableByName(name))
+                   for name in ['kinetic_energy_0', 'kinetic_energy_1', 'kinetic_energy_2', 'kinetic_energy_3',
+                                'energy_before_symplectic', 'energy_after_symplectic', 'heat', 'shadow_work'])
+   heat = (energies['kinetic_energy_1'] - energies['kinetic_energy_0']) + (energies['kinetic_energy_3'] - energies['kinetic_energy_2'])
+   assert abs(energies['heat'] - heat) < 1e-6
+   assert abs(energies['shadow_work'] - (energies['energy_after_symplectic'] - energies['energy_before_symplectic'])) < 1e-6
+   kinetic_energy = context.getState(getEnergy=True).getKineticEnergy() / unit.kilojoules_per_mole
+   assert abs(energies['kinetic_energy_3'] - kinetic_energy) < 1e-6
+   del context, integrator
    
+
+def test_langevin_splitting_heat_and_work():
+   ''' Heat and shadow work are accumulated for any splitting, and shadow work vanishes without a
+   symplectic error (zero timestep). Invalid splittings are rejected. '''
+   testsystem = testsystems.HarmonicOscillator()
+   temperature = 298.0 * unit.kelvin
+   for splitting in ["V R O R V", "O V R V O", "R V O V R", "VRORV"]:
+      integrator = integrators.LangevinSplittingIntegrator(splitting, temperature, monitor_heat=True, monitor_work=True)
+      context = openmm.Context(testsystem.system, integrator)
+      context.setPositions(testsystem.positions)
+      context.setVelocitiesToTemperature(temperature)
+      integrator.step(25)
+      assert(integrator.getGlobalVariableByName('heat') != 0)
+      assert(integrator.getGlobalVariableByName('shadow_work') != 0)
+      del context, integrator
+
+   # With an infinitesimal timestep, all energy changes are heat.
+   integrator = integrators.LangevinSplittingIntegrator("V R O R V", temperature, timestep=1.0e-6 * unit.femtoseconds, monitor_heat=True, monitor_work=True)
+   context = openmm.Context(testsystem.system, integrator)
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(temperature)
+   integrator.step(10)
+   assert(abs(integrator.getGlobalVariableByName('shadow_work')) < 1.0e-4)
+   del context, integrator
+
+   for splitting in ["V O V", "R O R", "V R X R V"]:
+      try:
+         integrators.LangevinSplittingIntegrator(splitting)
+      except ValueError:
+         pass
+      else:
+         raise Exception("Splitting '%s' should have been rejected." % splitting)
+
+def test_langevin_mts_thermostat():
+   ''' LangevinMTSIntegrator with constraints keeps a small molecule near the target temperature
+   for both placements of the stochastic velocity update. '''
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   system = testsystem.system
+   for force in system.getForces():
+      if force.__class__.__name__ == 'NonbondedForce':
+         force.setForceGroup(1)
+   temperature = 300.0 * unit.kelvin
+   ndof = 3*system.getNumParticles() - system.getNumConstraints() - 3  # CMMotionRemover removes 3 dof
+   for thermostat in ['inner', 'outer']:
+      integrator = integrators.LangevinMTSIntegrator(2.0*unit.femtoseconds, [(1,1), (0,4)], temperature,
+                                                     10.0/unit.picoseconds, thermostat=thermostat)
+      context = openmm.Context(system, integrator)
+      context.setPositions(testsystem.positions)
+      context.setVelocitiesToTemperature(temperature)
+      integrator.step(100)
+      temperatures = list()
+      for iteration in range(50):
+         integrator.step(10)
+         kinetic_energy = context.getState(getEnergy=True).getKineticEnergy()
+         temperatures.append((2 * kinetic_energy / (ndof * kB)) / unit.kelvin)
+      assert abs(numpy.mean(temperatures) / (temperature / unit.kelvin) - 1.0) < 0.15
+      del context, integrator
+
+def test_tune_mts_schedule():
+   ''' The MTS tuner reports every schedule and never recommends one that exceeds the drift tolerance. '''
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   groups = testsystems.assign_mts_force_groups(testsystem, bonded_substeps=2, direct_space_substeps=1)
+   schedules = [(1.0*unit.femtoseconds, groups), (20.0*unit.femtoseconds, groups)]
+   best, report = integrators.tune_mts_schedule(testsystem, schedules, platform=openmm.Platform.getPlatformByName('Reference'),
+                                                simulation_time=0.5*unit.picoseconds, nsamples=10)
+   assert len(report) == 2
+   assert report[1]['drift'] > report[0]['drift']
+   assert best is None or best[0] == 1.0*unit.femtoseconds
+   for entry in report:
+      assert entry['seconds_per_ps'] > 0
+
+   # Platforms other than Reference raise an exception for schedules that blow up.
+   schedules = [(1.0*unit.femtoseconds, groups), (100.0*unit.femtoseconds, groups)]
+   best, report = integrators.tune_mts_schedule(testsystem, schedules, platform=openmm.Platform.getPlatformByName('CPU'),
+                                                simulation_time=0.5*unit.picoseconds, nsamples=10)
+   assert report[1]['drift'] == numpy.inf
+   assert best is None or best[0] == 1.0*unit.femtoseconds
+
+   # Schedules must integrate every force group of the System.
+   try:
+      integrators.tune_mts_schedule(testsystem, [(1.0*unit.femtoseconds, groups[:1])])
+   except ValueError:
+      pass
+   else:
+      raise AssertionError('a schedule missing a force group should be rejected')
+
+def test_mts_program_size():
+   ''' The MTS program grows linearly with the number of levels rather than with the number of substeps. '''
+   shallow = integrators.MTSIntegrator(4.0*unit.femtoseconds, [(0,1), (1,2)])
+   deep = integrators.MTSIntegrator(4.0*unit.femtoseconds, [(0,1), (1,4), (2,16), (3,64)])
+   assert deep.getNumComputations() < 3 * shallow.getNumComputations()
+
+   # Deep hierarchies integrate stably.
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   for force in testsystem.system.getForces():
+      force.setForceGroup({'HarmonicBondForce': 3, 'HarmonicAngleForce': 2, 'PeriodicTorsionForce': 1}.get(force.__class__.__name__, 0))
+   check_stability(deep, testsystem)
+
+def test_isokinetic_mts_sampling():
+   ''' IsokineticMTSIntegrator samples the canonical configurational distribution of a harmonic oscillator
+   array, and integrates flexible water stably with a 24 fs outer timestep. '''
+   testsystem = testsystems.HarmonicOscillatorArray()
+   temperature = 298.0 * unit.kelvin
+   kT = kB * temperature
+   integrator = integrators.IsokineticMTSIntegrator(5.0*unit.femtoseconds, [(0,1)], temperature)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(temperature)
+   integrator.step(500)
+   potential_energies = list()
+   for iteration in range(500):
+      integrator.step(10)
+      potential_energies.append(context.getState(getEnergy=True).getPotentialEnergy() / kT)
+   expected = 1.5 * testsystem.system.getNumParticles()
+   assert abs(numpy.mean(potential_energies) / expected - 1.0) < 0.1
+   del context, integrator
+
+   testsystem = testsystems.WaterBox(box_edge=2.0*unit.nanometers, constrained=False)
+   groups = testsystems.assign_mts_force_groups(testsystem, bonded_substeps=48, direct_space_substeps=6, reciprocal_space_substeps=1)
+   integrator = integrators.IsokineticMTSIntegrator(24.0*unit.femtoseconds, groups, temperature)
+   context = openmm.Context(testsystem.system, integrator)
+   context.setPositions(testsystem.positions)
+   openmm.LocalEnergyMinimizer.minimize(context)
+   context.setVelocitiesToTemperature(temperature)
+   integrator.step(20)
+   assert not numpy.isnan(context.getState(getEnergy=True).getPotentialEnergy() / kT)
+
+   # Changing the timestep or collision rate keeps the thermostat variables.
+   v1 = numpy.array(integrator.getPerDofVariableByName('v1'))
+   integrator.setStepSize(12.0*unit.femtoseconds)
+   integrator.setCollisionRate(5.0/unit.picoseconds)
+   assert integrator.getGlobalVariableByName('initialized') == 1
+   assert numpy.all(numpy.array(integrator.getPerDofVariableByName('v1')) == v1)
+   del context, integrator
+
+   # Constrained Systems are rejected without changing the positions.
+   testsystem = testsystems.WaterBox(box_edge=2.0*unit.nanometers)
+   integrator = integrators.IsokineticMTSIntegrator(4.0*unit.femtoseconds, [(0,1)], temperature)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   try:
+      integrator.step(1)
+   except ValueError:
+      pass
+   else:
+      raise AssertionError('IsokineticMTSIntegrator should reject constrained Systems')
+   positions = context.getState(getPositions=True).getPositions(asNumpy=True)
+   assert numpy.all(positions == testsystem.positions)
+
+def test_ghmc_nsteps_partial_momentum_refresh():
+   ''' GHMC with several Verlet steps per trial and partial momentum refresh samples the canonical
+   distribution of a harmonic oscillator array. '''
+   testsystem = testsystems.HarmonicOscillatorArray()
+   temperature = 298.0 * unit.kelvin
+   kT = kB * temperature
+   integrator = integrators.GHMCIntegrator(temperature, timestep=5.0*unit.femtoseconds, nsteps=5, partial_momentum_refresh=0.5)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(temperature)
+   integrator.step(200)
+   potential_energies = list()
+   for iteration in range(400):
+      integrator.step(2)
+      potential_energies.append(context.getState(getEnergy=True).getPotentialEnergy() / kT)
+   expected = 1.5 * testsystem.system.getNumParticles()
+   assert abs(numpy.mean(potential_energies) / expected - 1.0) < 0.1
+   naccept = integrator.getGlobalVariableByName('naccept')
+   assert 0 < naccept < integrator.getGlobalVariableByName('ntrials')
+
+   try:
+      integrators.GHMCIntegrator(partial_momentum_refresh=1.5)
+   except ValueError:
+      pass
+   else:
+      raise Exception("Invalid partial momentum refresh should have been rejected.")
+
+def test_lean_integrators():
+   ''' Lean integrators allocate fewer per-DOF variables and integrate constrained systems identically. '''
+   memory = integrators.estimate_per_dof_memory(integrators.GHMCIntegrator(), 1000, precision='single')
+   assert memory == {'sigma': 12000, 'vold': 12000, 'xold': 12000, 'x1': 12000}
+   assert sorted(integrators.estimate_per_dof_memory(integrators.GHMCIntegrator(lean=True), 1000)) == ['vold', 'xold']
+   assert sorted(integrators.estimate_per_dof_memory(integrators.HMCIntegrator(lean=True), 1000)) == ['xold']
+   assert integrators.estimate_per_dof_memory(integrators.VVVRIntegrator(lean=True), 1000) == {}
+
+   # Without velocity randomization, standard and lean GHMC integrate along the same trajectory.  The very high
+   # integrator temperature makes every trial accepted, since the random streams of the two programs differ.
+   testsystem = testsystems.AlanineDipeptideImplicit()
+   temperature = 300.0 * unit.kelvin
+   positions = list()
+   for lean in [False, True]:
+      integrator = integrators.GHMCIntegrator(1.0e8*unit.kelvin, timestep=0.5*unit.femtoseconds, nsteps=4, partial_momentum_refresh=0.0, lean=lean)
+      context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+      context.setPositions(testsystem.positions)
+      context.setVelocitiesToTemperature(temperature, 1)
+      integrator.step(10)
+      positions.append(context.getState(getPositions=True).getPositions(asNumpy=True) / unit.nanometers)
+      if lean:
+         assert integrator.getGlobalVariableByName('has_constraints') == 1
+      del context, integrator
+   assert numpy.allclose(positions[0], positions[1], atol=1e-8)
+
+   # Without constraints, lean GHMC does not recompute the velocities from positions, and integrates exactly like
+   # the standard integrator.  Lean HMC detects the absence of constraints in the same way.
+   testsystem = testsystems.AlanineDipeptideImplicit(constraints=None)
+   positions = list()
+   for lean in [False, True]:
+      integrator = integrators.GHMCIntegrator(1.0e8*unit.kelvin, timestep=0.5*unit.femtoseconds, nsteps=4, partial_momentum_refresh=0.0, lean=lean)
+      context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+      context.setPositions(testsystem.positions)
+      context.setVelocitiesToTemperature(temperature, 1)
+      integrator.step(10)
+      positions.append(context.getState(getPositions=True).getPositions(asNumpy=True) / unit.nanometers)
+      if lean:
+         assert integrator.getGlobalVariableByName('has_constraints') == 0
+      del context, integrator
+   assert numpy.all(positions[0] == positions[1])
+   integrator = integrators.HMCIntegrator(temperature, lean=True)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   integrator.step(1)
+   assert integrator.getGlobalVariableByName('has_constraints') == 0
+   # The detection runs once, not at every trial.
+   integrator.setGlobalVariableByName('has_constraints', 1)
+   integrator.step(1)
+   assert integrator.getGlobalVariableByName('has_constraints') == 1
+   del context, integrator
+
+   # Lean Langevin integrators only recompute the velocities from positions if the System has constraints.  The
+   # random streams of the two programs differ, so the trajectories are compared without collisions.
+   for testsystem, has_constraints in [(testsystems.AlanineDipeptideImplicit(), 1),
+                                       (testsystems.AlanineDipeptideImplicit(constraints=None), 0)]:
+      positions = list()
+      for lean in [False, True]:
+         integrator = integrators.VVVRIntegrator(temperature, 0.0/unit.picoseconds, 0.5*unit.femtoseconds, lean=lean)
+         context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+         context.setPositions(testsystem.positions)
+         context.setVelocitiesToTemperature(temperature, 1)
+         integrator.step(10)
+         positions.append(context.getState(getPositions=True).getPositions(asNumpy=True) / unit.nanometers)
+         if lean:
+            assert integrator.getGlobalVariableByName('has_constraints') == has_constraints
+         del context, integrator
+      assert numpy.allclose(positions[0], positions[1], atol=1e-8)
+
+def test_thermostated_integrators_set_temperature():
+   ''' Changing the temperature or collision rate of a thermostated integrator recomputes its precomputed
+   quantities without rebuilding it. '''
+   for integrator in [integrators.AndersenVelocityVerletIntegrator(), integrators.MetropolisMonteCarloIntegrator(),
+                      integrators.HMCIntegrator(), integrators.GHMCIntegrator(), integrators.VVVRIntegrator(),
+                      integrators.LangevinMTSIntegrator(), integrators.IsokineticMTSIntegrator()]:
+      integrator.setTemperature(350.0 * unit.kelvin)
+      assert abs(integrator.getTemperature() / unit.kelvin - 350.0) < 1e-6
+
+   # Lean variants and overdamped integrators, which may have no initialization block.
+   testsystem = testsystems.HarmonicOscillatorArray()
+   for integrator in [integrators.HMCIntegrator(lean=True), integrators.GHMCIntegrator(lean=True),
+                      integrators.VVVRIntegrator(lean=True), integrators.BrownianDynamicsIntegrator(),
+                      integrators.MALAIntegrator()]:
+      integrator.setTemperature(350.0 * unit.kelvin)
+      context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+      context.setPositions(testsystem.positions)
+      integrator.step(1)
+      integrator.setTemperature(300.0 * unit.kelvin)
+      integrator.step(1)
+      assert abs(integrator.getTemperature() / unit.kelvin - 300.0) < 1e-6
+      del context, integrator
+
+   testsystem = testsystems.HarmonicOscillatorArray()
+   integrator = integrators.VVVRIntegrator(300.0*unit.kelvin, 5.0/unit.picoseconds, 1.0*unit.femtoseconds)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   integrator.step(1)
+   assert integrator.getGlobalVariableByName('initialized') == 1
+   assert abs(integrator.getGlobalVariableByName('a') - numpy.exp(-5.0e-3 / 2)) < 1e-12
+   integrator.setCollisionRate(50.0 / unit.picoseconds)
+   assert integrator.getGlobalVariableByName('initialized') == 0
+   integrator.step(1)
+   assert abs(integrator.getGlobalVariableByName('a') - numpy.exp(-5.0e-2 / 2)) < 1e-12
+   integrator.setStepSize(2.0 * unit.femtoseconds)
+   integrator.step(1)
+   assert abs(integrator.getGlobalVariableByName('a') - numpy.exp(-1.0e-1 / 2)) < 1e-12
+   del context, integrator
+
+   # GHMC samples the new temperature after it is changed.
+   temperature = 600.0 * unit.kelvin
+   integrator = integrators.GHMCIntegrator(300.0*unit.kelvin, timestep=5.0*unit.femtoseconds, nsteps=5)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   integrator.step(10)
+   integrator.setTemperature(temperature)
+   assert integrator.getGlobalVariableByName('ntrials') == 0
+   integrator.step(200)
+   potential_energies = list()
+   for iteration in range(400):
+      integrator.step(2)
+      potential_energies.append(context.getState(getEnergy=True).getPotentialEnergy() / (kB * temperature))
+   expected = 1.5 * testsystem.system.getNumParticles()
+   assert abs(numpy.mean(potential_energies) / expected - 1.0) < 0.1
+
+def test_hmc_timestep_adaptation():
+   ''' HMC adapts its timestep toward the target acceptance rate during warm-up and then freezes it. '''
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   temperature = 300.0 * unit.kelvin
+   for initial_timestep in [0.1*unit.femtoseconds, 10.0*unit.femtoseconds]:
+      integrator = integrators.HMCIntegrator(temperature, nsteps=10, timestep=initial_timestep, target_acceptance_rate=0.7, adaptation_trials=300)
+      context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+      context.setPositions(testsystem.positions)
+      integrator.step(300)
+      assert integrator.getGlobalVariableByName('nadapt') == 300
+      timestep = integrator.getStepSize()
+      naccept = integrator.n_accept
+      integrator.step(500)
+      assert integrator.getStepSize() == timestep
+      acceptance_rate = (integrator.n_accept - naccept) / 500.0
+      assert abs(acceptance_rate - 0.7) < 0.15
+      del context, integrator
+
+   # Without a target acceptance rate, there is no adaptation to reset.
+   try:
+      integrators.HMCIntegrator(temperature).resetAdaptation()
+   except ValueError:
+      pass
+   else:
+      raise Exception("resetAdaptation() should have been rejected without timestep adaptation.")
+
+def test_metropolis_molecule_moves():
+   ''' Metropolis Monte Carlo moves of single particles or molecules keep a reasonable acceptance rate. '''
+   temperature = 300.0 * unit.kelvin
+   sigma = 1.0 * unit.angstroms
+   testsystem = testsystems.LennardJonesFluid()
+   nparticles = testsystem.system.getNumParticles()
+   acceptance_rates = list()
+   for molecules in [None, [[particle] for particle in range(nparticles)]]:
+      integrator = integrators.MetropolisMonteCarloIntegrator(temperature, sigma, molecules=molecules)
+      context = openmm.Context(testsystem.system, integrator)
+      context.setPositions(testsystem.positions)
+      integrator.step(200)
+      acceptance_rates.append(integrator.getGlobalVariableByName('naccept') / 200.0)
+      del context, integrator
+   assert acceptance_rates[0] < 0.1
+   assert acceptance_rates[1] > 0.5
+
+   # Rigid molecule translations preserve the intramolecular distances of water.
+   testsystem = testsystems.WaterBox(box_edge=2.0*unit.nanometers)
+   molecules = [[atom.index for atom in residue.atoms()] for residue in testsystem.topology.residues()]
+   integrator = integrators.MetropolisMonteCarloIntegrator(temperature, 0.1*unit.angstroms, molecules=molecules, groups=[0])
+   context = openmm.Context(testsystem.system, integrator)
+   context.setPositions(testsystem.positions)
+   initial_positions = numpy.array(testsystem.positions / unit.nanometers)
+   integrator.step(200)
+   assert 0.2 < integrator.getGlobalVariableByName('naccept') / 200.0 < 0.9
+   positions = context.getState(getPositions=True).getPositions(asNumpy=True) / unit.nanometers
+   for index in range(testsystem.system.getNumConstraints()):
+      i, j, distance = testsystem.system.getConstraintParameters(index)
+      initial_distance = numpy.linalg.norm(initial_positions[i] - initial_positions[j])
+      assert abs(numpy.linalg.norm(positions[i] - positions[j]) - initial_distance) < 1e-5
+   del context, integrator
+
+   for molecules in [[[0, 1], [1, 2]], [[-1, 0], [1]], [[0, 2], [3]]]:
+      try:
+         integrators.MetropolisMonteCarloIntegrator(molecules=molecules)
+      except ValueError:
+         pass
+      else:
+         raise Exception("Overlapping, negative or missing particle indices should have been rejected.")
+
+def test_bussi_velocity_rescaling():
+   ''' Stochastic velocity rescaling samples the canonical kinetic energy distribution and accounts for the heat. '''
+   testsystem = testsystems.HarmonicOscillatorArray()
+   temperature = 298.0 * unit.kelvin
+   kT = kB * temperature
+   integrator = integrators.BussiVelocityVerletIntegrator(temperature, 10.0/unit.picoseconds, 1.0*unit.femtoseconds, monitor_heat=True)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(2 * temperature)
+   state = context.getState(getEnergy=True)
+   initial_energy = state.getKineticEnergy() + state.getPotentialEnergy()
+   integrator.step(1000)
+   state = context.getState(getEnergy=True)
+   final_energy = state.getKineticEnergy() + state.getPotentialEnergy()
+   heat = integrator.getGlobalVariableByName('heat') * unit.kilojoules_per_mole
+   assert abs(final_energy - initial_energy - heat) / kT < 0.05
+   assert integrator.getGlobalVariableByName('ndof') == 3 * testsystem.system.getNumParticles()
+
+   integrator.setStepSize(10.0 * unit.femtoseconds)
+   kinetic_energies = list()
+   for iteration in range(1000):
+      integrator.step(5)
+      kinetic_energies.append(context.getState(getEnergy=True).getKineticEnergy() / kT)
+   expected = 1.5 * testsystem.system.getNumParticles()
+   assert abs(numpy.mean(kinetic_energies) / expected - 1.0) < 0.1
+   del context, integrator
+
+   # Counting the degrees of freedom requires a System without constraints; otherwise ndof must be given.
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   integrator = integrators.BussiVelocityVerletIntegrator(temperature)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(temperature, 1)
+   try:
+      integrator.step(1)
+   except ValueError:
+      pass
+   else:
+      raise AssertionError('counting the degrees of freedom of a constrained System should have been rejected')
+   del context, integrator
+
+   ndof = integrators.count_degrees_of_freedom(testsystem.system)
+   assert ndof == 3 * testsystem.system.getNumParticles() - testsystem.system.getNumConstraints() - 3
+   integrator = integrators.BussiVelocityVerletIntegrator(temperature, timestep=1.0*unit.femtoseconds, ndof=ndof)
+   integrator.setRandomNumberSeed(1)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(temperature, 1)
+   integrator.step(100)
+   kinetic_energies = list()
+   for iteration in range(500):
+      integrator.step(5)
+      kinetic_energies.append(context.getState(getEnergy=True).getKineticEnergy() / kT)
+   assert abs(2 * numpy.mean(kinetic_energies) / ndof - 1.0) < 0.1
+
+def test_nose_hoover_chain():
+   ''' The Nose-Hoover chain integrator is deterministic, conserves the extended energy, and thermostats a constrained system. '''
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   temperature = 300.0 * unit.kelvin
+   kT = kB * temperature
+   ndof = integrators.count_degrees_of_freedom(testsystem.system)
+   positions = list()
+   for order in [3, 3, 5]:
+      integrator = integrators.NoseHooverChainVelocityVerletIntegrator(temperature, 1.0*unit.femtoseconds, chain_length=4, yoshida_order=order, ndof=ndof)
+      context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+      context.setPositions(testsystem.positions)
+      context.setVelocitiesToTemperature(temperature, 1)
+      context.applyVelocityConstraints(1e-8)
+      total_energies = list()
+      kinetic_energies = list()
+      for iteration in range(100):
+         integrator.step(50)
+         state = context.getState(getEnergy=True)
+         thermostat_energy = integrator.getGlobalVariableByName('thermostat_energy') * unit.kilojoules_per_mole
+         total_energies.append((state.getKineticEnergy() + state.getPotentialEnergy() + thermostat_energy) / kT)
+         kinetic_energies.append(state.getKineticEnergy() / kT)
+      assert numpy.std(total_energies) < 0.2
+      assert abs(2 * numpy.mean(kinetic_energies) / ndof - 1.0) < 0.1
+      positions.append(context.getState(getPositions=True).getPositions(asNumpy=True) / unit.nanometers)
+      del context, integrator
+   assert numpy.all(positions[0] == positions[1])
+
+   try:
+      integrators.NoseHooverChainVelocityVerletIntegrator(yoshida_order=4)
+   except ValueError:
+      pass
+   else:
+      raise Exception("Invalid Suzuki-Yoshida order should have been rejected.")
+
+def test_metropolized_langevin_splitting():
+   ''' Metropolizing BAOAB with the shadow work removes its kinetic energy error at a large timestep. '''
+   testsystem = testsystems.HarmonicOscillatorArray()
+   temperature = 298.0 * unit.kelvin
+   kT = kB * temperature
+   integrator = integrators.MetropolizedLangevinSplittingIntegrator("V R O R V", temperature, 5.0/unit.picoseconds, 30.0*unit.femtoseconds)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(temperature)
+   integrator.step(500)
+   integrator.resetStatistics()
+   potential_energies = list()
+   kinetic_energies = list()
+   for iteration in range(2000):
+      integrator.step(2)
+      state = context.getState(getEnergy=True)
+      potential_energies.append(state.getPotentialEnergy() / kT)
+      kinetic_energies.append(state.getKineticEnergy() / kT)
+   expected = 1.5 * testsystem.system.getNumParticles()
+   assert abs(numpy.mean(potential_energies) / expected - 1.0) < 0.1
+   assert abs(numpy.mean(kinetic_energies) / expected - 1.0) < 0.1
+   assert 0 < integrator.getGlobalVariableByName('naccept') < integrator.getGlobalVariableByName('ntrials') == 4000
+
+   try:
+      integrators.MetropolizedLangevinSplittingIntegrator("O V R V")
+   except ValueError:
+      pass
+   else:
+      raise Exception("Asymmetric splitting should have been rejected.")
+
+def test_nonequilibrium_switching():
+   ''' Switching the stiffness of a harmonic oscillator inside the integrator gives protocol works that satisfy
+   the Jarzynski equality. '''
+   temperature = 300.0 * unit.kelvin
+   kT = (kB * temperature).value_in_unit(unit.kilojoules_per_mole)
+   K0, K1 = 100.0, 400.0  # spring constants in kJ/mol/nm**2
+   system = openmm.System()
+   system.addParticle(12.0)
+   force = openmm.CustomExternalForce("0.5*K*(x^2 + y^2 + z^2)")
+   force.addGlobalParameter("K", K0)
+   force.addParticle(0, [])
+   system.addForce(force)
+
+   nsteps = 20
+   alchemical_functions = {'K': '%r + %r*protocol_lambda' % (K0, K1 - K0)}
+   integrator = integrators.NonequilibriumLangevinSplittingIntegrator(alchemical_functions, nsteps, temperature=temperature,
+                                                                      collision_rate=5.0/unit.picoseconds, timestep=10.0*unit.femtoseconds)
+   integrator.setRandomNumberSeed(1)
+   context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   random_state = numpy.random.RandomState(0)
+   works = list()
+   for trajectory in range(1000):
+      integrator.resetProtocol()
+      context.setPositions([random_state.normal(0.0, numpy.sqrt(kT / K0), 3)])
+      context.setVelocitiesToTemperature(temperature, trajectory + 1)
+      integrator.step(nsteps)
+      works.append(integrator.protocol_work.value_in_unit(unit.kilojoules_per_mole) / kT)
+   assert context.getParameter('K') == K1
+   assert integrator.getGlobalVariableByName('protocol_lambda') == 1.0
+   free_energy = -numpy.log(numpy.mean(numpy.exp(-numpy.array(works))))
+   assert abs(free_energy - 1.5 * numpy.log(K1 / K0)) < 0.2
+   assert numpy.mean(works) > free_energy
+
+   # Once the protocol is complete, no more work is performed.
+   integrator.step(5)
+   assert integrator.protocol_work.value_in_unit(unit.kilojoules_per_mole) / kT == works[-1]
+
+   # Resetting the protocol also resets the monitored heat and shadow work.
+   integrator = integrators.NonequilibriumLangevinSplittingIntegrator(alchemical_functions, nsteps, temperature=temperature,
+                                                                      monitor_heat=True, monitor_work=True)
+   context = openmm.Context(system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions([[0.1, 0.0, 0.0]])
+   integrator.step(nsteps)
+   assert integrator.getGlobalVariableByName('heat') != 0.0
+   integrator.resetProtocol()
+   for name in ['protocol_work', 'heat', 'shadow_work']:
+      assert integrator.getGlobalVariableByName(name) == 0.0
+   del context, integrator
+
+   # Splittings without an 'H' substep cannot switch the context parameters.
+   try:
+      integrators.NonequilibriumLangevinSplittingIntegrator(alchemical_functions, nsteps, splitting="V R O R V")
+   except ValueError:
+      pass
+   else:
+      raise Exception("A splitting without 'H' substeps should have been rejected.")
+
+def test_minimization_integrators():
+   ''' FIRE and L-BFGS minimize a constrained water box to the force tolerance, and then leave it unchanged. '''
+   testsystem = testsystems.WaterBox(box_edge=2.0*unit.nanometers)
+   force_tolerance = 1.0 * unit.kilojoules_per_mole / unit.nanometers
+   for integrator, max_steps in [(integrators.FIREMinimizationIntegrator(force_tolerance=force_tolerance), 1000),
+                                 (integrators.LBFGSMinimizationIntegrator(force_tolerance=force_tolerance), 500)]:
+      context = openmm.Context(testsystem.system, integrator)
+      context.setPositions(testsystem.positions)
+      initial_energy = context.getState(getEnergy=True).getPotentialEnergy()
+      nsteps = 0
+      while not integrator.getGlobalVariableByName('converged') and nsteps < max_steps:
+         integrator.step(10)
+         nsteps += 10
+      assert integrator.getGlobalVariableByName('converged') == 1
+      assert integrator.getGlobalVariableByName('frms') < force_tolerance / (unit.kilojoules_per_mole / unit.nanometers)
+      state = context.getState(getEnergy=True, getPositions=True)
+      assert state.getPotentialEnergy() < initial_energy
+      integrator.step(10)
+      assert numpy.all(context.getState(getPositions=True).getPositions(asNumpy=True) == state.getPositions(asNumpy=True))
+      del context, integrator
+
+def test_brownian_and_mala():
+   ''' Brownian dynamics samples a harmonic oscillator array accurately at a small timestep, and MALA removes its
+   timestep error at a large timestep. '''
+   testsystem = testsystems.HarmonicOscillatorArray()
+   temperature = 298.0 * unit.kelvin
+   kT = kB * temperature
+   collision_rate = 91.0 / unit.picoseconds
+   expected = 1.5 * testsystem.system.getNumParticles()
+   mean_potential_energies = dict()
+   for name, integrator in [('brownian', integrators.BrownianDynamicsIntegrator(temperature, collision_rate, 5.0*unit.femtoseconds)),
+                            ('brownian-large', integrators.BrownianDynamicsIntegrator(temperature, collision_rate, 100.0*unit.femtoseconds)),
+                            ('mala', integrators.MALAIntegrator(temperature, collision_rate, 100.0*unit.femtoseconds))]:
+      integrator.setRandomNumberSeed(1)
+      context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+      context.setPositions(testsystem.positions)
+      integrator.step(500)
+      potential_energies = list()
+      for iteration in range(2000):
+         integrator.step(3)
+         potential_energies.append(context.getState(getEnergy=True).getPotentialEnergy() / kT)
+      mean_potential_energies[name] = numpy.mean(potential_energies) / expected
+      if name == 'mala':
+         assert 0 < integrator.acceptance_rate < 1
+         assert integrator.n_trials == 6500
+      del context, integrator
+   assert abs(mean_potential_energies['brownian'] - 1.0) < 0.1
+   assert mean_potential_energies['brownian-large'] > 1.5
+   assert abs(mean_potential_energies['mala'] - 1.0) < 0.1
+
+def test_timestep_ramp():
+   ''' The timestep ramp starts from a small timestep and reaches the production timestep, both for a Langevin
+   integrator started from random positions and for GHMC. '''
+   testsystem = testsystems.LennardJonesFluid(nparticles=100)
+   box_edge = testsystem.system.getDefaultPeriodicBoxVectors()[0][0]
+   positions = box_edge * numpy.random.RandomState(0).uniform(size=(100, 3))
+   timestep = 10.0 * unit.femtoseconds
+   integrator = integrators.VVVRIntegrator(120.0*unit.kelvin, timestep=timestep)
+   integrators.add_timestep_ramp(integrator)
+   assert abs(integrator.getStepSize() / timestep - 0.01) < 1e-8
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(positions)
+   integrator.step(5000)
+   assert integrator.getGlobalVariableByName('ramp_done') == 1
+   assert integrator.getStepSize() == timestep
+   state = context.getState(getEnergy=True)
+   assert numpy.isfinite(state.getPotentialEnergy() / unit.kilojoules_per_mole)
+   assert state.getKineticEnergy() < 3.0 * 1.5 * kB * 120.0 * unit.kelvin * 100
+   del context, integrator
+
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   integrator = integrators.GHMCIntegrator(300.0*unit.kelvin, timestep=2.0*unit.femtoseconds)
+   integrators.add_timestep_ramp(integrator)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   integrator.step(200)
+   assert integrator.getGlobalVariableByName('ramp_done') == 1
+   assert integrator.getGlobalVariableByName('naccept') > 0.5 * integrator.getGlobalVariableByName('ntrials')
+   del context, integrator
+
+   # Overdamped integrators ramp without testing the kinetic temperature of their displacement velocities.
+   for integrator in [integrators.BrownianDynamicsIntegrator(300.0*unit.kelvin, timestep=1.0*unit.femtoseconds),
+                      integrators.MALAIntegrator(300.0*unit.kelvin, timestep=1.0*unit.femtoseconds)]:
+      integrators.add_timestep_ramp(integrator)
+      integrator.setRandomNumberSeed(1)
+      context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+      context.setPositions(testsystem.positions)
+      integrator.step(500)
+      assert integrator.getGlobalVariableByName('ramp_done') == 1
+      del context, integrator
+
+   # The isokinetic thermostat variables are drawn once, not at every step of the ramp.
+   testsystem = testsystems.AlanineDipeptideVacuum(constraints=None)
+   integrator = integrators.IsokineticMTSIntegrator(2.0*unit.femtoseconds, [(0,1)], 300.0*unit.kelvin)
+   integrators.add_timestep_ramp(integrator)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(300.0*unit.kelvin)
+   integrator.step(1)
+   assert integrator.getGlobalVariableByName('ramp_done') == 0
+   assert integrator.getGlobalVariableByName('initialized') == 1
+   del context, integrator
+
+   # Only the quantities that depend on the timestep are recomputed along the ramp, and the constraint detection of
+   # lean integrators runs once.
+   for integrator in [integrators.GHMCIntegrator(300.0*unit.kelvin, timestep=2.0*unit.femtoseconds, lean=True),
+                      integrators.VVVRIntegrator(300.0*unit.kelvin, timestep=2.0*unit.femtoseconds, lean=True)]:
+      integrators.add_timestep_ramp(integrator)
+      context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+      context.setPositions(testsystem.positions)
+      context.setVelocitiesToTemperature(300.0*unit.kelvin)
+      integrator.step(1)
+      assert integrator.getGlobalVariableByName('has_constraints') == 0
+      integrator.setGlobalVariableByName('has_constraints', 1)
+      integrator.step(10)
+      assert integrator.getGlobalVariableByName('ramp_done') == 0
+      assert integrator.getGlobalVariableByName('initialized') == 1
+      assert integrator.getGlobalVariableByName('has_constraints') == 1
+      dt = integrator.getStepSize().value_in_unit(unit.picoseconds)
+      collision_rate = integrator.getGlobalVariableByName('collision_rate')
+      if isinstance(integrator, integrators.GHMCIntegrator):
+         assert abs(integrator.getGlobalVariableByName('b') - numpy.exp(-collision_rate*dt)) < 1e-12
+      else:
+         assert abs(integrator.getGlobalVariableByName('a') - numpy.exp(-collision_rate*dt/2)) < 1e-12
+      del context, integrator
+
+   try:
+      integrators.add_timestep_ramp(integrators.VelocityVerletIntegrator())
+   except ValueError:
+      pass
+   else:
+      raise AssertionError('the timestep ramp requires a thermostated integrator')
+
+def test_run_with_rollback():
+   ''' The rollback driver recovers from a timestep that is too large, and restores integrator variables along
+   with the Context state when it gives up. '''
+   testsystem = testsystems.HarmonicOscillatorArray()
+   timestep = 100.0 * unit.femtoseconds
+   integrator = integrators.VelocityVerletIntegrator(timestep)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   context.setVelocitiesToTemperature(298.0 * unit.kelvin)
+   nrollbacks = integrators.run_with_rollback(context, 1000, checkpoint_interval=500)
+   assert nrollbacks == 2
+   assert integrator.getStepSize() == timestep
+   state = context.getState(getEnergy=True)
+   assert numpy.isfinite(state.getPotentialEnergy() / unit.kilojoules_per_mole)
+   del context, integrator
+
+   integrator = integrators.VVVRIntegrator(298.0*unit.kelvin, timestep=5.0*unit.femtoseconds, monitor_heat=True)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   assert integrators.run_with_rollback(context, 100) == 0
+   heat = integrator.getGlobalVariableByName('heat')
+   positions = context.getState(getPositions=True).getPositions(asNumpy=True)
+   integrator.setStepSize(timestep)
+   try:
+      integrators.run_with_rollback(context, 500, checkpoint_interval=500, max_retries=0)
+   except RuntimeError:
+      pass
+   else:
+      raise AssertionError('the integration should not have been stable')
+   assert integrator.getGlobalVariableByName('heat') == heat
+   assert numpy.all(context.getState(getPositions=True).getPositions(asNumpy=True) == positions)
+   assert integrator.getStepSize() == timestep
+   del context, integrator
+
+   # Timestep changes made by the integrator itself are kept between blocks.
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   timestep = 2.0 * unit.femtoseconds
+   integrator = integrators.VVVRIntegrator(300.0*unit.kelvin, timestep=timestep)
+   integrators.add_timestep_ramp(integrator)
+   context = openmm.Context(testsystem.system, integrator, openmm.Platform.getPlatformByName('Reference'))
+   context.setPositions(testsystem.positions)
+   assert integrators.run_with_rollback(context, 1000, checkpoint_interval=50) == 0
+   assert integrator.getGlobalVariableByName('ramp_done') == 1
+   assert integrator.getStepSize() == timestep
+   del context, integrator
+
+def test_checkpoint():
+   ''' Checkpoints restore the Context state and all integrator variables, and are validated against the
+   integrator. '''
+   testsystem = testsystems.AlanineDipeptideVacuum()
+   temperature = 300.0 * unit.kelvin
+   platform = openmm.Platform.getPlatformByName('Reference')
+   directory = tempfile.mkdtemp()
+   try:
+      filename = os.path.join(directory, 'checkpoint.npz')
+      for integrator_factory in [lambda: integrators.GHMCIntegrator(temperature),
+                                 lambda: integrators.HMCIntegrator(temperature, nsteps=5),
+                                 lambda: integrators.VVVRIntegrator(temperature, monitor_heat=True, monitor_work=True)]:
+         integrator = integrator_factory()
+         context = openmm.Context(testsystem.system, integrator, platform)
+         context.setPositions(testsystem.positions)
+         context.setVelocitiesToTemperature(temperature)
+         integrator.step(20)
+         integrators.save_checkpoint(context, filename)
+         state = context.getState(getPositions=True, getVelocities=True)
+         global_variables, per_dof_variables = integrators._get_integrator_variables(integrator)
+
+         new_integrator = integrator_factory()
+         new_context = openmm.Context(testsystem.system, new_integrator, platform)
+         integrators.load_checkpoint(new_context, filename)
+         new_state = new_context.getState(getPositions=True, getVelocities=True)
+         assert numpy.all(new_state.getPositions(asNumpy=True) == state.getPositions(asNumpy=True))
+         assert numpy.all(new_state.getVelocities(asNumpy=True) == state.getVelocities(asNumpy=True))
+         assert new_state.getTime() == state.getTime()
+         assert new_context.getStepCount() == context.getStepCount() == 20
+         assert new_integrator.getStepSize() == integrator.getStepSize()
+         new_global_variables, new_per_dof_variables = integrators._get_integrator_variables(new_integrator)
+         assert new_global_variables == global_variables
+         for name in per_dof_variables:
+            assert numpy.all(new_per_dof_variables[name] == per_dof_variables[name])
+         new_integrator.step(5)
+         del context, integrator, new_context, new_integrator
+
+      # VVVR checkpoint into a GHMC integrator, and into a VVVR integrator without heat and work accounting.
+      for integrator in [integrators.GHMCIntegrator(temperature), integrators.VVVRIntegrator(temperature)]:
+         context = openmm.Context(testsystem.system, integrator, platform)
+         try:
+            integrators.load_checkpoint(context, filename)
+         except ValueError:
+            pass
+         else:
+            raise AssertionError('the checkpoint should not match %s' % integrator.__class__.__name__)
+         del context, integrator
+
+      # The step size reached by a timestep ramp is restored.
+      integrator = integrators.VVVRIntegrator(temperature, timestep=2.0*unit.femtoseconds)
+      integrators.add_timestep_ramp(integrator)
+      context = openmm.Context(testsystem.system, integrator, platform)
+      context.setPositions(testsystem.positions)
+      integrator.step(200)
+      assert integrator.getGlobalVariableByName('ramp_done') == 1
+      integrators.save_checkpoint(context, filename)
+      new_integrator = integrators.VVVRIntegrator(temperature, timestep=2.0*unit.femtoseconds)
+      integrators.add_timestep_ramp(new_integrator)
+      new_context = openmm.Context(testsystem.system, new_integrator, platform)
+      integrators.load_checkpoint(new_context, filename)
+      assert new_integrator.getStepSize() == 2.0*unit.femtoseconds
+      assert new_integrator.getGlobalVariableByName('ramp_done') == 1
+      assert new_integrator.getGlobalVariableByName('initialized') == integrator.getGlobalVariableByName('initialized')
+      del context, integrator, new_context, new_integrator
+   finally:
+      shutil.rmtree(directory)
@@ -48,6 +48,17 @@ def test_subrandom_particle_positions():
     # Test halton sequence.
     x = testsystems.halton_sequence(2,100)
 
+    # Test scrambled halton sequence.
+    x = testsystems.halton_sequence(2, 100, scramble=True, seed=0)
+    assert np.all((x >= 0) & (x < 1))
+    assert np.all(x == testsystems.halton_sequence(2, 100, scramble=True, seed=0))
+    assert np.any(x != testsystems.halton_sequence(2, 100, scramble=True, seed=1))
+
+    # Test that windows of the sequence continue it.
+    y = np.concatenate([testsystems.halton_sequence(2, 40, scramble=True, seed=0),
+                        testsystems.halton_sequence(2, 60, scramble=True, seed=0, start=40)])
+    assert np.all(x == y)
+
     # Test Sobol.
     from openmmtools import sobol
     x = sobol.i4_sobol_generate(3, 100, 1)
@@ -56,6 +67,140 @@ def test_subrandom_particle_positions():
     nparticles = 216
     box_vectors = openmm.System().getDefaultPeriodicBoxVectors()
     positions = testsystems.subrandom_particle_positions(nparticles, box_vectors)
+    positions = testsystems.subrandom_particle_positions(nparticles, box_vectors, method='halton', seed=0)
+
+def test_subrandom_particle_positions_min_distance():
+    """Testing subrandom particle positions with a minimum separation.
+    """
+    nparticles = 500
+    box_edge = 2.0 * unit.nanometers
+    box_vectors = unit.Quantity(np.eye(3) * box_edge / unit.nanometers, unit.nanometers)
+    min_distance = testsystems.random_packing_distance(nparticles / box_edge**3)
+    for method in ['sobol', 'halton']:
+        positions = testsystems.subrandom_particle_positions(nparticles, box_vectors, method=method, min_distance=min_distance)
+        x = positions / unit.nanometers
+        dx = x[:, np.newaxis, :] - x[np.newaxis, :, :]
+        dx -= (box_edge / unit.nanometers) * np.round(dx / (box_edge / unit.nanometers))
+        distances = np.sqrt((dx**2).sum(axis=2)) + np.diag(np.inf * np.ones(nparticles))
+        assert distances.min() >= (min_distance / unit.nanometers) * (1 - 1e-6)
+
+def test_fluids_avoid_overlaps():
+    """Testing opt-in overlap-free initial placement of dense fluids.
+    """
+    # By default, the positions are the plain subrandom sequence.
+    testsystem = testsystems.LennardJonesFluid(nparticles=500, reduced_density=0.8)
+    positions = testsystems.subrandom_particle_positions(500, testsystem.system.getDefaultPeriodicBoxVectors())
+    assert np.all(testsystem.positions / unit.nanometers == positions / unit.nanometers)
+
+    # With avoid_overlaps, dense fluids start with moderate energies.
+    kT = testsystems.kB * 300.0 * unit.kelvin
+    for testsystem in [testsystems.LennardJonesFluid(nparticles=500, reduced_density=0.8, avoid_overlaps=True),
+                       testsystems.WCAFluid(avoid_overlaps=True),
+                       testsystems.DiatomicFluid(reduced_density=0.4, avoid_overlaps=True),
+                       testsystems.DipolarFluid(reduced_density=0.4, avoid_overlaps=True)]:
+        context = openmm.Context(testsystem.system, openmm.VerletIntegrator(1.0), openmm.Platform.getPlatformByName('Reference'))
+        context.setPositions(testsystem.positions)
+        potential_energy = context.getState(getEnergy=True).getPotentialEnergy()
+        assert potential_energy < testsystem.system.getNumParticles() * kT
+        del context
+
+def test_subrandom_orientations():
+    """Testing subrandom unit vectors, rotations and rigid molecule placement.
+    """
+    vectors = testsystems.subrandom_unit_vectors(1000)
+    assert np.allclose(np.sqrt((vectors**2).sum(axis=1)), 1.0)
+    assert np.all(np.abs(vectors.mean(axis=0)) < 0.01)
+
+    rotations = testsystems.subrandom_rotation_matrices(1000)
+    assert np.allclose(np.einsum('nij,nkj->nik', rotations, rotations), np.eye(3))
+    assert np.allclose(np.linalg.det(rotations), 1.0)
+
+    box_vectors = openmm.System().getDefaultPeriodicBoxVectors()
+    template = unit.Quantity(np.array([[0.5, 0.0, 0.0], [-0.5, 0.0, 0.0]]), unit.angstroms)
+    positions = testsystems.subrandom_molecule_positions(100, box_vectors, template, min_distance=1.0*unit.angstroms)
+    x = positions / unit.angstroms
+    assert x.shape == (200, 3)
+    assert np.allclose(np.sqrt(((x[0::2] - x[1::2])**2).sum(axis=1)), 1.0, atol=1e-4)
+
+def test_subrandom_velocities():
+    """Testing low-discrepancy Maxwell-Boltzmann velocities.
+    """
+    testsystem = testsystems.HarmonicOscillatorArray()
+    system = testsystem.system
+    temperature = 300.0 * unit.kelvin
+    kT = testsystems.kB * temperature
+    nsamples = 128
+    velocities = testsystems.subrandom_velocities(system, temperature, nsamples=nsamples)
+    assert velocities.shape == (nsamples, system.getNumParticles(), 3)
+
+    # The mean kinetic energy converges faster than for pseudorandom velocities.
+    masses = np.array([system.getParticleMass(i) / unit.amu for i in range(system.getNumParticles())])
+    v = velocities / (unit.nanometers / unit.picoseconds)
+    kinetic_energies = 0.5 * (masses[np.newaxis, :, np.newaxis] * v**2).sum(axis=(1, 2))
+    expected = 1.5 * system.getNumParticles() * (kT / unit.kilojoules_per_mole)
+    assert abs(kinetic_energies.mean() / expected - 1.0) < 0.02
+
+    # Consecutive samples can be generated independently.
+    v3 = testsystems.subrandom_velocities(system, temperature, nsamples=1, start=3)
+    assert np.allclose(v3[0] / (unit.nanometers / unit.picoseconds), v[3])
+
+    # Large systems are cheap, and each sample has the right temperature across particles.
+    system = testsystems.LennardJonesFluid(nparticles=1000).system
+    masses = np.array([system.getParticleMass(i) / unit.amu for i in range(system.getNumParticles())])
+    expected = 1.5 * system.getNumParticles() * (kT / unit.kilojoules_per_mole)
+    for method in ['sobol', 'halton']:
+        v = testsystems.subrandom_velocities(system, temperature, nsamples=4, method=method) / (unit.nanometers / unit.picoseconds)
+        kinetic_energies = 0.5 * (masses[np.newaxis, :, np.newaxis] * v**2).sum(axis=(1, 2))
+        assert np.all(np.abs(kinetic_energies / expected - 1.0) < 0.1)
+
+def test_sobol_sequence():
+    """Testing skip-ahead and chunked generation of the Sobol' sequence.
+    """
+    from openmmtools import sobol
+    reference = sobol.i4_sobol_generate(3, 1000, 1).T
+
+    # Chunked generation reproduces the whole sequence.
+    sequence = sobol.SobolSequence(3)
+    x = np.concatenate(list(sequence.chunks(1000, chunk_size=128)))
+    assert np.all(x == reference)
+    assert sequence.index == 1000
+
+    # Skipping ahead yields the same slice as generating from the start.
+    x = sobol.SobolSequence(3, index=613).generate(200)
+    assert np.all(x == reference[613:813])
+
+def test_assign_mts_force_groups():
+    """Testing partitioning of forces into multiple timestep force groups.
+    """
+    testsystem = testsystems.WaterBox(constrained=False)
+    groups = testsystems.assign_mts_force_groups(testsystem, bonded_substeps=4, direct_space_substeps=2, reciprocal_space_substeps=1)
+    assert groups == [(2, 1), (1, 2), (0, 4)]
+    for force in testsystem.system.getForces():
+        if isinstance(force, openmm.NonbondedForce):
+            assert force.getForceGroup() == 1 and force.getReciprocalSpaceForceGroup() == 2
+        else:
+            assert force.getForceGroup() == 0
+
+    # The total energy is unchanged by the partitioning.
+    integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+    context = openmm.Context(testsystem.system, integrator)
+    context.setPositions(testsystem.positions)
+    total_energy = context.getState(getEnergy=True).getPotentialEnergy() / unit.kilojoules_per_mole
+    group_energies = [context.getState(getEnergy=True, groups=1<<group).getPotentialEnergy() / unit.kilojoules_per_mole for group, substeps in groups]
+    assert np.allclose(sum(group_energies), total_energy, rtol=1e-4)
+    del context, integrator
+
+    # Nonperiodic systems have no reciprocal space group.
+    testsystem = testsystems.AlanineDipeptideImplicit()
+    assert testsystems.assign_mts_force_groups(testsystem) == [(1, 2), (0, 4)]
+
+    # Substeps of faster groups must be multiples of those of slower groups.
+    try:
+        testsystems.assign_mts_force_groups(testsystem, bonded_substeps=3, direct_space_substeps=2)
+    except ValueError:
+        pass
+    else:
+        raise Exception("Incommensurate substeps should have been rejected.")
 
 def check_properties(testsystem):
     class_name = testsystem.__class__.__name__
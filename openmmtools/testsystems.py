@@ -54,6 +54,7 @@ import inspect
 import scipy
 import scipy.special
 import scipy.integrate
+import scipy.spatial
 
 from simtk import openmm
 from simtk import unit
@@ -150,7 +151,7 @@ def get_data_filename(relative_path):
     return fn
 
 
-def halton_sequence(p, n):
+def halton_sequence(p, n, scramble=False, seed=None, start=0):
     """
     Halton deterministic sequence on [0,1].
 
@@ -160,6 +161,15 @@ def halton_sequence(p, n):
        Prime number for sequence.
     n : int
        Sequence length to generate.
+    scramble : bool, optional, default=False
+       If True, each base-p digit position is relabeled with an independent random
+       permutation of the digits (random digit permutation scrambling). The scrambled
+       sequence keeps the low discrepancy of the Halton sequence.
+    seed : int, optional, default=None
+       Seed for the random permutations used when `scramble` is True.
+    start : int, optional, default=0
+       Index of the first element to generate, so that a window of the sequence can be
+       generated without the elements before it.
 
     Returns
     -------
@@ -168,7 +178,8 @@ def halton_sequence(p, n):
 
     Notes
     -----
-    Code source: http://blue.math.buffalo.edu/sauer2py/
+    The j-th element is the radical inverse of start+j+1 in base p, computed for all elements
+    at once one digit at a time, so generating a window costs O(n log(start+n)).
     More info: http://en.wikipedia.org/wiki/Halton_sequence
 
     Examples
@@ -178,24 +189,39 @@ def halton_sequence(p, n):
     >>> y = halton_sequence(3,100)
     >>> z = halton_sequence(5,100)
 
+    Generate two differently scrambled sequences, e.g. for two replicas.
+    >>> x1 = halton_sequence(2, 100, scramble=True, seed=1)
+    >>> x2 = halton_sequence(2, 100, scramble=True, seed=2)
+
+    Continue a sequence where a previous call stopped.
+    >>> x = np.concatenate([halton_sequence(2, 50), halton_sequence(2, 50, start=50)])
+
     """
-    eps = np.finfo(np.double).eps
-    b = np.zeros(np.ceil(np.log(n) / np.log(p)) + 1)   # largest number of digits (adding one for halton_sequence(2,64) corner case)
-    u = np.empty(n)
-    for j in range(n):
-        i = 0
-        b[0] += 1                       # add one to current integer
-        while b[i] > p - 1 + eps:           # this loop does carrying in base p
-            b[i] = 0
-            i = i + 1
-            b[i] += 1
-        u[j] = 0
-        for k in range(len(b)):         # add up reversed digits
-            u[j] += b[k] * p**-(k + 1)
+    indices = np.arange(start + 1, start + n + 1, dtype=np.int64)
+    u = np.zeros(n)
+
+    if scramble:
+        # Scramble enough digits to cover double precision, including the leading zeros.
+        random_state = np.random.RandomState(seed)
+        ndigits = int(np.ceil(53 * np.log(2) / np.log(p)))
+        permutations = [random_state.permutation(p) for k in range(ndigits)]
+    else:
+        # Number of base-p digits of the largest index.
+        ndigits, largest = 1, start + n
+        while largest >= p:
+            largest //= p
+            ndigits += 1
+        permutations = [np.arange(p)] * ndigits
+
+    factor = 1.0 / p
+    for permutation in permutations:
+        indices, digits = np.divmod(indices, p)
+        u += permutation[digits] * factor
+        factor /= p
     return u
 
 
-def subrandom_particle_positions(nparticles, box_vectors, method='sobol'):
+def subrandom_particle_positions(nparticles, box_vectors, method='sobol', seed=None, min_distance=None):
     """Generate a deterministic list of subrandom particle positions.
 
     Parameters
@@ -206,12 +232,26 @@ def subrandom_particle_positions(nparticles, box_vectors, method='sobol'):
         Periodic box vectors in which particles should lie.
     method : str, optional, default='sobol'
         Method for creating subrandom sequence (one of 'halton' or 'sobol')
+    seed : int, optional, default=None
+        If specified, a scrambled Halton sequence seeded with `seed` is used, so that
+        different seeds give different low-discrepancy placements (only for method='halton').
+    min_distance : simtk.unit.Quantity with units compatible with nanometer, optional, default=None
+        If specified, points of the subrandom sequence that lie closer than `min_distance`
+        (under periodic boundary conditions) to an already placed particle are skipped.
+        Candidates are tested in bulk against a periodic k-d tree of the placed particles, so
+        placement takes O(nparticles log nparticles) time.
 
     Returns
     -------
     positions : simtk.unit.Quantity of (natoms,3) with units compatible with nanometer
         The particle positions.
 
+    Notes
+    -----
+    Random sequential placement jams at a packing fraction of about 0.38, so `min_distance`
+    must be chosen well below the mean interparticle spacing for dense systems
+    (see `random_packing_distance`).
+
     Examples
     --------
     >>> nparticles = 216
@@ -224,33 +264,391 @@ def subrandom_particle_positions(nparticles, box_vectors, method='sobol'):
     >>> box_vectors = openmm.System().getDefaultPeriodicBoxVectors()
     >>> positions = subrandom_particle_positions(nparticles, box_vectors, method='halton')
 
+    Use a scrambled halton sequence, e.g. to give each replica a different start:
+
+    >>> positions = subrandom_particle_positions(nparticles, box_vectors, method='halton', seed=1)
+
+    Keep particles at least 3 angstroms apart:
+
+    >>> positions = subrandom_particle_positions(nparticles, box_vectors, min_distance=3.0*unit.angstroms)
+
     """
-    # Create positions array.
-    positions = unit.Quantity(np.zeros([nparticles, 3], np.float32), unit.nanometers)
+    if method not in ['halton', 'sobol']:
+        raise Exception("method '%s' must be 'halton' or 'sobol'" % method)
+    if seed is not None and method != 'halton':
+        raise ValueError("seed is only supported for method='halton'")
 
-    if method == 'halton':
-        # Fill in each dimension.
-        primes = [2, 3, 5]  # prime bases for Halton sequence
-        for dim in range(3):
-            x = halton_sequence(primes[dim], nparticles)
-            l = box_vectors[dim][dim]
-            positions[:, dim] = unit.Quantity(x * l / l.unit, l.unit)
-
-    elif method == 'sobol':
-        # Generate Sobol' sequence.
-        from openmmtools import sobol
-        ivec = sobol.i4_sobol_generate(3, nparticles, 1)
-        x = np.array(ivec, np.float32)
-        for dim in range(3):
-            l = box_vectors[dim][dim]
-            positions[:, dim] = unit.Quantity(x[dim, :] * l / l.unit, l.unit)
+    box_lengths = np.array([box_vectors[dim][dim] / unit.nanometers for dim in range(3)])
 
+    if min_distance is None:
+        x = _subrandom_sequence(nparticles, method, seed) * box_lengths
     else:
+        x = _place_with_min_distance(nparticles, box_lengths, min_distance / unit.nanometers, method, seed)
+
+    positions = unit.Quantity(np.array(x, np.float32), unit.nanometers)
+    return positions
+
+
+def subrandom_molecule_positions(nmolecules, box_vectors, template, method='sobol', seed=None, min_distance=None):
+    """Generate a deterministic list of subrandom positions for a fluid of identical rigid molecules.
+
+    Molecule centers are drawn from the same subrandom sequence as `subrandom_particle_positions`,
+    and each molecule is rotated by a subrandom rotation uniformly distributed over SO(3),
+    so the whole fluid is generated in bulk with an isotropic distribution of orientations.
+
+    Parameters
+    ----------
+    nmolecules : int
+        The number of molecules.
+    box_vectors : simtk.unit.Quantity of (3,3) with units compatible with nanometer
+        Periodic box vectors in which molecule centers should lie.
+    template : simtk.unit.Quantity of (natoms,3) with units compatible with nanometer
+        Coordinates of the atoms of one molecule relative to its center.
+    method : str, optional, default='sobol'
+        Method for creating subrandom sequence (one of 'halton' or 'sobol')
+    seed : int, optional, default=None
+        If specified, a scrambled Halton sequence seeded with `seed` is used (only for method='halton').
+    min_distance : simtk.unit.Quantity with units compatible with nanometer, optional, default=None
+        If specified, molecules with any atom closer than `min_distance` to an atom of an already
+        placed molecule are skipped (see `subrandom_particle_positions`).
+
+    Returns
+    -------
+    positions : simtk.unit.Quantity of (nmolecules*natoms,3) with units compatible with nanometer
+        The atom positions, with the atoms of each molecule stored contiguously.
+
+    Examples
+    --------
+    Place 100 diatomic molecules with a bond length of 1 angstrom.
+
+    >>> box_vectors = openmm.System().getDefaultPeriodicBoxVectors()
+    >>> template = unit.Quantity(np.array([[0.5, 0.0, 0.0], [-0.5, 0.0, 0.0]]), unit.angstroms)
+    >>> positions = subrandom_molecule_positions(100, box_vectors, template)
+
+    """
+    if method not in ['halton', 'sobol']:
         raise Exception("method '%s' must be 'halton' or 'sobol'" % method)
+    if seed is not None and method != 'halton':
+        raise ValueError("seed is only supported for method='halton'")
+
+    box_lengths = np.array([box_vectors[dim][dim] / unit.nanometers for dim in range(3)])
+    template = np.array(template / unit.nanometers)
+
+    if min_distance is None:
+        x = _subrandom_molecules(nmolecules, box_lengths, template, method, seed).reshape(-1, 3)
+    else:
+        x = _place_with_min_distance(nmolecules, box_lengths, min_distance / unit.nanometers, method, seed, template=template)
 
+    positions = unit.Quantity(np.array(x, np.float32), unit.nanometers)
     return positions
 
 
+def _subrandom_sequence(npoints, method, seed=None, start=0, dims=(0, 1, 2)):
+    """Return points start, ..., start+npoints-1 of a subrandom sequence on [0,1)^len(dims) as an (npoints, len(dims)) array.
+
+    `dims` selects which dimensions of the underlying multidimensional sequence are used,
+    so that different quantities can be drawn from mutually uncorrelated dimensions.
+
+    """
+    if method == 'halton':
+        primes = _first_primes(max(dims) + 1)  # prime bases for Halton sequence
+        if seed is None:
+            scramble, seeds = False, [None] * len(primes)
+        else:
+            scramble, seeds = True, np.random.RandomState(seed).randint(2**31 - 1, size=len(primes))
+        x = [halton_sequence(primes[dim], npoints, scramble=scramble, seed=seeds[dim], start=start) for dim in dims]
+        return np.array(x).reshape(len(dims), npoints).T
+    else:
+        # The Sobol' sequence starts at the origin, as in sobol.i4_sobol_generate(3, npoints, 1).
+        from openmmtools import sobol
+        return sobol.SobolSequence(max(dims) + 1, index=start).generate(npoints)[:, list(dims)]
+
+
+_PRIMES = [2]
+
+
+def _first_primes(n):
+    """Return a list of the first n prime numbers."""
+    candidate = _PRIMES[-1] + 1
+    while len(_PRIMES) < n:
+        for p in _PRIMES:
+            if p * p > candidate:
+                _PRIMES.append(candidate)
+                break
+            if candidate % p == 0:
+                break
+        candidate += 1
+    return _PRIMES[:n]
+
+
+def subrandom_velocities(system, temperature, nsamples=1, start=0, method='sobol', seed=0):
+    """Generate deterministic low-discrepancy velocities from the Maxwell-Boltzmann distribution.
+
+    The samples are the points of a three-dimensional subrandom sequence, shifted for each particle
+    by a random offset modulo 1 (a Cranley-Patterson rotation), mapped through the inverse normal
+    cumulative distribution function and scaled by sqrt(kT/m). The offsets decorrelate the particles,
+    while averages over consecutive samples still converge faster than averages over pseudorandom
+    draws, so fewer samples are needed for the same confidence in validation runs. The cost is linear
+    in the number of particles and samples.
+
+    Parameters
+    ----------
+    system : simtk.openmm.System
+        The system, which provides the particle masses.
+    temperature : simtk.unit.Quantity with units compatible with kelvin
+        The temperature of the Maxwell-Boltzmann distribution.
+    nsamples : int, optional, default=1
+        The number of velocity samples to generate.
+    start : int, optional, default=0
+        The index of the first sample in the sequence.
+    method : str, optional, default='sobol'
+        Method for creating subrandom sequence (one of 'halton' or 'sobol').
+    seed : int, optional, default=0
+        Seed of the random per-particle offsets. If None, the offsets are not reproducible.
+
+    Returns
+    -------
+    velocities : simtk.unit.Quantity of (nsamples,nparticles,3) with units compatible with nanometers/picosecond
+        The velocities. Massless particles get zero velocity. Constraints are not applied;
+        use `set_subrandom_velocities` to project the velocities of a Context onto the constraints.
+
+    Examples
+    --------
+    >>> testsystem = HarmonicOscillator()
+    >>> velocities = subrandom_velocities(testsystem.system, 300*unit.kelvin, nsamples=10)
+
+    """
+    if method not in ['halton', 'sobol']:
+        raise Exception("method '%s' must be 'halton' or 'sobol'" % method)
+
+    nparticles = system.getNumParticles()
+    masses = np.array([system.getParticleMass(i) / unit.amu for i in range(nparticles)])
+    kT = kB * temperature
+    sigma = np.zeros(nparticles)
+    massive = masses > 0
+    sigma[massive] = np.sqrt((kT / unit.kilojoules_per_mole) / masses[massive])  # nm/ps
+
+    offsets = np.random.RandomState(seed).uniform(size=(nparticles, 3))
+    u = (_subrandom_sequence(nsamples, method, start=start)[:, np.newaxis, :] + offsets[np.newaxis, :, :]) % 1.0
+    eps = np.finfo(np.double).eps
+    z = scipy.special.ndtri(np.clip(u, eps, 1 - eps))
+    return unit.Quantity(z * sigma[np.newaxis, :, np.newaxis], unit.nanometers / unit.picoseconds)
+
+
+def set_subrandom_velocities(context, temperature, index=0, method='sobol', seed=0):
+    """Set the velocities of a Context to a subrandom Maxwell-Boltzmann sample, projected onto the constraints.
+
+    This is a deterministic replacement for Context.setVelocitiesToTemperature().
+
+    Parameters
+    ----------
+    context : simtk.openmm.Context
+        The context, whose positions must already be set if the system has constraints.
+    temperature : simtk.unit.Quantity with units compatible with kelvin
+        The temperature of the Maxwell-Boltzmann distribution.
+    index : int, optional, default=0
+        The index of the sample in the sequence; use consecutive indices for consecutive runs.
+    method : str, optional, default='sobol'
+        Method for creating subrandom sequence (see `subrandom_velocities`).
+    seed : int, optional, default=0
+        Seed of the random per-particle offsets (see `subrandom_velocities`).
+
+    Examples
+    --------
+    >>> testsystem = HarmonicOscillator()
+    >>> integrator = openmm.VerletIntegrator(1.0 * unit.femtoseconds)
+    >>> context = openmm.Context(testsystem.system, integrator)
+    >>> context.setPositions(testsystem.positions)
+    >>> set_subrandom_velocities(context, 300*unit.kelvin)
+
+    """
+    system = context.getSystem()
+    velocities = subrandom_velocities(system, temperature, nsamples=1, start=index, method=method, seed=seed)[0]
+    context.setVelocities(velocities)
+    if system.getNumConstraints() > 0:
+        context.applyVelocityConstraints(1.0e-6)
+
+
+def subrandom_unit_vectors(n, method='sobol', seed=None):
+    """Generate a deterministic list of subrandom unit vectors, uniformly distributed on the sphere.
+
+    Parameters
+    ----------
+    n : int
+        The number of unit vectors.
+    method : str, optional, default='sobol'
+        Method for creating subrandom sequence (one of 'halton' or 'sobol')
+    seed : int, optional, default=None
+        If specified, a scrambled Halton sequence seeded with `seed` is used (only for method='halton').
+
+    Returns
+    -------
+    vectors : numpy.ndarray with shape (n, 3)
+        The unit vectors.
+
+    Notes
+    -----
+    Points of a two-dimensional subrandom sequence are mapped onto the sphere by the
+    area-preserving map z = 1 - 2u, phi = 2 pi v. The dimensions used are independent of
+    those used by `subrandom_particle_positions`, so orientations are not correlated with positions.
+
+    Examples
+    --------
+    >>> vectors = subrandom_unit_vectors(100)
+
+    """
+    if seed is not None and method != 'halton':
+        raise ValueError("seed is only supported for method='halton'")
+    u = _subrandom_sequence(n, method, seed, dims=(3, 4))
+    z = 1.0 - 2.0 * u[:, 0]
+    phi = 2.0 * pi * u[:, 1]
+    r = np.sqrt(1.0 - z**2)
+    return np.array([r * np.cos(phi), r * np.sin(phi), z]).T
+
+
+def subrandom_rotation_matrices(n, method='sobol', seed=None):
+    """Generate a deterministic list of subrandom rotation matrices, uniformly distributed over SO(3).
+
+    Parameters
+    ----------
+    n : int
+        The number of rotation matrices.
+    method : str, optional, default='sobol'
+        Method for creating subrandom sequence (one of 'halton' or 'sobol')
+    seed : int, optional, default=None
+        If specified, a scrambled Halton sequence seeded with `seed` is used (only for method='halton').
+
+    Returns
+    -------
+    rotations : numpy.ndarray with shape (n, 3, 3)
+        The rotation matrices.
+
+    Notes
+    -----
+    Points of a three-dimensional subrandom sequence are mapped to uniformly distributed unit
+    quaternions with the method of Shoemake [Graphics Gems III, pp. 124-132 (1992)].
+
+    Examples
+    --------
+    Apply random rotations to a set of rigid molecules with coordinates relative to their centers.
+
+    >>> rotations = subrandom_rotation_matrices(10)
+    >>> xyz = np.dot(rotations, np.array([1.0, 0.0, 0.0]))
+
+    """
+    if seed is not None and method != 'halton':
+        raise ValueError("seed is only supported for method='halton'")
+    u = _subrandom_sequence(n, method, seed, dims=(3, 4, 5))
+    return _uniform_rotation_matrices(u)
+
+
+def _uniform_rotation_matrices(u):
+    """Map points of [0,1)^3, as an (n,3) array, to uniformly distributed rotation matrices of shape (n,3,3)."""
+    a, b = np.sqrt(1.0 - u[:, 0]), np.sqrt(u[:, 0])
+    qx, qy = a * np.sin(2 * pi * u[:, 1]), a * np.cos(2 * pi * u[:, 1])
+    qz, qw = b * np.sin(2 * pi * u[:, 2]), b * np.cos(2 * pi * u[:, 2])
+    rotations = np.array([
+        [1 - 2 * (qy**2 + qz**2), 2 * (qx * qy - qz * qw), 2 * (qx * qz + qy * qw)],
+        [2 * (qx * qy + qz * qw), 1 - 2 * (qx**2 + qz**2), 2 * (qy * qz - qx * qw)],
+        [2 * (qx * qz - qy * qw), 2 * (qy * qz + qx * qw), 1 - 2 * (qx**2 + qy**2)],
+        ])
+    return rotations.transpose(2, 0, 1)
+
+
+def _subrandom_molecules(nmolecules, box_lengths, template, method, seed=None, start=0):
+    """Return subrandom atom coordinates for molecules start, ..., start+nmolecules-1 as an (nmolecules, natoms, 3) array.
+
+    All lengths are unitless, in consistent units. Centers are taken from the same sequence
+    dimensions as `subrandom_particle_positions` and rotations from those of `subrandom_rotation_matrices`.
+
+    """
+    u = _subrandom_sequence(nmolecules, method, seed, start=start, dims=(0, 1, 2, 3, 4, 5))
+    centers = u[:, :3] * box_lengths
+    rotations = _uniform_rotation_matrices(u[:, 3:])
+    return centers[:, np.newaxis, :] + np.einsum('nij,aj->nai', rotations, template)
+
+
+def _place_with_min_distance(nmolecules, box_lengths, min_distance, method, seed, template=None, max_candidates_per_molecule=100):
+    """Place particles (or rigid molecules) from a subrandom sequence, skipping candidates closer than min_distance to placed atoms.
+
+    All lengths are unitless, in consistent units. If `template` is None, single particles are
+    placed; otherwise, each candidate is a molecule with atoms at `template` relative to its center.
+
+    """
+    # Candidates are generated in chunks. A whole chunk is tested at once against the atoms already placed,
+    # with a periodic k-d tree, and only the conflicts between the remaining candidates of the chunk are
+    # resolved one by one, in sequence order, so the result is the same as for one candidate at a time.
+    box_lengths = np.array(box_lengths, np.float64)
+
+    def wrap(x):
+        # Periodic k-d trees require coordinates in [0, box_length); atoms of molecules that straddle the box
+        # boundary are only wrapped for the neighbor search.
+        x = np.mod(x, box_lengths)
+        return np.where(x < box_lengths, x, 0.0)
+
+    positions = np.zeros([0, 1 if template is None else len(template), 3])
+    ncandidates = 0
+    chunk_size = max(nmolecules, 1024)
+    while len(positions) < nmolecules:
+        if ncandidates >= max_candidates_per_molecule * nmolecules:
+            raise ValueError("Could only place %d of %d molecules at a minimum distance of %f; "
+                             "try a smaller min_distance." % (len(positions), nmolecules, min_distance))
+        if template is None:
+            candidates = _subrandom_sequence(chunk_size, method, seed, start=ncandidates) * box_lengths
+            candidates = candidates[:, np.newaxis, :]
+        else:
+            candidates = _subrandom_molecules(chunk_size, box_lengths, template, method, seed, start=ncandidates)
+        ncandidates += chunk_size
+        natoms = candidates.shape[1]
+
+        # Discard candidates with an atom too close to an atom already placed.
+        if len(positions) > 0:
+            tree = scipy.spatial.cKDTree(wrap(positions.reshape(-1, 3)), boxsize=box_lengths)
+            distances, _ = tree.query(wrap(candidates.reshape(-1, 3)), distance_upper_bound=min_distance)
+            candidates = candidates[np.all(distances.reshape(-1, natoms) >= min_distance, axis=1)]
+
+        # Of the remaining candidates, accept each one that does not overlap with a candidate accepted before it.
+        tree = scipy.spatial.cKDTree(wrap(candidates.reshape(-1, 3)), boxsize=box_lengths)
+        pairs = tree.query_pairs(min_distance, output_type='ndarray') // natoms
+        pairs = np.sort(pairs[pairs[:, 0] != pairs[:, 1]], axis=1)
+        earlier_overlaps = dict()
+        for (i, j) in pairs.tolist():
+            earlier_overlaps.setdefault(j, []).append(i)
+        accepted = np.zeros(len(candidates), bool)
+        nremaining = nmolecules - len(positions)
+        for j in range(len(candidates)):
+            accepted[j] = not any(accepted[i] for i in earlier_overlaps.get(j, ()))
+            if accepted[j]:
+                nremaining -= 1
+                if nremaining == 0:
+                    break
+        positions = np.concatenate([positions, candidates[accepted]])
+
+    return positions.reshape(-1, 3)
+
+
+def random_packing_distance(number_density, packing_fraction=0.3):
+    """Return the sphere diameter that gives the specified packing fraction at a given number density.
+
+    Random sequential placement of spheres jams at a packing fraction of about 0.38, so
+    this is a safe choice of `min_distance` for `subrandom_particle_positions` at any density.
+
+    Parameters
+    ----------
+    number_density : simtk.unit.Quantity with units compatible with 1/nanometer**3
+        The number of particles per unit volume.
+    packing_fraction : float, optional, default=0.3
+        The fraction of the volume occupied by spheres of the returned diameter.
+
+    Returns
+    -------
+    diameter : simtk.unit.Quantity with units compatible with nanometer
+        The sphere diameter.
+
+    """
+    return (6.0 * packing_fraction / (pi * number_density))**(1.0 / 3.0)
+
+
 def build_lattice_cell():
     """Build a single (4 atom) unit cell of a FCC lattice, assuming a cell length
     of 1.0.
@@ -330,6 +728,75 @@ def generate_dummy_trajectory(xyz, box):
     return traj
 
 
+# Force classes that are cheap, stiff and local, and belong to the innermost MTS level.
+_BONDED_FORCE_CLASSES = ['HarmonicBondForce', 'HarmonicAngleForce', 'PeriodicTorsionForce', 'RBTorsionForce',
+                         'CMAPTorsionForce', 'CustomBondForce', 'CustomAngleForce', 'CustomTorsionForce',
+                         'CustomCompoundBondForce', 'CMMotionRemover']
+# Substrings of the names of force classes that compute long range interactions.
+_NONBONDED_FORCE_NAMES = ['Nonbonded', 'GB', 'Amoeba', 'Hbond']
+
+def assign_mts_force_groups(testsystem, bonded_substeps=4, direct_space_substeps=2, reciprocal_space_substeps=1):
+    """Partition the forces of a test system into force groups for multiple timestep integration.
+
+    Bonded forces are placed in force group 0, nonbonded forces in group 1 and, when a NonbondedForce
+    uses Ewald summation or PME, its reciprocal space contribution in group 2. Forces of other classes
+    (restraints, barostats, external fields) are placed with the bonded forces, which is always safe
+    but evaluates them at every inner step.
+
+    Parameters
+    ----------
+    testsystem : TestSystem or simtk.openmm.System
+        The test system whose forces will be assigned to groups. The System is modified in place.
+    bonded_substeps : int, optional, default=4
+        Number of evaluations of the bonded forces per outer time step.
+    direct_space_substeps : int, optional, default=2
+        Number of evaluations of the direct space nonbonded forces per outer time step.
+    reciprocal_space_substeps : int, optional, default=1
+        Number of evaluations of the reciprocal space nonbonded forces per outer time step.
+
+    Returns
+    -------
+    groups : list of tuples
+        The force group specification for MTSIntegrator or LangevinMTSIntegrator, with groups that
+        contain no forces omitted.
+
+    Examples
+    --------
+
+    Evaluate PME reciprocal space forces every 4 fs and bonded forces every 1 fs.
+
+    >>> from openmmtools import integrators
+    >>> testsystem = WaterBox(constrained=False)
+    >>> groups = assign_mts_force_groups(testsystem, bonded_substeps=4, direct_space_substeps=2, reciprocal_space_substeps=1)
+    >>> integrator = integrators.MTSIntegrator(4.0*unit.femtoseconds, groups)
+
+    """
+    if not (reciprocal_space_substeps > 0 and direct_space_substeps % reciprocal_space_substeps == 0
+            and bonded_substeps % direct_space_substeps == 0):
+        raise ValueError("The number of substeps of each force group must be a multiple of that of the next slower group")
+    system = getattr(testsystem, 'system', testsystem)
+
+    reciprocal_space_methods = [openmm.NonbondedForce.Ewald, openmm.NonbondedForce.PME]
+    if hasattr(openmm.NonbondedForce, 'LJPME'):
+        reciprocal_space_methods.append(openmm.NonbondedForce.LJPME)
+
+    used_groups = set()
+    for force in system.getForces():
+        force_name = force.__class__.__name__
+        if force_name not in _BONDED_FORCE_CLASSES and any(name in force_name for name in _NONBONDED_FORCE_NAMES):
+            group = 1
+        else:
+            group = 0
+        force.setForceGroup(group)
+        used_groups.add(group)
+        if isinstance(force, openmm.NonbondedForce) and force.getNonbondedMethod() in reciprocal_space_methods:
+            force.setReciprocalSpaceForceGroup(2)
+            used_groups.add(2)
+
+    substeps = {0: bonded_substeps, 1: direct_space_substeps, 2: reciprocal_space_substeps}
+    return [(group, substeps[group]) for group in [2, 1, 0] if group in used_groups]
+
+
 #=============================================================================================
 # Thermodynamic state description
 #=============================================================================================
@@ -1016,6 +1483,10 @@ class DiatomicFluid(TestSystem):
         If None, no switch will be applied (e.g. hard cutoff).
     dispersion_correction : bool, optional, default=True
         if True, will use analytical dispersion correction (if not using switching function)
+    avoid_overlaps : bool, optional, default=False
+        If True, molecules with an atom closer than min(sigma, random_packing_distance(density, packing_fraction=0.25))
+        to an atom of an already placed molecule are skipped, so that dense fluids can be simulated without
+        minimization.  A ValueError is raised if the molecules cannot be placed.
 
 
     Notes
@@ -1063,6 +1534,7 @@ class DiatomicFluid(TestSystem):
                  cutoff=None,
                  constraint=False,
                  dispersion_correction=True,
+                 avoid_overlaps=False,
                  **kwargs):
 
         TestSystem.__init__(self, **kwargs)
@@ -1109,18 +1581,15 @@ class DiatomicFluid(TestSystem):
         c = unit.Quantity((0 * unit.angstrom, 0 * unit.angstrom, box_edge))
         system.setDefaultPeriodicBoxVectors(a, b, c)
 
-        # Create initial molecule centers of geometry using subrandom positions.
-        molecule_positions = subrandom_particle_positions(nmolecules, system.getDefaultPeriodicBoxVectors())  # for molecule centers
-        molecule_directions = subrandom_particle_positions(nmolecules, system.getDefaultPeriodicBoxVectors())  # for molecule orientations
-
-        # Compute particle positions.
-        positions = unit.Quantity(np.zeros([nparticles, 3], np.float32), unit.angstroms)
-        unit_vector = np.array([1, 0, 0], np.float32)
-        for molecule_index in range(0, nmolecules):
-            vector = molecule_directions[molecule_index, :] - molecule_directions.mean(0)
-            unit_vector = vector / unit.norm(vector)
-            positions[2 * molecule_index + 0, :] = molecule_positions[molecule_index, :] + 0.5 * r0 * unit_vector
-            positions[2 * molecule_index + 1, :] = molecule_positions[molecule_index, :] - 0.5 * r0 * unit_vector
+        # Create initial particle positions from subrandom molecule centers and isotropic orientations,
+        # optionally keeping atoms of different molecules apart. Elongated molecules jam at lower packing
+        # fractions than spheres, so a smaller separation than for atomic fluids is used.
+        template = unit.Quantity(np.array([[+0.5, 0.0, 0.0], [-0.5, 0.0, 0.0]]) * (r0 / unit.angstroms), unit.angstroms)
+        if avoid_overlaps:
+            min_distance = min(sigma, random_packing_distance(number_density, packing_fraction=0.25))
+        else:
+            min_distance = None
+        positions = subrandom_molecule_positions(nmolecules, system.getDefaultPeriodicBoxVectors(), template, min_distance=min_distance)
 
         # Add exceptions for intramolecular forces.
         for molecule_index in range(nmolecules):
@@ -1742,6 +2211,10 @@ class LennardJonesFluid(TestSystem):
         testing the effect of charges in small systems.
     ewaldErrorTolerance : float, optional, default=5E-4
            The Ewald or PME tolerance.  Used only if charge is not None.
+    avoid_overlaps : bool, optional, default=False
+        If True (and `lattice` is False), subrandom positions closer than min(sigma, random_packing_distance(density))
+        to an already placed particle are skipped, so that dense fluids can be simulated without minimization.
+        A ValueError is raised if the particles cannot be placed.
 
     Examples
     --------
@@ -1756,6 +2229,11 @@ class LennardJonesFluid(TestSystem):
     >>> fluid = LennardJonesFluid(nparticles=1000, reduced_density=0.50)
     >>> system, positions = fluid.system, fluid.positions
 
+    Create a liquid-density Lennard-Jones fluid that can be simulated without minimization.
+
+    >>> fluid = LennardJonesFluid(nparticles=1000, reduced_density=0.80, avoid_overlaps=True)
+    >>> system, positions = fluid.system, fluid.positions
+
     Create Lennard-Jones fluid using switched particle interactions (switched off betwee 7 and 9 A) and more particles.
 
     >>> fluid = LennardJonesFluid(switch_width=2.0*unit.angstroms, cutoff=9.0*unit.angstroms)
@@ -1781,6 +2259,7 @@ class LennardJonesFluid(TestSystem):
                  lattice=False,
                  charge=None,
                  ewaldErrorTolerance=None,
+                 avoid_overlaps=False,
                  **kwargs):
 
         TestSystem.__init__(self, **kwargs)
@@ -1845,6 +2324,9 @@ class LennardJonesFluid(TestSystem):
             xyz *= (box_nm / box)
             traj = generate_dummy_trajectory(xyz, box_nm)
             positions = traj.openmm_positions(0)
+        elif avoid_overlaps:  # Create initial coordinates using subrandom positions, keeping particles apart.
+            min_distance = min(sigma, random_packing_distance(number_density))
+            positions = subrandom_particle_positions(nparticles, system.getDefaultPeriodicBoxVectors(), min_distance=min_distance)
         else:  # Create initial coordinates using subrandom positions.
             positions = subrandom_particle_positions(nparticles, system.getDefaultPeriodicBoxVectors())
         # Add the nonbonded force.
@@ -2143,7 +2625,8 @@ class CustomLennardJonesFluidMixture(TestSystem):
 
 class WCAFluid(TestSystem):
 
-    def __init__(self, nparticles=216, density=0.96, mass=39.9 * unit.amu, epsilon=120.0 * unit.kelvin * kB, sigma=3.4 * unit.angstrom, **kwargs):
+    def __init__(self, nparticles=216, density=0.96, mass=39.9 * unit.amu, epsilon=120.0 * unit.kelvin * kB, sigma=3.4 * unit.angstrom,
+                 avoid_overlaps=False, **kwargs):
         """
         Create a Weeks-Chandler-Andersen system.
 
@@ -2159,6 +2642,10 @@ class WCAFluid(TestSystem):
             WCA well depth.
         sigma : simtk.unit.Quantity
             WCA sigma.
+        avoid_overlaps : bool, optional, default=False
+            If True, subrandom positions closer than min(sigma, random_packing_distance(density)) to an already
+            placed particle are skipped, so that the fluid can be simulated without minimization.
+            A ValueError is raised if the particles cannot be placed.
 
         """
 
@@ -2202,8 +2689,12 @@ class WCAFluid(TestSystem):
         # Add nonbonded force term to the system.
         system.addForce(force)
 
-        # Create initial coordinates using subrandom positions.
-        positions = subrandom_particle_positions(nparticles, system.getDefaultPeriodicBoxVectors())
+        # Create initial coordinates using subrandom positions, optionally keeping particles apart.
+        if avoid_overlaps:
+            min_distance = min(sigma, random_packing_distance(density / unit.nanometer**3))
+        else:
+            min_distance = None
+        positions = subrandom_particle_positions(nparticles, system.getDefaultPeriodicBoxVectors(), min_distance=min_distance)
 
         # Create topology.
         topology = app.Topology()